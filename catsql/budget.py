@@ -0,0 +1,133 @@
+from __future__ import print_function
+import sqlite3
+import sys
+import threading
+import time
+from sqlalchemy import event
+
+# sqlite virtual machine steps between checks of the clock
+SQLITE_PROGRESS_STEPS = 1000
+
+
+def install_timeout(engine, seconds):
+    """Have the database cancel any statement that runs for longer than the
+    given number of seconds, using its own setting for this where it has
+    one.  A cancelled statement raises an error recognized by timed_out()."""
+    ms = int(seconds * 1000)
+    dialect = engine.dialect.name
+    if dialect == 'postgresql':
+        _on_connect(engine, 'SET statement_timeout = {}'.format(ms))
+    elif dialect == 'mysql':
+        # only applies to SELECT statements, which is all we need
+        _on_connect(engine, 'SET SESSION MAX_EXECUTION_TIME = {}'.format(ms))
+    elif dialect == 'sqlite':
+        _sqlite_deadline(engine, seconds)
+    else:
+        print("No statement timeout for {} databases".format(dialect),
+              file=sys.stderr)
+
+
+def timed_out(error):
+    """Check if a DBAPIError is from a statement cancelled for taking too
+    long."""
+    orig = getattr(error, 'orig', error)
+    if getattr(orig, 'pgcode', None) == '57014':
+        # postgres query_canceled
+        return True
+    args = getattr(orig, 'args', ())
+    if len(args) > 0 and args[0] in [3024, 1317]:
+        # mysql max execution time exceeded, query interrupted
+        return True
+    # sqlite, interrupted by the progress handler
+    return (isinstance(orig, sqlite3.OperationalError) and
+            str(orig) == 'interrupted')
+
+
+def _on_connect(engine, sql):
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(sql)
+        cursor.close()
+
+
+def timed_rows(rows):
+    """Iterate over rows from a query, counting only the time spent getting
+    each row (not what is done with it) against a sqlite statement
+    timeout."""
+    rows = iter(rows)
+    while True:
+        _resume()
+        try:
+            row = next(rows)
+        except StopIteration:
+            return
+        finally:
+            _pause()
+        yield row
+
+
+# the clock of the last statement started in each thread
+_current = threading.local()
+
+
+class _Clock(object):
+    # time left for the statement on a sqlite connection, running down only
+    # while the database is working on it
+    def __init__(self):
+        self.left = None
+        self.since = None
+
+    def start(self, seconds):
+        self.left = seconds
+        self.since = time.time()
+
+    def resume(self):
+        if self.left is not None and self.since is None:
+            self.since = time.time()
+
+    def pause(self):
+        if self.since is not None:
+            self.left -= time.time() - self.since
+            self.since = None
+
+    def run_out(self):
+        return self.since is not None and time.time() - self.since > self.left
+
+
+def _resume():
+    clock = getattr(_current, 'clock', None)
+    if clock is not None:
+        clock.resume()
+
+
+def _pause():
+    clock = getattr(_current, 'clock', None)
+    if clock is not None:
+        clock.pause()
+
+
+def _sqlite_deadline(engine, seconds):
+    # sqlite has no timeout setting, but a progress handler can interrupt
+    # a statement (including while its rows are fetched) once its time is up
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        clock = connection_record.info['catsql_clock'] = _Clock()
+
+        def check():
+            return 1 if clock.run_out() else 0
+        dbapi_connection.set_progress_handler(check, SQLITE_PROGRESS_STEPS)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start(conn, cursor, statement, parameters, context, executemany):
+        clock = conn.connection.info.get('catsql_clock')
+        if clock is not None:
+            clock.start(seconds)
+            _current.clock = clock
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def stop(conn, cursor, statement, parameters, context, executemany):
+        # later rows are timed only while fetched through timed_rows()
+        clock = conn.connection.info.get('catsql_clock')
+        if clock is not None:
+            clock.pause()
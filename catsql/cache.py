@@ -0,0 +1,101 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+CACHE_VERSION = 1
+
+# Cheap queries whose result changes whenever tables are created, dropped
+# or altered.  Where there is none, entries just expire after their ttl.
+FINGERPRINTS = {
+    'sqlite': "PRAGMA schema_version",
+    'postgresql': "SELECT count(*) || ':' || max(xmin::text::bigint) "
+                  "FROM pg_catalog.pg_class",
+    'mysql': "SELECT CONCAT(COUNT(*), ':', COALESCE(MAX(CREATE_TIME), '')) "
+             "FROM information_schema.TABLES "
+             "WHERE TABLE_SCHEMA = COALESCE(:schema, DATABASE())",
+}
+
+
+def default_cache_dir():
+    return os.environ.get('CATSQL_CACHE_DIR') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'catsql')
+
+
+class SchemaCache(object):
+    """Reflected table metadata, kept on disk between runs.
+
+    Entries are keyed by database url, schema and requested tables.  An
+    entry is used only if it is younger than `ttl` seconds and, for
+    databases with a fingerprint query, only if the schema has not changed
+    since it was stored.
+    """
+
+    def __init__(self, directory=None, ttl=300):
+        self.directory = directory or default_cache_dir()
+        self.ttl = ttl
+
+    def usable(self, engine):
+        # in-memory databases don't outlive the process
+        return engine.url.database not in [None, '', ':memory:']
+
+    def path(self, engine, schema, only):
+        key = repr((str(engine.url), schema, sorted(only) if only else None))
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'schema-{}.pickle'.format(digest))
+
+    def fingerprint(self, engine, schema):
+        sql = FINGERPRINTS.get(engine.dialect.name)
+        if sql is None:
+            return None
+        try:
+            with engine.connect() as conn:
+                params = {'schema': schema} if ':schema' in sql else {}
+                return str(conn.execute(text(sql), params).scalar())
+        except DBAPIError:
+            return None
+
+    def load(self, engine, schema, only, fingerprint):
+        if not self.usable(engine):
+            return None
+        try:
+            with open(self.path(engine, schema, only), 'rb') as fin:
+                entry = pickle.load(fin)
+        except Exception:
+            # missing, unreadable, or from an incompatible version
+            return None
+        if entry.get('version') != CACHE_VERSION:
+            return None
+        if time.time() - entry['time'] > self.ttl:
+            return None
+        if entry['fingerprint'] != fingerprint:
+            return None
+        return entry
+
+    def save(self, engine, schema, only, fingerprint, names, metadata,
+             created=None):
+        if not self.usable(engine):
+            return
+        entry = {
+            'version': CACHE_VERSION,
+            'time': created or time.time(),
+            'fingerprint': fingerprint,
+            'names': names,
+            'metadata': metadata,
+        }
+        tmp = None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, 0o700)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fout:
+                pickle.dump(entry, fout, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.path(engine, schema, only))
+        except Exception:
+            # caching is only an optimization
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
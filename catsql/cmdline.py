@@ -1,3 +1,6 @@
+from catsql.grep import GREP_MODES
+
+
 def add_options(parser):
 
     parser.add_argument('catsql_database_url',
@@ -7,6 +10,33 @@ def add_options(parser):
                         'postgres[ql]://user:pass@host/db, '
                         'data.sqlite3')
 
+    parser.add_argument('--after', nargs=1, required=False, default=None,
+                        help='Continue from the page of results that printed '
+                        'this token. Use with --page-size.')
+
+    parser.add_argument('--approx-count', default=False, action='store_true',
+                        help='Like --count, but use the row counts estimated '
+                        'by the database where it has them (for tables '
+                        'without filters). Fast, but may be out of date.')
+
+    parser.add_argument('--arrow', nargs=1, required=False, default=None,
+                        help='Save results to an arrow (feather) file. Only '
+                        'one table allowed. Needs pyarrow.')
+
+    parser.add_argument('--batch-size', nargs=1, required=False, default=None,
+                        help='Number of rows to fetch from the database at a '
+                        'time. Rows are streamed from a server-side cursor '
+                        'where the database supports it (default: 1000).')
+
+    parser.add_argument('--cache-schema', default=False, action='store_true',
+                        help='Keep reflected table metadata on disk for '
+                        'reuse by later runs (in $CATSQL_CACHE_DIR, default '
+                        '~/.cache/catsql).')
+
+    parser.add_argument('--cache-ttl', nargs=1, required=False, default=None,
+                        help='Seconds that cached table metadata stays valid '
+                        '(default: 300).')
+
     parser.add_argument('--column', action='append',
                         help='Column to include (defaults to all columns). '
                         'Can be a comma separated list of multiple columns.')
@@ -27,10 +57,56 @@ def add_options(parser):
     parser.add_argument('--excel', nargs=1, required=False, default=None,
                         help='Save results to an excel file.')
 
+    parser.add_argument('--excel-split', default=False, action='store_true',
+                        help='Continue tables too long for an excel sheet '
+                        '(over 1048575 rows) on extra sheets, rather than '
+                        'cutting them short.')
+
+    parser.add_argument('--explain', default=False, action='store_true',
+                        help='Show how the database plans to run the query '
+                        'for each table, flagging tables it would read in '
+                        'full, without running anything.')
+
     parser.add_argument('--grep', action='append',
                         help='Search cells for occurrence of a text fragment. '
                         'Translated to SQL query, performed by database.')
 
+    parser.add_argument('--grep-index', default=False, action='store_true',
+                        help='Answer --grep from a local full-text index of '
+                        'the database, kept in ~/.cache/catsql (or '
+                        '$CATSQL_CACHE_DIR). The index is built on first use '
+                        'and extended with changed rows on each run. Needs '
+                        '--grep-index-column, and only covers tables with a '
+                        'primary key and that column; others are searched '
+                        'directly.')
+
+    parser.add_argument('--grep-index-column', nargs=1, required=False,
+                        default=None,
+                        help='Column that increases whenever a row changes, '
+                        'such as a last-modified time, used by --grep-index '
+                        'to find rows to reindex. Tables where it can be '
+                        'NULL are searched directly.')
+
+    parser.add_argument('--grep-index-rebuild', default=False,
+                        action='store_true',
+                        help='Rebuild the --grep-index from scratch.')
+
+    parser.add_argument('--grep-mode', required=False, default='contains',
+                        choices=GREP_MODES,
+                        help='How --grep matches: "contains" searches text '
+                        'columns for the fragment, "exact" matches whole '
+                        'values and can use ordinary indexes, "prefix" '
+                        'matches their start, ignoring case, and can use '
+                        'indexes that ignore case, "fulltext" uses the '
+                        'database\'s full-text search where set up (sqlite: '
+                        'an FTS5 table called <table>_fts), "concat" '
+                        'searches all columns joined together (default: '
+                        'contains).')
+
+    parser.add_argument('--jobs', nargs=1, required=False, default=None,
+                        help='Number of tables to query at the same time, '
+                        'each over its own connection (default: 1).')
+
     parser.add_argument('--json', nargs=1, required=False, default=None,
                         help='Save results to a json file. Only one table allowed.')
 
@@ -40,6 +116,16 @@ def add_options(parser):
     parser.add_argument('--load-bookmark', required=False, action='store_true',
                         help='Load a set of filters from a file.')
 
+    parser.add_argument('--max-rows', nargs=1, required=False, default=None,
+                        help='Most rows to read from any one table. Tables '
+                        'with more are cut short with a warning, other '
+                        'tables carry on, and the exit status is 1.')
+
+    parser.add_argument('--ndjson', nargs=1, required=False, default=None,
+                        help='Save results as json, one row per line, to a '
+                        'file, or to standard output if the file is "-". '
+                        'Only one table allowed.')
+
     parser.add_argument('--order', action='append',
                         help='Columns to order by. '
                         'Can be a comma separated list of columns names. '
@@ -50,9 +136,43 @@ def add_options(parser):
     parser.add_argument('--output', nargs=1, required=False, default=None,
                         help='Save output to specified file.  Incompatible with --edit.')
 
+    parser.add_argument('--page-size', nargs=1, required=False, default=None,
+                        help='Show a page of this many rows per table, '
+                        'ordered by primary (or other unique) key, and print '
+                        'a token for fetching the next page with --after. '
+                        'Tables without such a key are skipped.')
+
+    parser.add_argument('--parquet', nargs=1, required=False, default=None,
+                        help='Save results to a parquet file. Only one table '
+                        'allowed. Needs pyarrow.')
+
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='Report on stderr where time went: connecting, '
+                        'reflecting, and for each table executing, fetching '
+                        'and formatting, with rows, bytes written and '
+                        'rows/sec.')
+
+    parser.add_argument('--profile-json', nargs=1, required=False,
+                        default=None,
+                        help='Save the --profile report to a json file.')
+
+    parser.add_argument('--row-group-size', nargs=1, required=False,
+                        default=None,
+                        help='Rows per parquet row group, or arrow record '
+                        'batch (default: 65536).')
+
     parser.add_argument('--safe-null', required=False, action='store_true',
                         help='Encode nulls in a reversible way.')
 
+    parser.add_argument('--sample', nargs=1, required=False, default=None,
+                        help='Show a random sample of at most this many rows '
+                        'per table. Uses table sampling where the database '
+                        'has it, rather than sorting every row randomly.')
+
+    parser.add_argument('--sample-pct', nargs=1, required=False, default=None,
+                        help='Show a random sample of about this percentage '
+                        'of rows per table.')
+
     parser.add_argument('--save-bookmark', nargs=1, required=False, default=None,
                         help='Save the current set of filters specified to a file.')
 
@@ -63,8 +183,7 @@ def add_options(parser):
                         help='Add a raw SQL filter for rows to include.  Example: '
                         '"total < 1000", "created_at > now() - interval \'1 day\'". '
                         'Tables that don\'t have the columns mentioned are '
-                        'omitted.'
-    )
+                        'omitted.')
 
     parser.add_argument('--sqlite', nargs=1, required=False, default=None,
                         help='Save results to a sqlite file.')
@@ -79,6 +198,13 @@ def add_options(parser):
     parser.add_argument('--terse', default=False, action='store_true',
                         help='Hide any columns with predetermined values.')
 
+    parser.add_argument('--timeout', nargs=1, required=False, default=None,
+                        help='Seconds any one query may run, enforced by the '
+                        'database where it can (statement_timeout on '
+                        'postgres, MAX_EXECUTION_TIME on mysql). Tables that '
+                        'take longer are skipped or cut short with a '
+                        'warning, and the exit status is 1.')
+
     parser.add_argument('--txt', nargs=1, required=False, default=None,
                         help='Save results to a text file (in csv format).')
 
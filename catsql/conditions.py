@@ -0,0 +1,132 @@
+from __future__ import unicode_literals
+import re
+
+# Pick apart a raw sql condition, as given to --sql, just enough to tell
+# which columns it refers to.  This lets us decide which tables a condition
+# makes sense for without sending a query to each of them.
+
+TOKEN = re.compile(r"""
+    (?P<string>'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*")
+  | (?P<delimited>`[^`]*`|\[[^\]]*\])
+  | (?P<number>\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|\.\d+)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<cast>::)
+  | (?P<other>\S)
+""", re.VERBOSE)
+
+KEYWORDS = set("""
+    ALL AND ANY AS ASC AT BETWEEN BINARY BY CASE CAST COLLATE CURRENT_DATE
+    CURRENT_TIME CURRENT_TIMESTAMP CURRENT_USER DESC DISTINCT DIV ELSE END
+    ESCAPE EXISTS FALSE FROM GLOB ILIKE IN INTERVAL IS ISNULL LIKE LOCALTIME
+    LOCALTIMESTAMP MATCH MOD NOT NOTNULL NULL OR REGEXP RLIKE SIMILAR SOME
+    SYMMETRIC THEN TO TRUE UNKNOWN WHEN XOR ZONE
+""".split())
+
+# only keywords when followed by a string, as in DATE '2020-01-01'
+LITERAL_PREFIXES = set("""
+    B DATE E N TIME TIMESTAMP X
+""".split())
+
+# only keywords after a quantity, as in INTERVAL 1 DAY
+UNITS = set("""
+    DAY DAYS HOUR HOURS MICROSECOND MINUTE MINUTES MONTH MONTHS QUARTER
+    SECOND SECONDS WEEK WEEKS YEAR YEARS
+""".split())
+
+# words that can continue a type name, as in ::double precision
+TYPE_WORDS = set("""
+    CHARACTER DOUBLE PRECISION TIME VARYING WITH WITHOUT ZONE
+""".split())
+
+# anything that could introduce a subquery or other construct we can't
+# follow
+OPAQUE = set("""
+    SELECT WITH VALUES
+""".split())
+
+_analyzed = {}
+
+
+def analyze(sql):
+    """Find the columns that a sql condition refers to.
+
+    Returns a pair of sets, (identifiers, quoted).  The first holds names
+    that must be columns for the condition to be valid.  The second holds
+    double-quoted names, which some databases (sqlite, mysql) will read as
+    strings if there is no such column.  Returns None if the condition
+    is too complicated to follow.
+    """
+    if sql in _analyzed:
+        return _analyzed[sql]
+    result = _analyze(sql)
+    _analyzed[sql] = result
+    return result
+
+
+def _analyze(sql):
+    if '$' in sql:
+        # dollar quoting, positional parameters
+        return None
+    tokens = [(m.lastgroup, m.group(m.lastgroup)) for m in TOKEN.finditer(sql)]
+    identifiers = set()
+    quoted = set()
+    skip_type = False
+    for idx, (kind, txt) in enumerate(tokens):
+        prev_kind = tokens[idx - 1][0] if idx > 0 else None
+        next_kind, next_txt = (tokens[idx + 1] if idx + 1 < len(tokens)
+                               else (None, None))
+        if kind in ['quoted', 'delimited']:
+            skip_type = False
+            if next_txt not in ['.', '(']:
+                name = txt[1:-1]
+                if kind == 'quoted':
+                    quoted.add(name.replace('""', '"'))
+                else:
+                    identifiers.add(name)
+            continue
+        if kind != 'word':
+            # after :: comes a type name, after a lone : a parameter name
+            skip_type = kind == 'cast' or (txt == ':' and next_kind == 'word')
+            continue
+        upper = txt.upper()
+        if skip_type:
+            # a type name after :: or CAST(... AS, or a parameter name
+            skip_type = next_kind == 'word' and next_txt.upper() in TYPE_WORDS
+            continue
+        if upper in OPAQUE:
+            return None
+        if upper in KEYWORDS:
+            skip_type = upper == 'AS'
+            continue
+        if upper in LITERAL_PREFIXES and next_kind == 'string':
+            continue
+        if upper in UNITS and prev_kind in ['number', 'string']:
+            continue
+        if next_txt == '(':
+            # a function call
+            continue
+        if next_txt == '.':
+            # a table or schema qualifier
+            continue
+        identifiers.add(txt)
+    return identifiers, quoted
+
+
+def refers_only_to(sql, column_names, dialect_name):
+    """Check whether a condition could be valid for a table with the given
+    columns.  Returns None if we can't tell."""
+    analysis = analyze(sql)
+    if analysis is None:
+        return None
+    identifiers, quoted = analysis
+    known = set(name.lower() for name in column_names)
+    if any(name.lower() not in known for name in identifiers):
+        # could be a column we lack, or sql we don't know (NOCASE in
+        # COLLATE NOCASE, YEAR in EXTRACT(YEAR FROM ...)), so can't tell
+        return None
+    if dialect_name not in ['sqlite', 'mysql']:
+        # double quotes are always identifiers
+        if any(name not in column_names for name in quoted):
+            return False
+    return True
@@ -1,4 +1,7 @@
 def dictify(h):
+    if hasattr(h, 'h'):
+        # haxe version change
+        return dict(h.h)
 
     def next2yield(h):
         while True:
@@ -9,10 +12,6 @@ def dictify(h):
 
     result = {}
     for key in next2yield(h.keys()):
-        if hasattr(h, 'h'):
-            # haxe version change
-            result[key] = h.h.get(key)
-        else:
-            result[key] = h.get(key)
+        result[key] = h.get(key)
 
     return result
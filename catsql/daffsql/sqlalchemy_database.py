@@ -7,11 +7,12 @@ from sqlalchemy.ext.declarative import declarative_base
 
 from catsql.database import Database
 from catsql.daffsql.sqlalchemy_helper import SqlAlchemyHelper
+from catsql.reflection import TableCatalog
 
 
 class SqlAlchemyDatabase(daff.SqlDatabase):
 
-    def __init__(self, url):
+    def __init__(self, url, cache=None, helper=None):
         if isinstance(url, Database):
             db = url
             self.database = db
@@ -19,16 +20,50 @@ class SqlAlchemyDatabase(daff.SqlDatabase):
             self.Base = db.Base
             self.engine = db.engine
             self.session = db._session
+            self.tables_metadata = db.tables_metadata
         else:
             self.database = None
             self.url = url
             self.Base = declarative_base()
             self.engine = create_engine(url)
-            self.Base.metadata.reflect(self.engine)
+            self.tables_metadata = TableCatalog(self.engine,
+                                                self.Base.metadata,
+                                                cache=cache)
             self.session = create_session(bind=self.engine)
-        self.helper = SqlAlchemyHelper()
+        self.helper = helper or SqlAlchemyHelper()
+        self._connection = None
+        self._transaction = None
+
+    def connection(self):
+        """The connection changes are made on.  Changes are made in a
+        transaction that lasts until commit() or rollback()."""
+        if self._connection is None:
+            self._connection = self.engine.connect()
+            self._transaction = self._connection.begin()
+        return self._connection
+
+    def flush(self):
+        self.helper.flush(self)
+
+    def commit(self):
+        self.flush()
+        if self._transaction is not None:
+            self._transaction.commit()
+            self._close()
+
+    def rollback(self):
+        self.helper.discard()
+        if self._transaction is not None:
+            self._transaction.rollback()
+            self._close()
+
+    def _close(self):
+        self._connection.close()
+        self._connection = None
+        self._transaction = None
 
     def finalize(self):
+        self.commit()
         if self.database:
             changes = (self.helper.updates +
                        self.helper.inserts +
@@ -37,11 +72,12 @@ class SqlAlchemyDatabase(daff.SqlDatabase):
 
     def getTable(self, name):
         self.getColumns(name)
-        result = self.Base.metadata.tables[name.toString()]
+        result = self.tables_metadata[name.toString()]
         return result
 
     @property
     def events(self):
+        self.flush()
         return {
             'updates': self.helper.updates,
             'inserts': self.helper.inserts,
@@ -59,7 +95,7 @@ class SqlAlchemyDatabase(daff.SqlDatabase):
 
     def getColumns(self, name):
         name = name.toString()
-        tab = self.Base.metadata.tables[name]
+        tab = self.tables_metadata[name]
         columns = []
         for name, col in tab.columns.items():
             column = daff.SqlColumn()
@@ -1,21 +1,47 @@
 from __future__ import print_function
 import daff
 import json
+from sqlalchemy import bindparam, func, select, tuple_
 import sys
 
 from catsql.daffsql.dictify import dictify
 
 EPSILON = 0.00001
 
+# most row changes sent to the database in a single executemany call
+BATCH_SIZE = 1000
+
 
 class SqlAlchemyHelper(daff.SqlHelper):
+    """Applies row changes from a daff patch.
+
+    Consecutive changes of the same shape (same action, same columns, and
+    the same kind of condition on each column) are held back and sent
+    together as one executemany of a cached statement, when they can be
+    seen up front to each hit one row by primary key.  Otherwise they are
+    made one by one, to report any that are skipped.  Order between
+    changes is preserved.  Call flush() once the patch is applied.
+
+    The first `resume_after` changes are passed over, for picking up a
+    patch where an earlier run left off.  If set, `listener` is called
+    with the database and the number of changes so far after each change.
+    """
 
-    def __init__(self):
+    def __init__(self, batch_size=BATCH_SIZE):
         self.updates = 0
         self.inserts = 0
         self.deletes = 0
         self.skips = 0
         self.cached_columns = {}
+        self.cached_tables = {}
+        self.statements = {}
+        self.batch_size = batch_size
+        self.pending = []
+        self.pending_shape = None
+        self.pending_db = None
+        self.operations = 0
+        self.resume_after = 0
+        self.listener = None
 
     def getColumns(self, db, name):
         if name in self.cached_columns:
@@ -30,7 +56,15 @@ class SqlAlchemyHelper(daff.SqlHelper):
             }
         return record
 
-    def where(self, q, key, value, tab, columns):
+    def getTable(self, db, name):
+        key = name.toString()
+        if key not in self.cached_tables:
+            self.cached_tables[key] = db.getTable(name)
+        return self.cached_tables[key]
+
+    def condition(self, key, value, columns):
+        """Decide how to match a column against a value.  Returns the kind
+        of match (null, float or equal) and the value to use."""
         is_float = columns[key]['float']
         if not is_float:
             if columns[key]['blank']:
@@ -41,62 +75,191 @@ class SqlAlchemyHelper(daff.SqlHelper):
                         is_float = True
                 except Exception:
                     pass
-        if is_float and value is not None:
+        if value is None:
+            return 'null', value
+        if is_float:
             # use epsilon
-            q = q.where(tab.c[key] > float(value) - EPSILON)
-            q = q.where(tab.c[key] < float(value) + EPSILON)
+            return 'float', float(value)
+        return 'equal', value
+
+    def where(self, q, key, value, tab, columns):
+        kind, value = self.condition(key, value, columns)
+        if kind == 'float':
+            q = q.where(tab.c[key] > value - EPSILON)
+            q = q.where(tab.c[key] < value + EPSILON)
         else:
             q = q.where(tab.c[key] == value)
         return q
 
     def update(self, db, name, conds, vals):
+        if not self._next_operation():
+            return
         conds = dictify(conds)
         vals = dictify(vals)
-        tab = db.getTable(name)
         columns = self.getColumns(db, name)
-
-        # should work doesn't work :(
-        # q = db.session.query(tab)
-        # q = q.filter_by(**conds)
-        # q = q.update(vals)
-
-        q = db.getTable(name).update()
-        for key, value in conds.items():
-            q = self.where(q, key, value, tab, columns)
-        q = q.values(vals)
-        result = db.session.connection().execute(q)
-        if result.rowcount == 0:
-            print(" * skipped update {}".format(json.dumps(conds)),
-                  file=sys.stderr)
-            self.skips += 1
-        else:
-            self.updates += result.rowcount
+        cond_shape, params = self._conditions(conds, columns)
+        val_keys = tuple(sorted(vals.keys()))
+        for idx, key in enumerate(val_keys):
+            params['catsql_v{}'.format(idx)] = vals[key]
+        self._add(db, ('update', name.toString(), cond_shape, val_keys),
+                  name, params, conds)
+        self._notify(db)
 
     def delete(self, db, name, conds):
+        if not self._next_operation():
+            return
         conds = dictify(conds)
-        tab = db.getTable(name)
         columns = self.getColumns(db, name)
-        q = db.getTable(name).delete()
-        for key, value in conds.items():
-            q = self.where(q, key, value, tab, columns)
-        result = db.session.connection().execute(q)
-        if result.rowcount == 0:
-            print(" * skipped delete {}".format(json.dumps(conds)),
-                  file=sys.stderr)
-            self.skips += 1
-        else:
-            self.deletes += result.rowcount
+        cond_shape, params = self._conditions(conds, columns)
+        self._add(db, ('delete', name.toString(), cond_shape),
+                  name, params, conds)
+        self._notify(db)
 
     def insert(self, db, name, vals):
+        if not self._next_operation():
+            return
         columns = self.getColumns(db, name)
         vals = dictify(vals)
-        keys = vals.keys()
+        keys = list(vals.keys())
         for key in keys:
             if vals[key] == '':
                 if columns[key]['primary']:
                     # don't try to set blank primary keys, assume they are autoincrement
                     vals.pop(key)
-        q = db.getTable(name).insert()
-        q = q.values(vals)
-        db.session.connection().execute(q)
-        self.inserts += 1
+        self._add(db, ('insert', name.toString(), tuple(sorted(vals.keys()))),
+                  name, vals, vals)
+        self._notify(db)
+
+    def flush(self, db=None):
+        """Send any held back changes to the database."""
+        if not self.pending:
+            return
+        db = db or self.pending_db
+        shape = self.pending_shape
+        pending = self.pending
+        self.pending = []
+        self.pending_shape = None
+        self._apply(db.connection(), shape, pending)
+
+    def _apply(self, conn, shape, pending):
+        action = shape[0]
+        statement = self.statements[shape]
+        if action == 'insert':
+            conn.execute(statement, [params for params, _ in pending])
+            self.inserts += len(pending)
+            return
+        if len(pending) > 1 and self._one_row_each(conn, shape, pending):
+            # every change hits exactly one row, so none are skipped
+            result = conn.execute(statement, [params for params, _ in pending])
+            self._count(action, result.rowcount)
+            return
+        # otherwise make the changes one by one, to find the ones skipped
+        for params, conds in pending:
+            result = conn.execute(statement, params)
+            if result.rowcount == 0:
+                self._skip(action, conds)
+            else:
+                self._count(action, result.rowcount)
+
+    def _one_row_each(self, conn, shape, pending):
+        """Check if each change matches exactly one row, picked out by its
+        primary key.  Then no change can affect which rows another matches,
+        so they can all be made at once."""
+        tab = self.statements[shape].table
+        primary_key = [column.name for column in tab.primary_key]
+        cond_shape = shape[2]
+        equal = [(idx, key) for idx, (key, kind) in enumerate(cond_shape)
+                 if kind == 'equal']
+        if (len(primary_key) == 0 or
+                not set(primary_key) <= set(key for _, key in equal)):
+            return False
+        if any(kind == 'float' for _, kind in cond_shape):
+            return False
+        if (shape[0] == 'update' and
+                any(key in shape[3] for key in primary_key)):
+            # keys change as we go
+            return False
+        values = [tuple(params['catsql_c{}'.format(idx)] for idx, _ in equal)
+                  for params, _ in pending]
+        keys = set(tuple(value for value, (_, key) in zip(row, equal)
+                         if key in primary_key)
+                   for row in values)
+        if len(keys) < len(pending):
+            return False
+        columns = [tab.c[key] for _, key in equal]
+        if len(columns) == 1:
+            match = columns[0].in_([row[0] for row in values])
+        else:
+            match = tuple_(*columns).in_(values)
+        q = select([func.count()]).select_from(tab).where(match)
+        for key, kind in cond_shape:
+            if kind == 'null':
+                q = q.where(tab.c[key].is_(None))
+        return conn.execute(q).scalar() == len(pending)
+
+    def discard(self):
+        """Forget any held back changes."""
+        self.pending = []
+        self.pending_shape = None
+
+    def _next_operation(self):
+        self.operations += 1
+        return self.operations > self.resume_after
+
+    def _notify(self, db):
+        if self.listener is not None:
+            self.listener(db, self.operations)
+
+    def _skip(self, action, conds):
+        print(" * skipped {} {}".format(action, json.dumps(conds)),
+              file=sys.stderr)
+        self.skips += 1
+
+    def _count(self, action, rowcount):
+        if action == 'update':
+            self.updates += rowcount
+        else:
+            self.deletes += rowcount
+
+    def _conditions(self, conds, columns):
+        shape = []
+        params = {}
+        for idx, key in enumerate(sorted(conds.keys())):
+            kind, value = self.condition(key, conds[key], columns)
+            shape.append((key, kind))
+            if kind == 'float':
+                params['catsql_lo{}'.format(idx)] = value - EPSILON
+                params['catsql_hi{}'.format(idx)] = value + EPSILON
+            elif kind == 'equal':
+                params['catsql_c{}'.format(idx)] = value
+        return tuple(shape), params
+
+    def _add(self, db, shape, name, params, conds):
+        if shape != self.pending_shape or len(self.pending) >= self.batch_size:
+            self.flush()
+        if shape not in self.statements:
+            self.statements[shape] = self._statement(self.getTable(db, name),
+                                                     shape)
+        self.pending_shape = shape
+        self.pending_db = db
+        self.pending.append((params, conds))
+
+    def _statement(self, tab, shape):
+        action = shape[0]
+        if action == 'insert':
+            # columns are taken from the parameters
+            return tab.insert()
+        q = tab.update() if action == 'update' else tab.delete()
+        for idx, (key, kind) in enumerate(shape[2]):
+            column = tab.c[key]
+            if kind == 'null':
+                q = q.where(column.is_(None))
+            elif kind == 'float':
+                q = q.where(column > bindparam('catsql_lo{}'.format(idx)))
+                q = q.where(column < bindparam('catsql_hi{}'.format(idx)))
+            else:
+                q = q.where(column == bindparam('catsql_c{}'.format(idx)))
+        if action == 'update':
+            q = q.values(dict((key, bindparam('catsql_v{}'.format(idx)))
+                              for idx, key in enumerate(shape[3])))
+        return q
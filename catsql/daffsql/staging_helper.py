@@ -0,0 +1,128 @@
+import itertools
+from sqlalchemy import (Column, Integer, MetaData, Table, and_, exists, func,
+                        select, types)
+
+from catsql.daffsql.sqlalchemy_helper import SqlAlchemyHelper
+
+# most row changes loaded into a staging table at a time
+STAGING_BATCH = 50000
+
+_staging_names = itertools.count()
+
+
+class StagingHelper(SqlAlchemyHelper):
+    """Applies row changes from a daff patch through a staging table.
+
+    Each run of changes of the same shape is bulk loaded into a temporary
+    table, then applied with a single set-based statement: a correlated
+    UPDATE (UPDATE ... FROM where the database has it), a DELETE ... WHERE
+    EXISTS, or an INSERT ... SELECT.  Changes that would match no rows are
+    found with one more query beforehand, and reported as skips just as
+    they are when changes are made one by one.
+    """
+
+    def __init__(self, batch_size=STAGING_BATCH):
+        SqlAlchemyHelper.__init__(self, batch_size)
+
+    def _apply(self, conn, shape, pending):
+        action = shape[0]
+        tab = self.statements[shape].table
+        if action == 'insert' and len(shape[2]) == 0:
+            # nothing to stage, every column takes its default
+            return SqlAlchemyHelper._apply(self, conn, shape, pending)
+        staged = self._stage(conn, tab, shape, pending)
+        seq = staged.c.catsql_seq
+        try:
+            if action == 'insert':
+                keys = list(shape[2])
+                rows = select([staged.c[key] for key in keys]).order_by(seq)
+                conn.execute(tab.insert().from_select(keys, rows))
+                self.inserts += len(pending)
+                return
+            match = self._match(tab, staged, shape[2])
+            missing = select([seq]).where(~exists().where(match)).order_by(seq)
+            for row in conn.execute(missing):
+                self._skip(action, pending[row[0]][1])
+            if action == 'delete':
+                q = tab.delete().where(exists().where(match))
+            elif conn.dialect.name in ['postgresql', 'mysql']:
+                # joined against only the last staged change for each
+                # condition, so that one wins, as it would if they were made
+                # one by one
+                latest = self._latest(staged)
+                q = tab.update().where(
+                    self._match(tab, latest, shape[2])).values(dict(
+                        (key, latest.c['catsql_v{}'.format(idx)])
+                        for idx, key in enumerate(shape[3])))
+            else:
+                # when several staged changes hit a row, the last one wins,
+                # as it would if they were made one by one
+                q = tab.update().where(exists().where(match)).values(dict(
+                    (key, select([staged.c['catsql_v{}'.format(idx)]]).
+                     where(match).order_by(seq.desc()).limit(1).as_scalar())
+                    for idx, key in enumerate(shape[3])))
+            self._count(action, conn.execute(q).rowcount)
+        finally:
+            staged.drop(conn)
+
+    def _stage(self, conn, tab, shape, pending):
+        columns = [Column('catsql_seq', Integer, primary_key=True,
+                          autoincrement=False)]
+        if shape[0] == 'insert':
+            columns += [Column(key, self._type(tab.c[key]))
+                        for key in shape[2]]
+        else:
+            for idx, (key, kind) in enumerate(shape[2]):
+                if kind == 'float':
+                    columns.append(Column('catsql_lo{}'.format(idx),
+                                          types.Float))
+                    columns.append(Column('catsql_hi{}'.format(idx),
+                                          types.Float))
+                elif kind == 'equal':
+                    columns.append(Column('catsql_c{}'.format(idx),
+                                          self._type(tab.c[key])))
+            if shape[0] == 'update':
+                columns += [Column('catsql_v{}'.format(idx),
+                                   self._type(tab.c[key]))
+                            for idx, key in enumerate(shape[3])]
+        staged = Table('catsql_staging_{}'.format(next(_staging_names)),
+                       MetaData(), *columns, prefixes=['TEMPORARY'])
+        staged.create(conn)
+        conn.execute(staged.insert(),
+                     [dict(params, catsql_seq=seq)
+                      for seq, (params, _) in enumerate(pending)])
+        return staged
+
+    def _latest(self, staged):
+        # staged changes with the highest catsql_seq for their condition
+        # values (the staged table is read once, as mysql requires)
+        parts = [column for column in staged.c
+                 if column.name.startswith(('catsql_c', 'catsql_lo',
+                                            'catsql_hi'))]
+        rank = func.row_number().over(partition_by=parts or None,
+                                      order_by=staged.c.catsql_seq.desc())
+        ranked = select([staged, rank.label('catsql_rank')]).alias(
+            'catsql_ranked')
+        columns = [column for column in ranked.c
+                   if column.name != 'catsql_rank']
+        return select(columns).where(ranked.c.catsql_rank == 1).alias(
+            'catsql_latest')
+
+    def _match(self, tab, staged, cond_shape):
+        parts = []
+        for idx, (key, kind) in enumerate(cond_shape):
+            column = tab.c[key]
+            if kind == 'null':
+                parts.append(column.is_(None))
+            elif kind == 'float':
+                parts.append(column > staged.c['catsql_lo{}'.format(idx)])
+                parts.append(column < staged.c['catsql_hi{}'.format(idx)])
+            else:
+                parts.append(column == staged.c['catsql_c{}'.format(idx)])
+        return and_(*parts)
+
+    def _type(self, column):
+        # untyped columns (common in sqlite) can't be declared as they are
+        if isinstance(column.type, types.NullType):
+            return types.String
+        return column.type
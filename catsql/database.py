@@ -1,12 +1,19 @@
+import atexit
+from catsql.budget import install_timeout
 from catsql.filter import Filter
+from catsql.profiler import phase
+from catsql.reflection import TableCatalog
+import itertools
 import os
 import re
 from shutil import copyfile
-from sqlalchemy import Column, create_engine, Float, Integer, MetaData, String, Table
+from sqlalchemy import (Column, create_engine, event, Float, Integer, MetaData,
+                        String, Table)
 from sqlalchemy.exc import ArgumentError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import create_session, mapper
 import sys
+import tempfile
 
 if sys.version_info[0] == 2:
     import unicodecsv as csv
@@ -14,18 +21,55 @@ else:
     import csv
 
 
+# rows at the start of a csv file used to guess column types
+CSV_SAMPLE = 1000
+
+# rows inserted per executemany call when loading a csv file
+CSV_BATCH = 10000
+
+# csv files larger than this many bytes are loaded into a temporary sqlite
+# file rather than into memory
+CSV_MEMORY_LIMIT = 256 * 1024 * 1024
+
+
+def _scratch_pragmas(dbapi_connection, connection_record):
+    # a loaded csv file is a scratch copy, no need to protect it
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=OFF')
+    cursor.execute('PRAGMA synchronous=OFF')
+    cursor.close()
+
+
+def _remove_quietly(fname):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
+
+
 class Database(object):
 
-    def __init__(self, url, verbose=False, tables=None, schema=None, can_create=False):
+    def __init__(self, url, verbose=False, tables=None, schema=None,
+                 can_create=False, cache=None, pool_size=None,
+                 csv_memory_limit=CSV_MEMORY_LIMIT, profiler=None,
+                 timeout=None, max_rows=None):
         self.url = url
         self._full_url = self.url
         self.verbose = verbose
         self.tables = tables
         self.schema = schema
         self.can_create = can_create
+        self.cache = cache
+        self.pool_size = pool_size
+        self.csv_memory_limit = csv_memory_limit
         self.csv = None
         self.table = None
-        self.connect_database()
+        self.condition_cache = {}
+        self.profiler = profiler
+        self.timeout = timeout
+        self.max_rows = max_rows
+        with phase(profiler, 'connect'):
+            self.connect_database()
 
     def finalize(self, changed):
         if not changed:
@@ -46,7 +90,7 @@ class Database(object):
             self.engine = self.wrap_csv(self.url)
         else:
             try:
-                self.engine = create_engine(self.url, echo=self.verbose)
+                self.engine = self._create_engine(self.url)
             except ImportError as e:
                 print("Support library for this database not installed - {}".format(e))
                 exit(1)
@@ -55,21 +99,35 @@ class Database(object):
                     try:
                         # maybe this is a local sqlite database?
                         sqlite_url = 'sqlite:///{}'.format(self.url)
-                        self.engine = create_engine(sqlite_url, echo=self.verbose)
+                        self.engine = self._create_engine(sqlite_url)
                         self._full_url = sqlite_url
                     except ArgumentError:
                         # no joy, recreate the original problem and die.
-                        self.engine = create_engine(self.url, echo=self.verbose)
+                        self.engine = self._create_engine(self.url)
                 else:
                     raise
+        if self.timeout:
+            install_timeout(self.engine, self.timeout)
         only = None
         if self.tables:
             only = list(self.tables)
-        self.Base.metadata.reflect(self.engine, only=only)
+        self._catalog = TableCatalog(self.engine, self.Base.metadata,
+                                     schema=self.schema, only=only,
+                                     cache=None if self.csv else self.cache)
         self._session = create_session(bind=self.engine)
 
+    def _create_engine(self, url):
+        if self.pool_size:
+            try:
+                return create_engine(url, echo=self.verbose,
+                                     pool_size=self.pool_size,
+                                     max_overflow=self.pool_size)
+            except TypeError:
+                # this dialect's pool has no size (e.g. sqlite files)
+                pass
+        return create_engine(url, echo=self.verbose)
+
     def wrap_csv(self, url):
-        engine = create_engine('sqlite://')
         self.csv = url
         table_name = url
         table_name = re.sub(r'.*[/\\]', '', table_name)
@@ -77,24 +135,61 @@ class Database(object):
         table_name = table_name.lower()
         table_name = re.sub(r'[^a-z]', '', table_name)
         table_name = table_name or '_table_'
-        data = self.read_csv(url)
-
-        metadata = MetaData(bind=engine)
-        cols = [
-            Column(name,
-                   data.column_types[idx],
-                   primary_key=(name == 'id'))
-            for idx, name in enumerate(data.column_names)
-        ]
-        has_primary_key = any((name == 'id') for name in data.column_names)
-        if not has_primary_key:
-            cols = [Column('id', Integer(), primary_key=True)] + cols
-        table = Table(table_name, metadata, *cols)
-        table.create()
-        for idx, row in enumerate(data.rows):
+        limit = self.csv_memory_limit
+        if limit is not None and os.path.getsize(url) > limit:
+            fd, fname = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+            atexit.register(_remove_quietly, fname)
+            engine = create_engine('sqlite:///{}'.format(fname))
+        else:
+            engine = create_engine('sqlite://')
+        event.listen(engine, 'connect', _scratch_pragmas)
+
+        with open(url) as f:
+            # blank lines are not rows
+            reader = (row for row in csv.reader(f, delimiter=',') if row)
+            column_names = next(reader, [])
+            sample = list(itertools.islice(reader, CSV_SAMPLE))
+            column_types = [self.tweak_type(sample, idx)
+                            for idx, _ in enumerate(column_names)]
+
+            metadata = MetaData(bind=engine)
+            cols = [
+                Column(name,
+                       column_types[idx][0],
+                       primary_key=(name == 'id'))
+                for idx, name in enumerate(column_names)
+            ]
+            has_primary_key = any((name == 'id') for name in column_names)
             if not has_primary_key:
-                row['id'] = idx + 1
-            table.insert().values(**row).execute()
+                cols = [Column('id', Integer(), primary_key=True)] + cols
+            table = Table(table_name, metadata, *cols)
+
+            converters = [converter for _, converter in column_types]
+            width = len(column_names)
+
+            def prepare(idx, row):
+                row = (row + [None] * width)[:width]
+                row = [cell if converter is None else converter(cell)
+                       for cell, converter in zip(row, converters)]
+                if not has_primary_key:
+                    row = [idx + 1] + row
+                return row
+
+            rows = (prepare(idx, row)
+                    for idx, row in enumerate(itertools.chain(sample, reader)))
+            # values are already converted, so skip sqlalchemy's per-value
+            # processing and hand batches straight to the driver
+            sql = str(table.insert().compile(dialect=engine.dialect))
+            with engine.begin() as conn:
+                table.create(conn)
+                cursor = conn.connection.cursor()
+                while True:
+                    batch = list(itertools.islice(rows, CSV_BATCH))
+                    if not batch:
+                        break
+                    cursor.executemany(sql, batch)
+                cursor.close()
 
         class CsvTable(object):
             pass
@@ -102,24 +197,14 @@ class Database(object):
         self.table = table
         return engine
 
-    def read_csv(self, fname):
-        class Data(object):
-            pass
-        data = Data()
-        with open(fname) as f:
-            cf = csv.DictReader(f, delimiter=',')
-            data.rows = list(cf)
-            data.column_names = cf.fieldnames
-        data.column_types = [self.tweak_type(data, idx) for idx, _ in enumerate(data.column_names)]
-        return data
-
-    def tweak_type(self, data, idx):
-        name = data.column_names[idx]
+    def tweak_type(self, rows, idx):
+        """Guess the type of a csv column from a sample of rows.  Returns
+        the type, and a function to convert cells to it (or None)."""
         strings = 0
         ints = 0
         floats = 0
-        for row in data.rows:
-            v = row[name]
+        for row in rows:
+            v = row[idx] if idx < len(row) else None
             try:
                 f = float(v)
                 if abs(round(f) - f) > 0.001:
@@ -131,18 +216,18 @@ class Database(object):
             if strings > 50:
                 break
         if strings > max([floats, ints]):
-            return String()
-        for row in data.rows:
-            v = row[name]
+            return String(), None
+        as_int = ints > floats
+
+        def convert(v):
             try:
                 f = float(v)
-                if ints > floats and abs(round(f) - f) < 0.001:
-                    row[name] = int(f)
-                else:
-                    row[name] = f
             except Exception:
-                pass
-        return Integer() if ints > floats else Float()
+                return v
+            if as_int and abs(round(f) - f) < 0.001:
+                return int(f)
+            return f
+        return (Integer() if as_int else Float()), convert
 
     def save_csv(self, fname):
         if os.path.exists(fname):
@@ -163,7 +248,7 @@ class Database(object):
 
     @property
     def tables_metadata(self):
-        return self.Base.metadata.tables
+        return self._catalog
 
     def query(self, columns=None):
         return Filter(self, columns=columns)
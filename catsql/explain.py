@@ -0,0 +1,105 @@
+from __future__ import unicode_literals
+import copy
+import json
+from sqlalchemy import bindparam, text
+
+# how each database is asked for a plan without running the query
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN',
+    'postgresql': 'EXPLAIN (FORMAT JSON)',
+}
+
+
+def explain_statement(dialect, statement, prefix='EXPLAIN'):
+    """EXPLAIN of a statement as plain text, keeping its bound parameters
+    but not the types of its result columns, which the plan doesn't have."""
+    # compiled with named parameters, as text() wants them
+    dialect = copy.copy(dialect)
+    dialect.paramstyle = 'named'
+    dialect.positional = False
+    compiled = statement.compile(dialect=dialect)
+    params = compiled.params
+    return text('{} {}'.format(prefix, compiled.string)).bindparams(
+        *[bindparam(name, params[name], type_=compiled.binds[name].type)
+          for name in params])
+
+
+def explain(session, statement):
+    """Plan for a statement, as a dict with the plan as lines of text
+    ('plan'), estimated rows and cost where the database gives them ('rows',
+    'cost'), and the tables it would read in full ('scans')."""
+    dialect = session.get_bind().dialect
+    prefix = EXPLAIN_PREFIXES.get(dialect.name, 'EXPLAIN')
+    result = session.execute(explain_statement(dialect, statement, prefix))
+    rows = result.fetchall()
+    keys = result.keys()
+    if dialect.name == 'sqlite':
+        return sqlite_plan(rows)
+    if dialect.name == 'postgresql':
+        return postgres_plan(rows)
+    if dialect.name == 'mysql':
+        return mysql_plan([dict(zip(keys, row)) for row in rows])
+    return {
+        'plan': [' '.join('{}'.format(cell) for cell in row) for row in rows],
+        'rows': None,
+        'cost': None,
+        'scans': []
+    }
+
+
+def sqlite_plan(rows):
+    # rows are (id, parent, notused, detail), with nesting given by parent
+    depth = {0: -1}
+    plan = []
+    scans = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        plan.append('  ' * depth[node] + detail)
+        if detail.startswith('SCAN ') and 'USING' not in detail:
+            # "SCAN TABLE x" before sqlite 3.36, "SCAN x" since
+            words = detail.split()[1:]
+            if words[0] == 'TABLE' and len(words) > 1:
+                words = words[1:]
+            scans.append(words[0])
+    return {'plan': plan, 'rows': None, 'cost': None, 'scans': scans}
+
+
+def postgres_plan(rows):
+    data = rows[0][0]
+    if not isinstance(data, list):
+        data = json.loads(data)
+    top = data[0]['Plan']
+    plan = []
+    scans = []
+
+    def visit(node, depth):
+        line = node['Node Type']
+        if 'Relation Name' in node:
+            line += ' on {}'.format(node['Relation Name'])
+        plan.append('{}{} (cost={}..{} rows={})'.format(
+            '  ' * depth, line, node.get('Startup Cost'),
+            node.get('Total Cost'), node.get('Plan Rows')))
+        if node['Node Type'] == 'Seq Scan':
+            scans.append(node['Relation Name'])
+        for child in node.get('Plans', []):
+            visit(child, depth + 1)
+
+    visit(top, 0)
+    return {'plan': plan, 'rows': top.get('Plan Rows'),
+            'cost': top.get('Total Cost'), 'scans': scans}
+
+
+def mysql_plan(rows):
+    plan = []
+    scans = []
+    estimate = None
+    for row in rows:
+        plan.append('{} {} type={} key={} rows={}'.format(
+            row.get('select_type'), row.get('table'), row.get('type'),
+            row.get('key'), row.get('rows')))
+        if row.get('type') == 'ALL':
+            scans.append(row.get('table'))
+        if row.get('rows') is not None:
+            # rows examined multiply across a join
+            estimate = (estimate or 1) * int(row['rows'])
+    return {'plan': plan, 'rows': estimate, 'cost': None, 'scans': scans}
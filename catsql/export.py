@@ -0,0 +1,456 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from collections import OrderedDict
+from datetime import datetime
+import decimal
+import itertools
+import json
+import operator
+import sys
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+from sqlalchemy import Column, ForeignKey, MetaData, Table, text, types
+from sqlalchemy.exc import CompileError, DBAPIError
+from sqlalchemy.orm import Query
+
+# rows per executemany call, and per commit, when saving to sqlite
+SQLITE_BATCH = 10000
+SQLITE_COMMIT = 500000
+
+EXPORT_SCHEMA = 'catsql_export'
+
+# rows per sheet allowed by excel, including the header
+EXCEL_MAX_ROWS = 1048576
+
+# rows per record batch (and parquet row group) when saving arrow/parquet
+ARROW_BATCH = 65536
+
+# rows looked at to pick column widths, and the widest allowed
+EXCEL_SAMPLE = 100
+EXCEL_MAX_WIDTH = 60
+
+
+def row_projector(idxs):
+    """A function picking the cells at the given indexes out of a row, as
+    a tuple."""
+    if len(idxs) == 0:
+        return lambda row: ()
+    if len(idxs) == 1:
+        idx = idxs[0]
+        return lambda row: (row[idx],)
+    return operator.itemgetter(*idxs)
+
+
+class CatEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, decimal.Decimal):
+            return float(obj)
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        return json.JSONEncoder.default(self, obj)
+
+
+def _to_float(value):
+    return None if value is None else float(value)
+
+
+def _to_isoformat(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def json_converter(sql_type):
+    """A function to make values of a column's type fit for json, or None
+    if they already are (or the type isn't known)."""
+    if isinstance(sql_type, types.Numeric) and sql_type.asdecimal:
+        return _to_float
+    if isinstance(sql_type, (types.DateTime, types.Date, types.Time)):
+        return _to_isoformat
+    return None
+
+
+def fallback_type(example):
+    if isinstance(example, bool):
+        return types.Boolean
+    elif isinstance(example, int):
+        return types.Integer
+    elif isinstance(example, float):
+        return types.Float
+    elif isinstance(example, datetime):
+        return types.DateTime
+    return types.UnicodeText
+
+
+def sqlited(data):
+    if isinstance(data, dict) or isinstance(data, list):
+        return json.dumps(data)
+    return data
+
+
+def sqlite_file(engine):
+    return (engine.dialect.name == 'sqlite' and
+            engine.url.database not in [None, '', ':memory:'])
+
+
+class SqliteExport(object):
+    """Saves tables of results into a sqlite database.
+
+    Rows are bound as tuples straight through the driver, in large
+    transactions with journaling off.  When the rows come from a query on
+    another sqlite database, the target is attached to it and filled with a
+    single INSERT ... SELECT, so no data passes through Python at all.
+    """
+
+    def __init__(self, target_db, source_db=None):
+        self.target_db = target_db
+        self.source_db = source_db
+
+    def save(self, table_name, table, columns, rows):
+        """Save rows into a fresh table.  `columns` lists the (index, name)
+        pairs of the row cells to keep."""
+        if table_name in self.target_db.tables_metadata.keys():
+            # clear previous results
+            self.target_db.tables_metadata[table_name].drop(
+                self.target_db.engine)
+        if self._attached_copy(table_name, table, columns, rows):
+            return
+        rows = iter(rows)
+        first = next(rows, None)
+        target = self._create(table_name, table, columns, first)
+        if first is not None:
+            self._insert(target, columns, itertools.chain([first], rows))
+
+    def _create(self, table_name, table, columns, example):
+        engine = self.target_db.engine
+        target_columns = []
+        for idx, name in columns:
+            column = table.c[name]
+            sql_type = column.type
+            try:
+                engine.dialect.type_compiler.process(sql_type)
+            except CompileError:
+                # some types need to be approximated
+                sql_type = None
+            if sql_type is None or isinstance(sql_type, types.NullType):
+                value = example[idx] if example is not None else None
+                sql_type = fallback_type(sqlited(value))
+            sql_type.collation = None  # ignore collation
+            fks = [ForeignKey(fk.column) for fk in column.foreign_keys]
+            target_columns.append(Column(name, sql_type,
+                                         *fks,
+                                         primary_key=column.primary_key))
+        metadata = MetaData(bind=engine)
+        target = Table(table_name, metadata, *target_columns)
+        target.create(engine)
+        return target
+
+    def _insert(self, target, columns, rows):
+        engine = self.target_db.engine
+        dialect = engine.dialect
+        converters = []
+        for column in target.columns:
+            processor = column.type.bind_processor(dialect)
+            converters.append(processor)
+        project = row_projector([idx for idx, _ in columns])
+        sql = str(target.insert().compile(dialect=dialect))
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            if dialect.name == 'sqlite':
+                # a half-written export is no use anyway
+                cursor.execute('PRAGMA journal_mode=OFF')
+                cursor.execute('PRAGMA synchronous=OFF')
+            pending = 0
+            while True:
+                batch = []
+                for row in itertools.islice(rows, SQLITE_BATCH):
+                    batch.append(tuple([sqlited(value) if convert is None
+                                        else convert(sqlited(value))
+                                        for value, convert
+                                        in zip(project(row), converters)]))
+                if not batch:
+                    break
+                cursor.executemany(sql, batch)
+                pending += len(batch)
+                if pending >= SQLITE_COMMIT:
+                    conn.commit()
+                    pending = 0
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+
+    def _attached_copy(self, table_name, table, columns, rows):
+        if self.source_db is None or not isinstance(rows, Query):
+            return False
+        source = self.source_db.engine
+        if (source.dialect.name != 'sqlite' or
+                not sqlite_file(self.target_db.engine)):
+            return False
+        if any(isinstance(table.c[name].type, types.NullType)
+               for _, name in columns):
+            # types would need guessing from the data
+            return False
+        selected = rows.with_entities(
+            *[table.c[name] for _, name in columns]).statement
+        target = self._create(table_name, table, columns, None)
+        copy = Table(table_name, MetaData(),
+                     *[Column(c.name, c.type) for c in target.columns],
+                     schema=EXPORT_SCHEMA)
+        try:
+            with source.connect() as conn:
+                conn.execute(text("ATTACH DATABASE :fname AS {}".format(
+                    EXPORT_SCHEMA)), fname=self.target_db.engine.url.database)
+                try:
+                    conn.execute(copy.insert().from_select(
+                        [c.name for c in copy.columns], selected))
+                finally:
+                    conn.execute(text("DETACH DATABASE {}".format(
+                        EXPORT_SCHEMA)))
+        except DBAPIError:
+            # e.g. locked, or some construct sqlite can't run inside an
+            # INSERT; do it the slow way instead
+            target.drop(self.target_db.engine)
+            return False
+        return True
+
+
+class JsonExport(object):
+    """Saves a table of results as json, a row at a time.
+
+    By default the output is a single object with `meta`, `results` and,
+    once all rows are written, `count`.  With `lines`, it is one object
+    per row and nothing else.  Values are converted by column type up
+    front, so the encoder rarely needs to fall back on CatEncoder (unless
+    `typed` is off, for rows that aren't values of the columns).
+    """
+
+    def __init__(self, output, lines=False, typed=True):
+        self.output = output
+        self.lines = lines
+        self.typed = typed
+
+    def save(self, table, columns, rows):
+        """`columns` lists the (index, name) pairs of the row cells to keep."""
+        names = [name for _, name in columns]
+        project = row_projector([idx for idx, _ in columns])
+        converters = []
+        for name in names:
+            try:
+                converters.append(json_converter(table.c[name].type)
+                                  if self.typed else None)
+            except (AttributeError, KeyError):
+                converters.append(None)
+        if not any(converters):
+            converters = None
+        encode = CatEncoder().encode
+        if self.lines:
+            start, separator, end = '', '\n', '\n'
+        else:
+            meta = OrderedDict([('generator', 'catsql'), ('name', table.name)])
+            self.output.write('{{\n  "meta": {},\n  "results": ['.format(
+                encode(meta)))
+            start, separator, end = '\n    ', ',\n    ', '\n  '
+        count = 0
+        for row in rows:
+            values = project(row)
+            if converters:
+                values = [value if convert is None else convert(value)
+                          for value, convert in zip(values, converters)]
+            self.output.write(separator if count else start)
+            self.output.write(encode(OrderedDict(zip(names, values))))
+            count += 1
+        if count:
+            self.output.write(end)
+        if not self.lines:
+            self.output.write('],\n  "count": {}\n}}\n'.format(count))
+
+
+class ExcelExport(object):
+    """Saves tables of results as sheets of an excel workbook.
+
+    The workbook is write-only, so rows go out to disk as they are added
+    rather than accumulating in memory.  Tables longer than excel allows
+    are either cut short, or with `split` continued on further sheets.
+    """
+
+    def __init__(self, filename, split=False):
+        self.filename = filename
+        self.split = split
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheets = 0
+
+    def add(self, table_name, columns, rows):
+        """Add a sheet for a table.  `columns` lists the (index, name) pairs
+        of the row cells to keep."""
+        project = row_projector([idx for idx, _ in columns])
+        names = [name for _, name in columns]
+        rows = iter(rows)
+        sample = list(itertools.islice(rows, EXCEL_SAMPLE))
+        widths = [len('{}'.format(name)) for name in names]
+        for row in sample:
+            for c, value in enumerate(project(row)):
+                if value is not None:
+                    widths[c] = max(widths[c], len('{}'.format(value)))
+        part = 1
+        ws = self._sheet(table_name, names, widths)
+        written = 1
+        for row in itertools.chain(sample, rows):
+            if written >= EXCEL_MAX_ROWS:
+                if not self.split:
+                    print("WARNING: {} has more rows than fit in a sheet, "
+                          "use --excel-split to keep them all".format(
+                              table_name), file=sys.stderr)
+                    break
+                part += 1
+                ws = self._sheet('{}_{}'.format(table_name[:26], part),
+                                 names, widths)
+                written = 1
+            ws.append(project(row))
+            written += 1
+
+    def _sheet(self, title, names, widths):
+        ws = self.workbook.create_sheet(title=title)
+        # widths have to be set before any rows are written
+        for c, width in enumerate(widths):
+            ws.column_dimensions[get_column_letter(c + 1)].width = min(
+                width + 2, EXCEL_MAX_WIDTH)
+        header = []
+        for name in names:
+            cell = WriteOnlyCell(ws, value=name)
+            cell.font = Font(bold=True)
+            header.append(cell)
+        ws.append(header)
+        self.sheets += 1
+        return ws
+
+    def save(self):
+        if self.sheets == 0:
+            # a workbook needs at least one sheet
+            self.workbook.create_sheet()
+        self.workbook.save(self.filename)
+
+
+class ArrowExport(object):
+    """Saves a table of results as a parquet file, or an arrow (feather)
+    file, a batch of rows at a time.
+
+    The arrow schema comes from the column types of the table.  Columns
+    whose type doesn't say (e.g. untyped sqlite columns) take the type of
+    the values in the first batch.  With `typed` off, every column is a
+    string column.  Needs pyarrow.
+    """
+
+    def __init__(self, filename, parquet=True, batch_size=ARROW_BATCH,
+                 typed=True):
+        import pyarrow
+        self.pa = pyarrow
+        if parquet:
+            import pyarrow.parquet
+        self.filename = filename
+        self.parquet = parquet
+        self.batch_size = batch_size
+        self.typed = typed
+
+    def arrow_type(self, sql_type):
+        pa = self.pa
+        if isinstance(sql_type, types.Boolean):
+            return pa.bool_()
+        if isinstance(sql_type, types.SmallInteger):
+            return pa.int16()
+        if isinstance(sql_type, types.Integer):
+            return pa.int64()
+        if isinstance(sql_type, types.Float):
+            return pa.float64()
+        if isinstance(sql_type, types.Numeric):
+            if (sql_type.precision and sql_type.precision <= 38 and
+                    sql_type.asdecimal):
+                return pa.decimal128(sql_type.precision, sql_type.scale or 0)
+            return pa.float64()
+        if isinstance(sql_type, types.DateTime):
+            return pa.timestamp('us', tz='UTC' if sql_type.timezone else None)
+        if isinstance(sql_type, types.Date):
+            return pa.date32()
+        if isinstance(sql_type, types.Time):
+            return pa.time64('us')
+        if isinstance(sql_type, types.Interval):
+            return pa.duration('us')
+        if isinstance(sql_type, types._Binary):
+            return pa.binary()
+        if isinstance(sql_type, (types.String, types.Enum)):
+            return pa.string()
+        return None
+
+    def save(self, table, columns, rows):
+        """`columns` lists the (index, name) pairs of the row cells to keep."""
+        pa = self.pa
+        names = [name for _, name in columns]
+        project = row_projector([idx for idx, _ in columns])
+        arrow_types = []
+        for name in names:
+            if not self.typed:
+                arrow_types.append(pa.string())
+                continue
+            try:
+                arrow_types.append(self.arrow_type(table.c[name].type))
+            except (AttributeError, KeyError):
+                arrow_types.append(None)
+        rows = iter(rows)
+        writer = None
+        try:
+            while True:
+                batch = list(itertools.islice(rows, self.batch_size))
+                if writer is not None and not batch:
+                    break
+                cells = ([[sqlited(value) for value in values]
+                          for values in zip(*map(project, batch))] or
+                         [[] for _ in names])
+                if writer is None:
+                    for c, values in enumerate(cells):
+                        if arrow_types[c] is None:
+                            arrow_types[c] = self._guess_type(values)
+                    schema = pa.schema([pa.field(name, arrow_type)
+                                        for name, arrow_type
+                                        in zip(names, arrow_types)])
+                    if self.parquet:
+                        writer = pa.parquet.ParquetWriter(self.filename,
+                                                          schema)
+                    else:
+                        writer = pa.ipc.new_file(self.filename, schema)
+                arrays = [self._array(values, arrow_type)
+                          for values, arrow_type in zip(cells, arrow_types)]
+                record_batch = pa.RecordBatch.from_arrays(arrays,
+                                                          schema=schema)
+                if self.parquet:
+                    writer.write_table(pa.Table.from_batches([record_batch]),
+                                       row_group_size=self.batch_size)
+                else:
+                    writer.write_batch(record_batch)
+                if not batch:
+                    break
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def _guess_type(self, values):
+        try:
+            arrow_type = self.pa.array(values).type
+        except (self.pa.ArrowException, TypeError, ValueError):
+            return self.pa.string()
+        if arrow_type == self.pa.null():
+            return self.pa.string()
+        return arrow_type
+
+    def _array(self, values, arrow_type):
+        pa = self.pa
+        try:
+            return pa.array(values, type=arrow_type)
+        except (pa.ArrowException, TypeError, ValueError):
+            if arrow_type == pa.float64():
+                values = [None if value is None else float(value)
+                          for value in values]
+            elif arrow_type == pa.string():
+                values = [None if value is None else '{}'.format(value)
+                          for value in values]
+            return pa.array(values, type=arrow_type)
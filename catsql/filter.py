@@ -1,8 +1,48 @@
-from __future__ import unicode_literals
+from __future__ import print_function, unicode_literals
+import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import json
-from sqlalchemy import asc, desc, text, types
-from sqlalchemy.exc import OperationalError, InvalidRequestError
-from sqlalchemy.sql import expression, functions
+import random
+from six.moves import queue
+import sys
+import threading
+from sqlalchemy import (Table, UniqueConstraint, asc, desc, literal_column,
+                        or_, select, tablesample, text, tuple_, types,
+                        union_all)
+from sqlalchemy.exc import (DBAPIError, OperationalError, InvalidRequestError,
+                            ProgrammingError)
+from sqlalchemy.orm import create_session
+from sqlalchemy.sql import functions
+
+from catsql.budget import timed_out, timed_rows
+from catsql.conditions import refers_only_to
+from catsql.explain import explain
+from catsql.grep import grep_condition
+from catsql.profiler import phase
+from catsql.reflection import BULK_CHUNK
+from catsql.stats import estimated_counts
+
+# how many tables to count per query
+COUNT_BATCH = 50
+
+# when fetching tables in parallel, rows are handed over in batches of
+# this size, with at most FETCH_QUEUE batches waiting for each table
+FETCH_BATCH = 1000
+FETCH_QUEUE = 4
+
+# most primary keys to look up from a search index, beyond which the
+# table is just searched directly
+INDEX_KEYS = 1000
+
+# when sampling a number of rows, how many times more rows to aim for, to
+# make up for gaps in keys and rows ruled out by other filters
+SAMPLE_OVERSAMPLE = 4
+
+# most random keys to look up when sampling, beyond which rows are picked
+# with a random condition instead
+SAMPLE_KEYS = 10000
 
 
 def recursive_find(data, key):
@@ -19,14 +59,149 @@ def recursive_find(data, key):
     return result
 
 
+def keys_condition(table, keys):
+    primary_key = list(table.primary_key)
+    if len(primary_key) == 1:
+        return primary_key[0].in_([key[0] for key in keys])
+    return tuple_(*primary_key).in_(keys)
+
+
+def unique_key(table):
+    """Columns that pick out a single row: the primary key, or else a
+    unique constraint or index on columns that can't be null.  None if the
+    table has neither."""
+    if len(table.primary_key) > 0:
+        return list(table.primary_key)
+    candidates = [list(constraint.columns) for constraint in table.constraints
+                  if isinstance(constraint, UniqueConstraint)]
+    candidates += [list(index.columns) for index in table.indexes
+                   if index.unique]
+    for columns in candidates:
+        if len(columns) > 0 and not any(column.nullable for column in columns):
+            return columns
+    return None
+
+
+def encode_page_token(state):
+    # key values that aren't plain json (dates, decimals) go as strings,
+    # which databases compare correctly against their columns
+    text = json.dumps(state, sort_keys=True, default=str)
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(token):
+    try:
+        text = base64.urlsafe_b64decode(token.encode('ascii'))
+        return json.loads(text.decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError('not a page token: {}'.format(token))
+
+
+def _postgres_sample(preparer, table, method, pct):
+    sampled = tablesample(table, getattr(functions.func, method)(pct),
+                          name='catsql_sample')
+    keys = list(table.primary_key)
+    if len(keys) == 0:
+        ctid = literal_column('{}.ctid'.format(preparer.format_table(table)))
+        return ctid.in_(select([literal_column('catsql_sample.ctid')]).
+                        select_from(sampled))
+    if len(keys) == 1:
+        return keys[0].in_(select([sampled.c[keys[0].key]]))
+    return tuple_(*keys).in_(select([sampled.c[key.key] for key in keys]))
+
+
+def _random_order(dialect):
+    if dialect == 'mysql':
+        return functions.func.rand()
+    return functions.func.random()
+
+
+def _random_below(dialect, fraction):
+    # true for about the given fraction of rows
+    if dialect == 'sqlite':
+        return (functions.func.abs(functions.func.random()) % 1000000 <
+                int(fraction * 1000000))
+    return _random_order(dialect) < fraction
+
+
+def _session_rows(session, query):
+    rows = query['rows']
+    if hasattr(rows, 'with_session'):
+        rows = rows.with_session(session)
+    return rows
+
+
+def _fetch_rows(session, query):
+    # for a query, this is where it is executed
+    return iter(_session_rows(session, query))
+
+
+def _hand_over(channel, stopped, item):
+    # put an item on a queue, unless the reader gives up first
+    while not stopped():
+        try:
+            channel.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _drain(table_name, channel, stop):
+    while True:
+        try:
+            batch = channel.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                raise RuntimeError('rows of {} must be read before fetching '
+                                   'the next table'.format(table_name))
+            continue
+        if isinstance(batch, Exception):
+            raise batch
+        if not batch:
+            return
+        for row in batch:
+            yield row
+
+
+def _count_batch(session, queries):
+    # count several tables in a single UNION ALL statement
+    selects = []
+    for idx, query in enumerate(queries):
+        rows = query['rows'].order_by(None).subquery()
+        selects.append(select([literal_column(str(idx)).label('idx'),
+                               functions.count().label('ct')]).
+                       select_from(rows))
+    statement = selects[0] if len(selects) == 1 else union_all(*selects)
+    counts = dict((idx, ct) for idx, ct in session.execute(statement))
+    return [counts[idx] for idx in range(len(queries))]
+
+
 class Filter(object):
     def __init__(self, database, columns=None):
         self.database = database
-        self.queries = None
+        self._queries = None
+        self._table_keys = None
+        self._restricted = False
+        self._page_size = None
+        self._page_state = {}
+        # tables that went over the timeout or max_rows budget
+        self.cut_short = []
         self.selected_columns = columns
         self._query()
 
+    @property
+    def queries(self):
+        if self._queries is None:
+            self._queries = self._build_queries()
+        return self._queries
+
+    @queries.setter
+    def queries(self, queries):
+        self._queries = queries
+
     def distinct(self, distinct=True):
+        self._restricted = True
         for query in self.queries:
             query['rows'] = query['rows'].distinct()
         return self
@@ -39,19 +214,35 @@ class Filter(object):
 
         active_queries = []
         for query in self.queries:
+            if not all(self._condition_ok(query, sql) for sql in sqls):
+                continue
             for sql in sqls:
                 query['rows'] = query['rows'].filter(text(sql))
-            try:
-                query['rows'].limit(1).all()  # inefficient
-                active_queries.append(query)
-            except OperationalError:
-                # should cache these and show if no results at all found
-                continue
+            active_queries.append(query)
         self.queries = active_queries
         return self
 
+    def _condition_ok(self, query, sql):
+        # does a raw sql condition make sense for this table?  Decided from
+        # the columns it mentions where possible, otherwise by preparing a
+        # query that returns no rows.  Remembered for the database.
+        key = (query['table_name'], sql)
+        cache = self.database.condition_cache
+        if key not in cache:
+            ok = refers_only_to(sql, query['table'].columns.keys(),
+                                self.database.engine.dialect.name)
+            if ok is None:
+                try:
+                    query['rows'].filter(text(sql)).limit(0).all()
+                    ok = True
+                except (OperationalError, ProgrammingError):
+                    ok = False
+            cache[key] = ok
+        return cache[key]
+
     def where_kv(self, conditions):
         # conditions is a dict
+        self._prune(conditions.keys())
         active_queries = []
         for query in self.queries:
             try:
@@ -73,25 +264,67 @@ class Filter(object):
         ]
         return self
 
-    def grep(self, pattern, case_sensitive=False):
+    def grep(self, pattern, case_sensitive=False, mode='contains', index=None):
+        active_queries = []
         for query in self.queries:
-            query['rows'] = self._add_grep(query['table'], query['rows'], pattern,
-                                           case_sensitive=case_sensitive)
+            table = query['table']
+            columns = [column for column in table.columns
+                       if self.ok_column(column.name)]
+            condition = grep_condition(self.database, table, columns, pattern,
+                                       mode=mode,
+                                       case_sensitive=case_sensitive)
+            if condition is None:
+                # no column that could hold the pattern
+                continue
+            if index is not None and mode in ['contains', 'exact', 'prefix']:
+                keys = self._indexed_keys(index, query, pattern)
+                if keys is not None:
+                    if len(keys) == 0:
+                        continue
+                    if len(keys) <= INDEX_KEYS:
+                        query['rows'] = query['rows'].filter(
+                            keys_condition(table, keys))
+            # the index may be stale, so the condition is still needed
+            query['rows'] = query['rows'].filter(condition)
+            active_queries.append(query)
+        self.queries = active_queries
         return self
 
+    def _indexed_keys(self, index, query, pattern):
+        # without a column tracking changes, updated rows could be missed
+        if (not isinstance(query['table'], Table) or
+                not index.tracks(query['table'])):
+            return None
+        index.refresh(query['table_name'], query['table'])
+        return index.lookup(query['table_name'], pattern)
+
     def limit(self, limit):
+        self._restricted = True
         for query in self.queries:
             query['rows'] = query['rows'].limit(limit)
         return self
 
-    def _query(self):
+    def stream(self, batch_size=1000):
+        # fetch rows in batches, from a server-side cursor where the
+        # driver supports one, rather than loading whole results up front
+        for query in self.queries:
+            rows = query['rows']
+            if not hasattr(rows, 'yield_per'):
+                # already executed, e.g. by select_from
+                continue
+            rows = rows.execution_options(stream_results=True)
+            query['rows'] = rows.yield_per(batch_size)
+        return self
 
-        table_items = self.database.tables_metadata.items()
+    def _query(self):
+        # pick out the tables in play; their queries are built (and their
+        # columns reflected) only when first needed
 
-        self.queries = []
+        self._table_keys = []
 
-        for table_name, table in sorted(table_items):
+        for key in sorted(self.database.tables_metadata.keys()):
 
+            table_name = key
             if self.database.schema:
                 schema = self.database.schema + '.'
                 if table_name.startswith(schema):
@@ -101,6 +334,253 @@ class Filter(object):
                 if table_name not in self.database.tables:
                     continue
 
+            self._table_keys.append((table_name, key))
+
+        self._queries = None
+
+    def fetch(self, jobs=1):
+        # run the per-table queries, up to `jobs` at a time, yielding each
+        # table (in name order) with an iterator over its rows.  Rows are
+        # handed over a batch at a time, so memory use doesn't grow with
+        # table size; read a table's rows before asking for the next table.
+        queries = sorted(self.queries, key=lambda query: query['table_name'])
+        profiler = self.database.profiler
+        work = self._fetch_within_budget if self._budgeted() else _fetch_rows
+        work = profiler.timed(work) if profiler else work
+        if jobs <= 1 or len(queries) <= 1 or not self._parallel_ok():
+            for query in queries:
+                result = dict(query)
+                rows = work(self.database.session, query)
+                if profiler:
+                    rows = profiler.rows(query['table_name'], rows)
+                result['rows'] = rows
+                yield result
+            return
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        stop = threading.Event()
+        try:
+            channels = []
+            for query in queries:
+                channel = (queue.Queue(FETCH_QUEUE), threading.Event())
+                executor.submit(self._stream, work, query, channel[0],
+                                channel[1], stop)
+                channels.append(channel)
+            for query, (channel, done) in zip(queries, channels):
+                result = dict(query)
+                rows = _drain(query['table_name'], channel, done)
+                if profiler:
+                    rows = profiler.rows(query['table_name'], rows)
+                result['rows'] = rows
+                yield result
+                # rows left unread are dropped, freeing the worker
+                done.set()
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+    def _stream(self, work, query, channel, done, stop):
+        # runs in a worker thread, with its own session
+        session = create_session(bind=self.database.engine)
+
+        def stopped():
+            return done.is_set() or stop.is_set()
+        try:
+            rows = work(session, query)
+            while True:
+                batch = list(itertools.islice(rows, FETCH_BATCH))
+                if not _hand_over(channel, stopped, batch) or not batch:
+                    return
+        except Exception as e:
+            _hand_over(channel, stopped, e)
+        finally:
+            session.close()
+
+    def explain(self):
+        # the plan for each table's query, without running it, in table
+        # name order; see catsql.explain.explain for what a plan holds
+        plans = []
+        queries = sorted(self.queries, key=lambda query: query['table_name'])
+        for query in queries:
+            if not hasattr(query['rows'], 'statement'):
+                # already executed, e.g. by select_from
+                continue
+            plan = explain(self.database.session, query['rows'].statement)
+            plan['table_name'] = query['table_name']
+            plans.append(plan)
+        return plans
+
+    def counts(self, jobs=1, approx=False):
+        # row count for each table, keyed by table name.  Exact counts are
+        # made a batch of tables per query.  With approx, the database's own
+        # estimates are used where available, for unfiltered tables.
+        with phase(self.database.profiler, 'count'):
+            return self._counts(jobs, approx)
+
+    def _counts(self, jobs, approx):
+        result = {}
+        queries = sorted(self.queries, key=lambda query: query['table_name'])
+        if approx:
+            estimates = estimated_counts(self.database.engine,
+                                         self.database.schema)
+            for query in queries:
+                name = query['table'].name
+                if self._unfiltered(query) and name in estimates:
+                    result[query['table_name']] = estimates[name]
+        queries = [query for query in queries
+                   if query['table_name'] not in result]
+        for query in queries:
+            if not hasattr(query['rows'], 'statement'):
+                # already executed, e.g. by select_from
+                result[query['table_name']] = sum(1 for _ in query['rows'])
+        queries = [query for query in queries
+                   if query['table_name'] not in result]
+        batches = [queries[i:i + COUNT_BATCH]
+                   for i in range(0, len(queries), COUNT_BATCH)]
+        if self.database.timeout:
+            work = self._count_within_budget
+        else:
+            work = _count_batch
+        for batch, counts in zip(batches, self._map(jobs, work, batches)):
+            for query, count in zip(batch, counts):
+                result[query['table_name']] = count
+        return result
+
+    def _budgeted(self):
+        return (bool(self.database.timeout) or
+                self.database.max_rows is not None)
+
+    def _limited(self, rows):
+        # ask for one row more than allowed, to tell if there are too many
+        max_rows = self.database.max_rows
+        if max_rows is None or not hasattr(rows, 'limit'):
+            return rows
+        limit = getattr(rows, '_limit', None)
+        if limit is not None and limit <= max_rows:
+            return rows
+        return rows.limit(max_rows + 1)
+
+    def _guard(self, table_name, rows):
+        # pass on rows while within the budget, stopping with a warning
+        # once the table goes over (so other tables still get their turn)
+        max_rows = self.database.max_rows
+        count = 0
+        try:
+            for row in timed_rows(rows):
+                if max_rows is not None and count >= max_rows:
+                    print(" * {}: more than {} rows, cut short".format(
+                        table_name, max_rows), file=sys.stderr)
+                    self.cut_short.append(table_name)
+                    return
+                count += 1
+                yield row
+        except DBAPIError as e:
+            if not timed_out(e):
+                raise
+            self.cut_short.append(table_name)
+            if count:
+                outcome = 'cut short after {} rows'.format(count)
+            else:
+                outcome = 'skipped'
+            print(" * {}: over the {}s timeout, {}".format(
+                table_name, self.database.timeout, outcome), file=sys.stderr)
+
+    def _hand_out(self, query):
+        rows = query['rows']
+        profiler = self.database.profiler
+        if self._budgeted():
+            rows = self._limited(rows)
+        if profiler:
+            rows = profiler.rows(query['table_name'], rows)
+        if self._budgeted():
+            rows = self._guard(query['table_name'], rows)
+        return rows
+
+    def _fetch_within_budget(self, session, query):
+        query = dict(query, rows=self._limited(query['rows']))
+        return self._guard(query['table_name'], _session_rows(session, query))
+
+    def _count_within_budget(self, session, queries):
+        try:
+            return _count_batch(session, queries)
+        except DBAPIError as e:
+            if not timed_out(e):
+                raise
+            self.cut_short += [query['table_name'] for query in queries]
+            print(" * over the {}s timeout counting {}".format(
+                self.database.timeout,
+                ', '.join(query['table_name'] for query in queries)),
+                file=sys.stderr)
+            return [None] * len(queries)
+
+    def _unfiltered(self, query):
+        rows = query['rows']
+        return (not self._restricted and
+                getattr(rows, 'whereclause', True) is None)
+
+    def _map(self, jobs, work, items):
+        # apply work(session, item) to each item, up to `jobs` at a time,
+        # yielding results in order
+        if jobs <= 1 or len(items) <= 1 or not self._parallel_ok():
+            for item in items:
+                yield work(self.database.session, item)
+            return
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        pending = deque()
+        try:
+            # keep a bounded amount of work in flight, so fetched rows
+            # don't pile up ahead of the consumer
+            for item in items:
+                pending.append(executor.submit(self._isolated, work, item))
+                if len(pending) >= jobs * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _isolated(self, work, item):
+        # sessions can't be shared across threads
+        session = create_session(bind=self.database.engine)
+        try:
+            return work(session, item)
+        finally:
+            session.close()
+
+    def _parallel_ok(self):
+        engine = self.database.engine
+        if (engine.dialect.name == 'sqlite' and
+                engine.url.database in [None, '', ':memory:']):
+            # each connection to an in-memory database sees a different one
+            return False
+        # rows from select_from have already been executed
+        return all(hasattr(query['rows'], 'with_session')
+                   for query in self.queries)
+
+    def _prune(self, names):
+        # drop tables lacking any of the named columns, before their queries
+        # are built
+        if self._queries is not None or not names:
+            return
+        index = self.database.tables_metadata.column_index()
+        self._table_keys = [(table_name, key)
+                            for table_name, key in self._table_keys
+                            if all(key in index.get(name, ())
+                                   for name in names)]
+
+    def _build_queries(self):
+
+        tables = self.database.tables_metadata
+        with phase(self.database.profiler, 'reflect'):
+            tables.prefetch([key for _, key in self._table_keys])
+
+        queries = []
+
+        for table_name, key in self._table_keys:
+
+            table = tables[key]
+
             if self.selected_columns is not None:
                 ok = True
                 for name in self.selected_columns:
@@ -112,47 +592,183 @@ class Filter(object):
                                                      for name in self.selected_columns])
             else:
                 rows = self.database.session.query(table)
-            self.queries.append({
+            queries.append({
                 'table_name': table_name,
                 'table': table,
                 'rows': rows
             })
 
-    def _add_grep(self, table, query, sequence, case_sensitive):
-        # functions.concat would be neater, but doesn't seem to translate
-        # correctly on sqlite
-        parts = ''
-        for idx, column in enumerate(table.columns):
-            if not self.ok_column(column.name):
+        return queries
+
+    def _order_columns(self, table):
+        if self.selected_columns:
+            return [table.c[name] for name in self.selected_columns]
+        if len(table.primary_key) >= 1:
+            return list(table.primary_key)
+        # exclude JSON fields which may not have an obvious default ordering.
+        return [c for c in table.c if str(c.type) not in ['JSON', 'JSONB']]
+
+    def _default_order(self):
+        for query in self.queries:
+            cols = self._order_columns(query['table'])
+            if len(cols) >= 1:
+                query['rows'] = query['rows'].order_by(*cols)
+        return self
+
+    def sample(self, n=None, pct=None):
+        """Cut each table down to a random sample, of at most `n` rows
+        and/or about `pct` percent of rows.  Avoids sorting whole tables
+        randomly where it can: postgres samples with TABLESAMPLE (falling
+        back on random keys if that comes up short), sqlite looks up random
+        rowids, and other databases look up random values in the range of an
+        integer primary key."""
+        self._restricted = True
+        dialect = self.database.engine.dialect.name
+        preparer = self.database.engine.dialect.identifier_preparer
+        estimates = None
+        for query in self.queries:
+            rows = query['rows']
+            if not hasattr(rows, 'filter'):
+                # already executed, e.g. by select_from
                 continue
-            if parts != '':
-                parts = parts + ' // '
-            part = functions.coalesce(expression.cast(column,
-                                        types.Unicode),
-                                        '')
-            parts = parts + part
-        if case_sensitive:
-            query = query.filter(parts.contains(sequence))
+            table = query['table']
+            condition = None
+            if dialect == 'postgresql':
+                if pct is None:
+                    if estimates is None:
+                        estimates = estimated_counts(self.database.engine,
+                                                     self.database.schema)
+                    if estimates.get(table.name):
+                        share = (100.0 * n * SAMPLE_OVERSAMPLE /
+                                 estimates[table.name])
+                        condition = _postgres_sample(preparer, table, 'system',
+                                                     min(100.0, share))
+                        # sampling whole pages at a small percentage can
+                        # come up short, even empty
+                        found = rows.filter(condition).order_by(None).limit(n)
+                        if found.count() < n:
+                            condition = self._random_keys(table, n)
+                else:
+                    condition = _postgres_sample(preparer, table, 'bernoulli',
+                                                 pct)
+            elif pct is not None:
+                condition = _random_below(dialect, pct / 100.0)
+            else:
+                condition = self._random_keys(table, n)
+            if condition is not None:
+                rows = rows.filter(condition)
+            if n is not None:
+                # only the candidates (or, for small tables or when there's
+                # nothing better to go on, all rows) are sorted randomly
+                rows = rows.order_by(None).order_by(
+                    _random_order(dialect)).limit(n)
+            query['rows'] = rows
+        return self
+
+    def _random_keys(self, table, n):
+        dialect = self.database.engine.dialect.name
+        keys = list(table.primary_key)
+        if len(keys) == 1 and isinstance(keys[0].type, types.Integer):
+            key = keys[0]
+        elif dialect == 'sqlite':
+            preparer = self.database.engine.dialect.identifier_preparer
+            key = literal_column('{}.rowid'.format(
+                preparer.format_table(table)))
         else:
-            query = query.filter(parts.ilike('%%' + sequence + '%%'))
-        return query
+            return None
+        try:
+            lo, hi = self.database.session.execute(
+                select([functions.min(key), functions.max(key)]).
+                select_from(table)).first()
+        except OperationalError:
+            # e.g. a sqlite table without rowids
+            return None
+        if lo is None:
+            return None
+        span = hi - lo + 1
+        want = n * SAMPLE_OVERSAMPLE
+        if span <= want:
+            return None
+        if want > SAMPLE_KEYS:
+            return _random_below(dialect, float(want) / span)
+        picks = set()
+        while len(picks) < want:
+            picks.add(random.randint(lo, hi))
+        # the keys are our own integers, so are written into the query
+        # rather than bound, keeping clear of bound parameter limits
+        picks = [literal_column(str(int(pick))) for pick in sorted(picks)]
+        return or_(*[key.in_(picks[i:i + BULK_CHUNK])
+                     for i in range(0, len(picks), BULK_CHUNK)])
 
-    def _default_order(self):
+    def page(self, size, after=None):
+        """Limit each table to a page of `size` rows, continuing from where
+        the page whose token is `after` left off.  Rows are ordered by a
+        unique key (see unique_key()), selected after the columns asked for
+        if it isn't among them, and each page starts with a `key > last`
+        condition, so any page costs the same as the first.  Tables with no
+        unique key are dropped with a warning, since rows that tie would be
+        lost between pages.  Get the token for the next page from
+        page_token()."""
+        self._restricted = True
+        self._page_size = size
+        self._page_state = decode_page_token(after) if after else {}
+        active_queries = []
         for query in self.queries:
+            rows = query['rows']
+            table_name = query['table_name']
+            if (table_name in self._page_state and
+                    self._page_state[table_name] is None):
+                # all rows already seen
+                continue
+            if not hasattr(rows, 'order_by'):
+                # already executed, e.g. by select_from
+                self._page_state[table_name] = None
+                active_queries.append(query)
+                continue
             table = query['table']
-            primary_key = table.primary_key
-            if self.selected_columns:
-                query['rows'] = query['rows'].order_by(*[table.c[name]
-                                                         for name in self.selected_columns])
-            elif len(primary_key) >= 1:
-                query['rows'] = query['rows'].order_by(*primary_key)
-            elif len(table.c) >= 1:
-                # exclude JSON fields which may not have an obvious default ordering.
-                cols = [c for c in table.c if str(c.type) not in ['JSON', 'JSONB']]
-                if len(cols) >= 1:
-                    query['rows'] = query['rows'].order_by(*cols)
+            if (len(table.primary_key) == 0 and
+                    table.key in self.database.tables_metadata):
+                # tables reflected in bulk lack unique constraints
+                self.database.tables_metadata.complete(table.key)
+            keys = unique_key(table)
+            if keys is None:
+                print(" * {}: no unique key to page by, skipped".format(
+                    table_name), file=sys.stderr)
+                continue
+            names = list(self.selected_columns or table.c.keys())
+            extra = [key for key in keys if key.name not in names]
+            if len(extra) > 0:
+                rows = rows.add_columns(*extra)
+                names += [key.name for key in extra]
+            query['page_keys'] = [names.index(key.name) for key in keys]
+            rows = rows.order_by(None).order_by(*keys)
+            last = self._page_state.get(table_name)
+            if last is not None:
+                if len(keys) == 1:
+                    rows = rows.filter(keys[0] > last[0])
+                else:
+                    rows = rows.filter(tuple_(*keys) > tuple_(*last))
+            query['rows'] = rows.limit(size)
+            active_queries.append(query)
+        self.queries = active_queries
         return self
 
+    def page_token(self, seen):
+        """Token for the page after the current one, given a dict mapping
+        table names to (number of rows read, last row read).  Returns None
+        if there are no more rows."""
+        state = dict(self._page_state)
+        for query in self.queries:
+            table_name = query['table_name']
+            count, last = seen.get(table_name, (0, None))
+            if 'page_keys' not in query or count < self._page_size:
+                state[table_name] = None
+            else:
+                state[table_name] = [last[idx] for idx in query['page_keys']]
+        if all(last is None for last in state.values()):
+            return None
+        return encode_page_token(state)
+
     def order(self, ordering=None):
         if ordering is None:
             return self._default_order()
@@ -176,6 +792,7 @@ class Filter(object):
 
     def where_kv_with_expansion(self, conditions):
         # conditions is a dict
+        self._prune(conditions.keys())
         active_queries = []
         for query in self.queries:
             try:
@@ -198,7 +815,10 @@ class Filter(object):
         return self
 
     def __iter__(self):
-        return self.queries.__iter__()
+        if self.database.profiler is None and not self._budgeted():
+            return self.queries.__iter__()
+        return iter([dict(query, rows=self._hand_out(query))
+                     for query in self.queries])
 
     def __len__(self):
         return len(self.queries)
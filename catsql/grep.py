@@ -0,0 +1,174 @@
+from __future__ import unicode_literals
+import itertools
+import re
+from sqlalchemy import inspect, or_, text, types
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import (bindparam, expression, functions, literal_column,
+                            select)
+from sqlalchemy.sql import table as table_clause
+
+# Ways to search a table for a text fragment:
+#   contains - any text column contains the fragment (the default)
+#   exact    - any text column is exactly the fragment
+#   prefix   - any text column starts with the fragment
+#   fulltext - the database's own full-text search, where the table has
+#              it set up, otherwise the same as contains
+#   concat   - all columns, of any type, rendered as text and joined
+# Searching individual columns rather than everything joined together lets
+# the database use indexes: exact and prefix can use ordinary indexes,
+# fulltext uses full-text indexes.
+GREP_MODES = ['contains', 'exact', 'prefix', 'fulltext', 'concat']
+
+_bind_names = itertools.count()
+
+
+def text_columns(columns):
+    # untyped columns (common in sqlite) may well hold text
+    return [column for column in columns
+            if isinstance(column.type,
+                          (types.String, types.Enum, types.NullType))]
+
+
+def as_text(column):
+    # enums, untyped and user-defined types need a cast before text
+    # operators will take them, on postgres at least
+    if (isinstance(column.type, types.String) and
+            not isinstance(column.type, types.Enum)):
+        return column
+    return expression.cast(column, types.Unicode)
+
+
+def grep_condition(database, table, columns, sequence, mode='contains',
+                   case_sensitive=False):
+    """Build a condition matching rows of `table` in which `sequence` occurs.
+    Only the given columns are searched.  Returns None if nothing in the
+    table could match."""
+    if mode == 'concat':
+        return concat_condition(columns, sequence, case_sensitive)
+    if mode == 'fulltext':
+        condition = fulltext_condition(database, table, columns, sequence)
+        if condition is not None:
+            return condition
+        mode = 'contains'
+    columns = [as_text(column) for column in text_columns(columns)]
+    if len(columns) == 0:
+        return None
+    if mode == 'exact':
+        parts = [column == sequence for column in columns]
+    elif mode == 'prefix':
+        parts = prefix_condition(database, columns, sequence, case_sensitive)
+    elif case_sensitive:
+        parts = [column.contains(sequence) for column in columns]
+    else:
+        parts = [column.ilike('%' + sequence + '%') for column in columns]
+    return or_(*parts)
+
+
+def prefix_condition(database, columns, sequence, case_sensitive):
+    # written so an index can be used where the database allows: sqlite's
+    # LIKE ignores case and can use an index declared COLLATE NOCASE, mysql's
+    # LIKE follows the column's (usually case-insensitive) collation, and on
+    # postgres lower(column) LIKE can use an index on lower(column) with
+    # text_pattern_ops
+    fragment = re.sub(r'([\\%_])', r'\\\1', sequence) + '%'
+    dialect = database.engine.dialect.name
+    if case_sensitive or dialect in ['sqlite', 'mysql']:
+        return [column.like(fragment, escape='\\') for column in columns]
+    if dialect == 'postgresql':
+        return [functions.func.lower(column).like(fragment.lower(),
+                                                  escape='\\')
+                for column in columns]
+    return [column.ilike(fragment, escape='\\') for column in columns]
+
+
+def concat_condition(columns, sequence, case_sensitive):
+    # functions.concat would be neater, but doesn't seem to translate
+    # correctly on sqlite
+    parts = ''
+    for column in columns:
+        if parts != '':
+            parts = parts + ' // '
+        part = functions.coalesce(expression.cast(column, types.Unicode), '')
+        parts = parts + part
+    if parts == '':
+        return None
+    if case_sensitive:
+        return parts.contains(sequence)
+    return parts.ilike('%%' + sequence + '%%')
+
+
+def fulltext_condition(database, table, columns, sequence):
+    dialect = database.engine.dialect.name
+    if dialect == 'postgresql':
+        return postgres_fulltext(columns, sequence)
+    if dialect == 'mysql':
+        return mysql_fulltext(database, table, columns, sequence)
+    if dialect == 'sqlite':
+        return sqlite_fulltext(database, table, sequence)
+    return None
+
+
+def postgres_fulltext(columns, sequence):
+    # matches expression indexes on to_tsvector('simple', column)
+    columns = [as_text(column) for column in text_columns(columns)]
+    if len(columns) == 0:
+        return None
+    query = functions.func.plainto_tsquery('simple', sequence)
+    return or_(*[functions.func.to_tsvector('simple', column).op('@@')(query)
+                 for column in columns])
+
+
+def mysql_fulltext(database, table, columns, sequence):
+    # MATCH only works against the exact column list of a FULLTEXT index
+    names = set(column.name for column in columns)
+    try:
+        indexes = inspect(database.engine).get_indexes(table.name,
+                                                       schema=table.schema)
+    except DBAPIError:
+        return None
+    parts = []
+    preparer = database.engine.dialect.identifier_preparer
+    for index in indexes:
+        if index.get('type') != 'FULLTEXT':
+            continue
+        if not set(index['column_names']) <= names:
+            continue
+        name = 'grep_{}'.format(next(_bind_names))
+        quoted = ', '.join(preparer.quote(column)
+                           for column in index['column_names'])
+        parts.append(text(
+            'MATCH ({}) AGAINST (:{} IN NATURAL LANGUAGE MODE)'.format(
+                quoted, name)).bindparams(bindparam(name, sequence)))
+    if len(parts) == 0:
+        return None
+    return or_(*parts)
+
+
+def sqlite_fulltext(database, table, sequence):
+    # look for an FTS5 table shadowing this one, named <table>_fts
+    fts_name = '{}_fts'.format(table.name)
+    master = 'sqlite_master'
+    if table.schema:
+        master = '"{}".sqlite_master'.format(table.schema)
+    try:
+        with database.engine.connect() as conn:
+            sql = conn.execute(
+                text("SELECT sql FROM {} WHERE name = :name".format(master)),
+                {'name': fts_name}).scalar()
+    except DBAPIError:
+        return None
+    if not sql or 'fts5' not in sql.lower():
+        return None
+    preparer = database.engine.dialect.identifier_preparer
+    match = re.search(r"content_rowid\s*=\s*['\"]?(\w+)", sql, re.IGNORECASE)
+    if match and match.group(1) in table.c:
+        key = table.c[match.group(1)]
+    else:
+        key = literal_column('{}.rowid'.format(preparer.format_table(table)))
+    fts = table_clause(fts_name)
+    if table.schema:
+        fts.schema = table.schema
+    phrase = '"{}"'.format(sequence.replace('"', '""'))
+    hits = select([literal_column('rowid')]).select_from(fts).where(
+        literal_column(preparer.quote(fts_name)).op('MATCH')(phrase))
+    return key.in_(hits)
@@ -0,0 +1,127 @@
+from __future__ import unicode_literals
+import daff
+from decimal import Decimal
+import sys
+
+from catsql.nullify import Nullify
+
+if sys.version_info[0] == 2:
+    import unicodecsv as csv
+else:
+    import csv
+
+_KEY_TYPES = [int, float, Decimal]
+
+
+class Unordered(Exception):
+    """A file isn't strictly in key order, so can't be merged."""
+    pass
+
+
+def key_converters(table, header):
+    """Functions turning the primary key cells of a row into a sortable key,
+    or None if the rows can't be keyed."""
+    converters = []
+    for column in table.primary_key:
+        if column.name not in header:
+            return None
+        try:
+            kind = column.type.python_type
+        except NotImplementedError:
+            kind = None
+        converters.append((header.index(column.name),
+                           kind if kind in _KEY_TYPES else None))
+    return converters if len(converters) > 0 else None
+
+
+def keyed_rows(rows, converters):
+    last = None
+    for row in rows:
+        key = []
+        for idx, kind in converters:
+            value = row[idx] if idx < len(row) else None
+            if value is None:
+                raise Unordered()
+            if kind is not None:
+                try:
+                    value = kind(value)
+                except ValueError:
+                    raise Unordered()
+            key.append(value)
+        key = tuple(key)
+        if last is not None and key <= last:
+            raise Unordered()
+        last = key
+        yield key, row
+
+
+def keyed_diff(table, fname0, fname1, safe_null=False):
+    """Diff two csv snapshots of a table with a primary key, reading each a
+    row at a time.  Both must list rows in increasing key order, as the
+    reference snapshot written for --edit does.  Returns the patch as a
+    daff table, or None if the snapshots can't be compared this way (the
+    table has no key, the columns differ, or rows are out of order), in
+    which case daff should be used instead."""
+    nullify = Nullify()
+    with open(fname0, 'rt') as fin0, open(fname1, 'rt') as fin1:
+        rows0 = csv.reader(fin0)
+        rows1 = csv.reader(fin1)
+        if safe_null:
+            rows0 = nullify.decode_rows(rows0)
+            rows1 = nullify.decode_rows(rows1)
+        header = next(rows0, None)
+        if header is None or header != next(rows1, None):
+            return None
+        converters = key_converters(table, header)
+        if converters is None:
+            return None
+        width = len(header)
+        patch = [['@@'] + header]
+        rows0 = keyed_rows(rows0, converters)
+        rows1 = keyed_rows(rows1, converters)
+        try:
+            before = next(rows0, None)
+            after = next(rows1, None)
+            while before is not None or after is not None:
+                if after is None or (before is not None and
+                                     before[0] < after[0]):
+                    patch.append(['---'] + _pad(before[1], width))
+                    before = next(rows0, None)
+                elif before is None or after[0] < before[0]:
+                    patch.append(['+++'] + _pad(after[1], width))
+                    after = next(rows1, None)
+                else:
+                    change = _update(nullify, _pad(before[1], width),
+                                     _pad(after[1], width))
+                    if change is not None:
+                        patch.append(change)
+                    before = next(rows0, None)
+                    after = next(rows1, None)
+        except Unordered:
+            return None
+    return daff.Coopy.tablify(patch)
+
+
+def _pad(row, width):
+    row = list(row[:width])
+    return row + [None] * (width - len(row))
+
+
+def _update(nullify, before, after):
+    if before == after:
+        return None
+    # as in daff, the arrow is lengthened until no cell in the row holds it
+    cells = [('{}'.format(value) for value in [a, b] if value is not None)
+             for a, b in zip(before, after)]
+    text = [value for pair in cells for value in pair]
+    separator = '->'
+    while any(separator in value for value in text):
+        separator = '-' + separator
+    row = [separator]
+    for a, b in zip(before, after):
+        if a == b:
+            row.append(a)
+        else:
+            row.append('{}{}{}'.format(nullify.encode_null(a), separator,
+                                       nullify.encode_null(b)))
+    return row
@@ -6,24 +6,25 @@ from __future__ import unicode_literals
 import argparse
 import errno
 from collections import OrderedDict
-from datetime import datetime
-import decimal
 from io import StringIO, BytesIO
 import json
-import openpyxl
-import openpyxl.styles
 import os
 from shutil import copyfile
-from sqlalchemy import Column, ForeignKey, MetaData, Table, types
+import sqlite3
 from sqlalchemy.exc import (CompileError, SAWarning)
 from subprocess import call
 import sys
 import warnings
 
 from catsql import cmdline
+from catsql.cache import SchemaCache
 from catsql.database import Database
+from catsql.export import (ARROW_BATCH, ArrowExport, ExcelExport, JsonExport,
+                           SqliteExport, row_projector)
 from catsql.nullify import Nullify
 from catsql.patch import patchsql
+from catsql.profiler import CountingWriter, Profiler
+from catsql.search_index import SearchIndex
 
 if sys.version_info[0] == 2:
     import unicodecsv as csv
@@ -33,15 +34,6 @@ else:
 warnings.simplefilter("ignore", category=SAWarning)
 
 
-class CatEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, decimal.Decimal):
-            return float(obj)
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return json.JSONEncoder.default(self, obj)
-
-
 # Get approximate length of header
 class CsvRowWriter(object):
     def __init__(self):
@@ -69,9 +61,13 @@ class SmartFormatter(argparse.HelpFormatter):
 
 
 class Viewer(object):
-    def __init__(self, args, remainder, sys_args):
+    def __init__(self, args, remainder, sys_args, parser=None):
         self.args = args
         self.sys_args = sys_args
+        self.parser = parser
+        if self.parser is None:
+            self.parser = argparse.ArgumentParser()
+            cmdline.add_options(self.parser)
         self.failure = False
         self.values = None
         self.setup_filters(args)
@@ -107,21 +103,31 @@ class Viewer(object):
 
         if self.tables is not None:
             self.tables = set(self.tables)
+        self.selected_column_set = set(self.selected_columns or [])
         self.row_filter = args.sql
         self.output_in_csv = args.csv
         if args.txt:
             self.output_in_csv = True
         self.output_in_json = args.json
+        self.output_in_ndjson = args.ndjson
+        self.output_in_arrow = args.parquet or args.arrow
         self.output_in_sqlite = args.sqlite
         self.output_in_excel = args.excel
+        if args.approx_count:
+            self.args.count = True
+        self.jobs = int(args.jobs[0]) if args.jobs else 1
+        self.page_seen = {}
+        self.profiler = None
+        if args.profile or args.profile_json:
+            self.profiler = Profiler()
 
         self.target_db = None
         if self.output_in_sqlite:
             self.target_db = Database(self.output_in_sqlite[0], can_create=True)
         self.target_ss = None
         if self.output_in_excel:
-            self.target_ss = openpyxl.Workbook()
-            self.target_ss.remove_sheet(self.target_ss.active)
+            self.target_ss = ExcelExport(self.output_in_excel[0],
+                                         split=args.excel_split)
 
         if args.value is not None:
             for context in args.value:
@@ -133,47 +139,77 @@ class Viewer(object):
                     self.context_columns.add(context)
 
     def connect_database(self):
-        database = Database(self.url, verbose=self.args.verbose, tables=self.tables, schema=self.schema)
+        cache = None
+        if self.args.cache_schema:
+            ttl = float(self.args.cache_ttl[0]) if self.args.cache_ttl else 300
+            cache = SchemaCache(ttl=ttl)
+        timeout = float(self.args.timeout[0]) if self.args.timeout else None
+        max_rows = int(self.args.max_rows[0]) if self.args.max_rows else None
+        database = Database(self.url, verbose=self.args.verbose,
+                            tables=self.tables, schema=self.schema,
+                            cache=cache,
+                            pool_size=self.jobs if self.jobs > 1 else None,
+                            profiler=self.profiler, timeout=timeout,
+                            max_rows=max_rows)
         self.database = database
         self.url = self.args.catsql_database_url = database.full_url
 
+    def search_index(self):
+        if not (self.args.grep_index or self.args.grep_index_rebuild):
+            return None
+        if not self.args.grep_index_column:
+            print("Search index not used: --grep-index needs "
+                  "--grep-index-column to find changed rows", file=sys.stderr)
+            return None
+        column = self.args.grep_index_column[0]
+        try:
+            index = SearchIndex(self.database.engine, schema=self.schema,
+                                column=column)
+        except (OSError, sqlite3.Error) as e:
+            # e.g. a sqlite without the fts5 trigram tokenizer
+            print("Search index not available: {}".format(e), file=sys.stderr)
+            return None
+        if self.args.grep_index_rebuild:
+            index.rebuild()
+        return index
+
     def process_remainder(self, remainder):
-        column_names = set()
+        # remaining arguments should be --column value filters; check them
+        # against the columns the database actually has
         if len(remainder) == 0:
             return
-        for table in self.database.tables_metadata.values():
-            keys = None
-            if hasattr(table, 'columns'):
-                keys = table.columns.keys()
-            else:
-                keys = table.keys
-            column_names |= set(keys)
-        if 'catsql_database_url' in column_names:
-            column_names.remove('catsql_database_url')
-        parser = argparse.ArgumentParser()
-        cmdline.add_options(parser)
-        for name in sorted(column_names):
-            try:
-                parser.add_argument('--{}'.format(name), nargs=1, default=None)
-            except argparse.ArgumentError:
-                column_names.remove(name)
-        self.values = vars(parser.parse_args(self.sys_args))
-        dud = []
-        for key, val in self.values.items():
-            if (key not in column_names) or val is None:
-                dud.append(key)
-        for key in dud:
-            del self.values[key]
-        for key, val in self.values.items():
-            self.values[key] = val[0]
+        column_index = self.database.tables_metadata.column_index()
+        self.values = dict()
+        unknown = []
+        idx = 0
+        while idx < len(remainder):
+            arg = remainder[idx]
+            idx += 1
+            if not arg.startswith('--'):
+                unknown.append(arg)
+                continue
+            key = arg[2:]
+            val = None
+            if '=' in key:
+                key, val = key.split('=', 1)
+            elif idx < len(remainder):
+                val = remainder[idx]
+                idx += 1
+            if key not in column_index or val is None:
+                unknown.append(arg)
+                continue
+            self.values[key] = val
             self.context_columns.add(key)
+        if unknown:
+            self.parser.error('unrecognized arguments: {}'.format(
+                ' '.join(unknown)))
 
     def ok_column(self, name):
         if self.args.terse:
             if name in self.context_columns:
                 return False
-        if self.selected_columns:
-            if name not in self.selected_columns:
+        if self.selected_column_set:
+            if name not in self.selected_column_set:
                 return False
         return True
 
@@ -184,23 +220,33 @@ class Viewer(object):
         self.columns = columns
         if self.selected_columns:
             self.columns = self.selected_columns
+        if self.columns is not None:
+            # work out once which cells of each row are shown
+            self.visible_columns = [(c, name)
+                                    for c, name in enumerate(self.columns)
+                                    if self.ok_column(name)]
+            self.project = row_projector([c for c, _ in self.visible_columns])
 
     def show_header_on_need(self):
         if self.header_shown or self.header_considered:
             return True
         self.header_considered = True
         if len(self.tables_so_far) > 0:
-            if (self.output_in_csv or self.output_in_json or self.output_in_sqlite or
-                  self.output_in_excel):
+            if (self.output_in_csv or self.output_in_json or
+                    self.output_in_sqlite or self.output_in_excel or
+                    self.output_in_ndjson or self.output_in_arrow):
                 if not self.output_in_sqlite:
                     self.failure = True
                 self.tables_so_far.append(self.table_name)
                 return False
             print("", file=self.output_file)
-        if not (self.output_in_csv or self.output_in_json or self.output_in_sqlite or
-                self.output_in_excel):
+        if not (self.output_in_csv or self.output_in_json or
+                self.output_in_sqlite or self.output_in_excel or
+                self.output_in_ndjson or self.output_in_arrow):
             print('== {} =='.format(self.table_name), file=self.output_file)
-        if not (self.output_in_json or self.output_in_sqlite or self.output_in_excel):
+        if not (self.output_in_json or self.output_in_sqlite or
+                self.output_in_excel or self.output_in_ndjson or
+                self.output_in_arrow):
             header_writer = CsvRowWriter()
 
             header = header_writer.writerow(list(column for column in self.columns
@@ -235,7 +281,9 @@ class Viewer(object):
                 self.args.safe_null = True
                 self.args.save_bookmark = [os.path.join(work, 'bookmark.json')]
             elif self.args.output:
-                self.output_file = open(self.args.output[0], 'wt')
+                work_file = self.output_file = open(self.args.output[0], 'wt')
+            if self.profiler:
+                self.output_file = CountingWriter(self.output_file)
 
             viable_tables = []
 
@@ -244,17 +292,21 @@ class Viewer(object):
             if self.args.select_from:
                 q = q.select_from(self.args.select_from[0])
                 touchable = False
-            if self.args.distinct:
-                q = q.distinct()
-            if self.row_filter is not None:
-                q = q.where_sqls(self.row_filter)
+            # column value filters come first, since they can rule out
+            # tables without building queries for them
             if self.args.value is not None:
                 q = q.where_kv(self.context_filters)
             if self.values is not None:
                 q = q.where_kv_with_expansion(self.values)
+            if self.args.distinct:
+                q = q.distinct()
+            if self.row_filter is not None:
+                q = q.where_sqls(self.row_filter)
             if self.args.grep:
+                index = self.search_index()
                 for pattern in self.args.grep:
-                    q = q.grep(pattern, case_sensitive=False)
+                    q = q.grep(pattern, case_sensitive=False,
+                               mode=self.args.grep_mode, index=index)
             if self.args.order:
                 if 'none' not in self.args.order:
                     q.order(self.ordering)
@@ -262,9 +314,36 @@ class Viewer(object):
                 q.order()
             if self.args.limit:
                 q = q.limit(int(self.args.limit[0]))
-
-            ts = list(q)
-            ts.sort(key=lambda t: t['table_name'])
+            if self.args.sample or self.args.sample_pct:
+                n = int(self.args.sample[0]) if self.args.sample else None
+                pct = None
+                if self.args.sample_pct:
+                    pct = float(self.args.sample_pct[0])
+                q = q.sample(n=n, pct=pct)
+            if self.args.page_size:
+                try:
+                    after = self.args.after[0] if self.args.after else None
+                    q = q.page(int(self.args.page_size[0]), after=after)
+                except ValueError as e:
+                    self.parser.error(str(e))
+            if self.args.batch_size:
+                q = q.stream(int(self.args.batch_size[0]))
+            else:
+                q = q.stream()
+
+            if self.args.explain:
+                self.show_plans(q)
+                return
+
+            counts = None
+            if self.args.count:
+                counts = q.counts(self.jobs, approx=self.args.approx_count)
+                ts = sorted(q, key=lambda t: t['table_name'])
+            elif self.jobs > 1:
+                ts = q.fetch(self.jobs)
+            else:
+                ts = list(q)
+                ts.sort(key=lambda t: t['table_name'])
 
             for t in ts:
                 table_name = t['table_name']
@@ -279,12 +358,17 @@ class Viewer(object):
                     keys = table.keys
                 self.start_table(table_name, keys)
                 viable_tables.append(table_name)
+                if self.profiler:
+                    written = self.output_file.count
+
+                if self.args.page_size:
+                    rows = self.paged(table_name, rows)
 
                 if self.args.types:
+                    # a row as wide as the table's, since the writers
+                    # pick the visible cells out of it
                     column_types = []
                     for name in self.columns:
-                        if not self.ok_column(name):
-                            continue
                         try:
                             column = table.c[name]
                             sql_name = str(column.type)  # make sure not nulltype
@@ -294,90 +378,25 @@ class Viewer(object):
                     rows = [column_types]
 
                 if self.target_ss:
-                    ws = self.target_ss.create_sheet()
-                    ws.title = table_name
-                    ws.append(column for column in self.columns
-                                if self.ok_column(column))
-                    for row in rows:
-                        ws.append(cell for c, cell in enumerate(row)
-                                if self.ok_column(self.columns[c]))
-                    s = openpyxl.styles.NamedStyle(name="Header",
-                                                   font=openpyxl.styles.Font(bold=True))
-                    for cell in next(ws.rows):
-                        cell.style = s
-                    for column_cells in ws.columns:
-                        ws.column_dimensions[column_cells[0].column_letter].auto_size = True
+                    self.target_ss.add(table_name, self.visible_columns, rows)
 
                 if self.target_db:
-                    if table_name in self.target_db.tables_metadata.keys():
-                        # clear previous results
-                        self.target_db.tables_metadata[table_name].drop(self.target_db.engine)
-                    target = {'table': None, 'rows': []}
-
-                    def fallback_type(example):
-                        if isinstance(example, bool):
-                            return types.Boolean
-                        elif isinstance(example, int):
-                            return types.Integer
-                        elif isinstance(example, float):
-                            return types.Float
-                        elif isinstance(example, datetime):
-                            return types.DateTime
-                        return types.UnicodeText
-
-                    def create_table(data):
-                        if target['table'] is not None:
-                            return
-                        columns = []
-                        for name in self.columns:
-                            if not self.ok_column(name):
-                                continue
-                            column = table.c[name]
-                            sql_type = column.type
-                            try:
-                                self.target_db.engine.dialect.type_compiler.process(sql_type)
-                            except CompileError:
-                                # some types need to be approximated
-                                sql_type = None
-                            if sql_type is None or isinstance(sql_type, types.NullType):
-                                example = data.get(name)
-                                sql_type = fallback_type(example)
-                            sql_type.collation = None  # ignore collation
-                            fks = [ForeignKey(fk.column) for fk in column.foreign_keys]
-                            columns.append(Column(name, sql_type,
-                                                  *fks,
-                                                  primary_key=column.primary_key))
-                        metadata = MetaData(bind=self.target_db.engine)
-                        target['table'] = Table(table_name, metadata, *columns)
-                        target['table'].create(self.target_db.engine)
-
-                    def add_row(data):
-                        if data:
-                            target['rows'].append(data)
-                        if len(target['rows']) > 10000 or not data:
-                            if len(target['rows']) > 0:
-                                target['table'].insert().execute(target['rows'])
-                            target['rows'] = []
-
-                    def sqlited(data):
-                        if isinstance(data, dict) or isinstance(data, list):
-                            return json.dumps(data)
-                        return data
-
-                    for row in rows:
-                        data = dict((self.columns[c], sqlited(cell))
-                                    for c, cell in enumerate(row)
-                                    if self.ok_column(self.columns[c]))
-                        create_table(data)
-                        add_row(data)
-                    create_table({})
-                    add_row(None)
-
-                if self.output_in_json or self.output_in_sqlite or self.output_in_excel:
+                    SqliteExport(self.target_db, self.database).save(
+                        table_name, table, self.visible_columns, rows)
+
+                if (self.output_in_json or self.output_in_sqlite or
+                        self.output_in_excel or self.output_in_ndjson or
+                        self.output_in_arrow):
                     if not self.show_header_on_need():
                         continue
                     if self.output_in_json:
                         self.save_as_json(table, rows, self.output_in_json[0])
+                    if self.output_in_ndjson:
+                        self.save_as_json(table, rows,
+                                          self.output_in_ndjson[0],
+                                          lines=True)
+                    if self.output_in_arrow:
+                        self.save_as_arrow(table, rows)
                 elif not self.args.count:
                     # csv spec is that eol is \r\n; we ignore this for our purposes
                     # for good reasons that unfortunately there isn't space to describe
@@ -387,23 +406,34 @@ class Viewer(object):
                         continue
                     if self.args.safe_null:
                         nullify = Nullify()
-                        for row in rows:
-                            csv_writer.writerow(list(nullify.encode_null(cell)
-                                                     for c, cell in enumerate(row)
-                                                     if self.ok_column(self.columns[c])))
+                        csv_writer.writerows(
+                            nullify.encode_rows(map(self.project, rows)))
                     else:
-                        for row in rows:
-                            csv_writer.writerow(list(cell for c, cell in enumerate(row)
-                                                     if self.ok_column(self.columns[c])))
+                        csv_writer.writerows(map(self.project, rows))
                     del csv_writer
                 else:
                     self.show_header_on_need()
-                    ct = rows.count()
-                    print("({} row{})".format(ct, '' if ct == 1 else 's'), file=self.output_file)
+                    ct = counts[table_name]
+                    if ct is None:
+                        print("(timed out)", file=self.output_file)
+                    else:
+                        print("({} row{})".format(ct, '' if ct == 1 else 's'),
+                              file=self.output_file)
+
+                if self.profiler:
+                    self.profiler.wrote(table_name,
+                                        self.output_file.count - written +
+                                        self.file_bytes())
 
             if len(self.tables_so_far) == 0 and len(viable_tables) == 1:
                 self.show_header_on_need()
 
+            if self.args.page_size:
+                token = q.page_token(self.page_seen)
+                if token:
+                    print(" * more rows: --after {}".format(token),
+                          file=sys.stderr)
+
             if self.args.save_bookmark:
                 with open(self.args.save_bookmark[0], 'w') as fout:
                     link = OrderedDict()
@@ -427,11 +457,15 @@ class Viewer(object):
                 call([editor, edit_filename])
                 patchsql([self.url, '--table'] + self.tables_so_far +
                          ['--follow', output_filename, edit_filename,
-                            '--safe-null'] +
-                            (['--quiet'] if self.args.quiet else []) +
-                            (['--schema', self.schema] if self.schema else []),
+                          '--safe-null'] +
+                         (['--quiet'] if self.args.quiet else []) +
+                         (['--schema', self.schema] if self.schema else []),
                          database=self.database)
 
+            if q.cut_short:
+                # output is incomplete, which scripts should hear about
+                exit(1)
+
         finally:
             if self.failure:
                 print("ERROR: "
@@ -442,7 +476,7 @@ class Viewer(object):
                           file=sys.stderr)
 
             if self.target_ss:
-                self.target_ss.save(self.output_in_excel[0])
+                self.target_ss.save()
             if work_file:
                 try:
                     work_file.close()
@@ -453,33 +487,81 @@ class Viewer(object):
                 import shutil
                 shutil.rmtree(work)
                 work = None
-
-    def save_as_json(self, table, rows, filename):
-        result = OrderedDict()
-        result['count'] = 0
-        result['meta'] = {
-            'generator': 'catsql',
-            'name': table.name,
-        }
-        results = result['results'] = []
-        names = []
-        idxs = []
-        for idx, column in enumerate(self.columns):
-            if not self.ok_column(column):
-                continue
-            idxs.append(idx)
-            names.append(column)
-        for row in rows:
-            od = OrderedDict()
-            for i, idx in enumerate(idxs):
-                od[names[i]] = row[idx]
-            results.append(od)
-        result['count'] = len(results)
-
+            if self.profiler:
+                if self.args.profile:
+                    self.profiler.report(sys.stderr)
+                if self.args.profile_json:
+                    self.profiler.save(self.args.profile_json[0])
+
+    def save_as_json(self, table, rows, filename, lines=False):
+        columns = self.visible_columns
+        # a --types row holds type names, not values
+        typed = not self.args.types
+        if filename == '-':
+            JsonExport(self.output_file, lines=lines, typed=typed).save(
+                table, columns, rows)
+            return
         with open(filename, 'w') as fout:
-            fout.write(json.dumps(result,
-                                  indent=2,
-                                  cls=CatEncoder))
+            JsonExport(fout, lines=lines, typed=typed).save(table, columns,
+                                                            rows)
+
+    def show_plans(self, q):
+        for idx, plan in enumerate(q.explain()):
+            if idx > 0:
+                print("", file=self.output_file)
+            print('== {} =='.format(plan['table_name']), file=self.output_file)
+            for line in plan['plan']:
+                print(line, file=self.output_file)
+            if plan['rows'] is not None or plan['cost'] is not None:
+                print(" * estimated rows: {}, cost: {}".format(
+                    plan['rows'], plan['cost']), file=self.output_file)
+            for name in plan['scans']:
+                print(" * full scan of {}".format(name), file=self.output_file)
+
+    def file_bytes(self):
+        # size of single-table output files, written whole for each table
+        fnames = []
+        if self.output_in_json:
+            fnames.append(self.output_in_json[0])
+        if self.output_in_ndjson and self.output_in_ndjson[0] != '-':
+            fnames.append(self.output_in_ndjson[0])
+        for fname in (self.args.parquet or []) + (self.args.arrow or []):
+            fnames.append(fname)
+        return sum(os.path.getsize(fname) for fname in fnames
+                   if os.path.exists(fname))
+
+    def paged(self, table_name, rows):
+        # note how far through the page each table gets, for page_token
+        count = 0
+        row = None
+        for row in rows:
+            count += 1
+            yield row
+        self.page_seen[table_name] = (count, row)
+
+    def save_as_arrow(self, table, rows):
+        columns = self.visible_columns
+        batch_size = ARROW_BATCH
+        if self.args.row_group_size:
+            batch_size = int(self.args.row_group_size[0])
+        if self.args.parquet and self.args.arrow:
+            # both want the rows
+            rows = list(rows)
+        # a --types row holds type names, not values
+        typed = not self.args.types
+        try:
+            if self.args.parquet:
+                ArrowExport(self.args.parquet[0], parquet=True,
+                            batch_size=batch_size,
+                            typed=typed).save(table, columns, rows)
+            if self.args.arrow:
+                ArrowExport(self.args.arrow[0], parquet=False,
+                            batch_size=batch_size,
+                            typed=typed).save(table, columns, rows)
+        except ImportError as e:
+            print("Support library for parquet/arrow not installed - "
+                  "{}".format(e))
+            exit(1)
 
 
 def catsql(sys_args):
@@ -489,7 +571,7 @@ def catsql(sys_args):
 
     cmdline.add_options(parser)
     args, remainder = parser.parse_known_args(sys_args)
-    viewer = Viewer(args, remainder, sys_args)
+    viewer = Viewer(args, remainder, sys_args, parser)
     viewer.show()
 
 
@@ -1,6 +1,9 @@
 import re
 from six import string_types
 
+# first characters of any string that encoding or decoding could change
+_SPECIAL_STARTS = ('_', 'N')
+
 
 class Nullify(object):
 
@@ -17,6 +20,8 @@ class Nullify(object):
             return 'NULL'
         if not self.stringy(value):
             return value
+        if value[:1] not in _SPECIAL_STARTS:
+            return value
         if self.need_underscore.match(value):
             return '_{}'.format(value)
         return value
@@ -26,9 +31,54 @@ class Nullify(object):
             return value
         if not self.stringy(value):
             return value
+        if value[:1] not in _SPECIAL_STARTS:
+            return value
         if value == 'NULL':
             return None
         result = self.has_underscore.match(value)
         if result:
             return result.group(1)
         return value
+
+    def encode_row(self, row):
+        result = list(row)
+        need_underscore = self.need_underscore
+        for idx, value in enumerate(result):
+            if value is None:
+                result[idx] = 'NULL'
+            elif (isinstance(value, string_types) and
+                  value[:1] in _SPECIAL_STARTS and
+                  need_underscore.match(value)):
+                result[idx] = '_{}'.format(value)
+        return result
+
+    def decode_row(self, row):
+        result = list(row)
+        has_underscore = self.has_underscore
+        for idx, value in enumerate(result):
+            if (not isinstance(value, string_types) or
+                    value[:1] not in _SPECIAL_STARTS):
+                continue
+            if value == 'NULL':
+                result[idx] = None
+            else:
+                match = has_underscore.match(value)
+                if match:
+                    result[idx] = match.group(1)
+        return result
+
+    def encode_rows(self, rows):
+        """Encode rows lazily, as they are read."""
+        for row in rows:
+            yield self.encode_row(row)
+
+    def decode_rows(self, rows):
+        """Decode rows lazily, as they are read."""
+        for row in rows:
+            yield self.decode_row(row)
+
+    def decode_table(self, table):
+        """Decode a list of rows in place."""
+        for idx, row in enumerate(table):
+            table[idx] = self.decode_row(row)
+        return table
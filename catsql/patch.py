@@ -3,12 +3,19 @@
 from __future__ import print_function
 import argparse
 import daff
+import hashlib
 import json
+import os
 from sqlalchemy.exc import SAWarning
 import sys
+import time
 import warnings
 
+from catsql.cache import SchemaCache
 from catsql.daffsql.sqlalchemy_database import SqlAlchemyDatabase
+from catsql.daffsql.sqlalchemy_helper import SqlAlchemyHelper
+from catsql.daffsql.staging_helper import StagingHelper
+from catsql.keyed_diff import keyed_diff
 from catsql.nullify import Nullify
 
 if sys.version_info[0] == 2:
@@ -18,14 +25,99 @@ else:
 
 warnings.simplefilter("ignore", category=SAWarning)
 
+# changes per commit when checkpointing, if --chunk-size isn't given
+CHECKPOINT_CHUNK = 10000
 
-def fix_nulls(table, active):
-    if not active:
-        return
-    nullify = Nullify()
-    for row in table:
-        for i in range(0, len(row)):
-            row[i] = nullify.decode_null(row[i])
+# row actions in a daff patch
+ROW_ACTIONS = ['+++', '---', '->', '+']
+
+
+def read_csv(fname, safe_null):
+    with open(fname, 'rt') as fin:
+        rows = csv.reader(fin)
+        if safe_null:
+            rows = Nullify().decode_rows(rows)
+        return list(rows)
+
+
+def count_changes(patch):
+    view = patch.getCellView()
+    column = 1 if view.toString(patch.getCell(0, 0)) == '@:@' else 0
+    return sum(1 for r in range(patch.get_height())
+               if view.toString(patch.getCell(column, r)) in ROW_ACTIONS)
+
+
+def patch_digest(table, fnames):
+    digest = hashlib.sha1(table.encode('utf-8'))
+    for fname in fnames:
+        with open(fname, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def load_checkpoint(fname, digest):
+    """Number of changes already committed by an earlier run of the same
+    patch, according to its checkpoint file."""
+    if not os.path.exists(fname):
+        return 0
+    with open(fname, 'r') as fin:
+        checkpoint = json.loads(fin.read())
+    if checkpoint.get('patch') != digest:
+        print(" * checkpoint {} is for a different patch, "
+              "starting over".format(fname), file=sys.stderr)
+        return 0
+    return checkpoint['done']
+
+
+class PatchProgress(object):
+    """Follows a patch as it is applied, committing every `chunk_size`
+    changes and noting in a checkpoint file how many are committed.  With
+    `show`, reports progress on stderr."""
+
+    def __init__(self, total, chunk_size=None, checkpoint=None, digest=None,
+                 show=False, start=0):
+        self.total = total
+        self.chunk_size = chunk_size
+        self.checkpoint = checkpoint
+        self.digest = digest
+        self.show = show
+        self.start = start
+        self.started = self.last_report = time.time()
+
+    def __call__(self, db, done):
+        if self.chunk_size and (done - self.start) % self.chunk_size == 0:
+            db.commit()
+            self.save(done)
+        if self.show and time.time() - self.last_report >= 1:
+            self.report(done)
+
+    def finish(self, db, done):
+        db.commit()
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        if self.show:
+            self.report(done)
+            print("", file=sys.stderr)
+
+    def save(self, done):
+        if not self.checkpoint:
+            return
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as fout:
+            fout.write(json.dumps({'patch': self.digest, 'done': done}))
+        os.rename(tmp, self.checkpoint)
+
+    def report(self, done):
+        now = self.last_report = time.time()
+        rate = (done - self.start) / max(now - self.started, 0.001)
+        eta = '?'
+        if rate > 0:
+            seconds = int(max(self.total - done, 0) / rate)
+            eta = '{}:{:02d}:{:02d}'.format(seconds // 3600,
+                                            (seconds // 60) % 60, seconds % 60)
+        print("\r * {}/{} changes, {:.0f} rows/sec, ETA {}  ".format(
+            done, self.total, rate, eta), file=sys.stderr, end='')
 
 
 def patchsql(sys_args, database=None):
@@ -52,17 +144,59 @@ def patchsql(sys_args, database=None):
                         help='Decode nulls in a reversible way.')
 
     parser.add_argument('--quiet', required=False, action='store_true',
-                       help='Do not show computed diff.')
+                        help='Do not show computed diff.')
+
+    parser.add_argument('--cache-schema', required=False, action='store_true',
+                        help='Keep reflected table metadata on disk for '
+                        'reuse by later runs (in $CATSQL_CACHE_DIR, default '
+                        '~/.cache/catsql).')
+
+    parser.add_argument('--cache-ttl', nargs=1, required=False, default=None,
+                        help='Seconds that cached table metadata stays valid '
+                        '(default: 300).')
+
+    parser.add_argument('--chunk-size', nargs=1, required=False, default=None,
+                        help='Commit after every so many row changes. By '
+                        'default the whole patch is applied in a single '
+                        'transaction.')
+
+    parser.add_argument('--progress', required=False, action='store_true',
+                        help='Report rows changed per second, and time '
+                        'remaining, on stderr.')
+
+    parser.add_argument('--checkpoint', nargs=1, required=False, default=None,
+                        help='File noting how many changes have been '
+                        'committed. If a run is interrupted, running the same '
+                        'patch again with the same checkpoint file resumes '
+                        'after the last commit. Commits every {} changes '
+                        'unless --chunk-size is given.'.format(
+                            CHECKPOINT_CHUNK))
+
+    parser.add_argument('--strategy', required=False, default='rows',
+                        choices=['rows', 'staging'],
+                        help='How to apply changes. "rows" sends them as '
+                        'batches of row-level statements. "staging" loads '
+                        'them into a temporary table and applies them with a '
+                        'few set-based statements, which is faster for large '
+                        'patches.')
 
     args = parser.parse_args(sys_args)
 
     url = args.url
     table = args.schema + '.' + args.table[0] if args.schema else args.table[0]
 
+    if args.strategy == 'staging':
+        helper = StagingHelper()
+    else:
+        helper = SqlAlchemyHelper()
     if database:
-        db = SqlAlchemyDatabase(database)
+        db = SqlAlchemyDatabase(database, helper=helper)
     else:
-        db = SqlAlchemyDatabase(url)
+        cache = None
+        if args.cache_schema:
+            ttl = float(args.cache_ttl[0]) if args.cache_ttl else 300
+            cache = SchemaCache(ttl=ttl)
+        db = SqlAlchemyDatabase(url, cache=cache, helper=helper)
 
     st = daff.SqlTable(db, daff.SqlTableName(table))
 
@@ -74,22 +208,45 @@ def patchsql(sys_args, database=None):
             patch = daff.Coopy.tablify(patch)
 
     if args.follow:
-        with open(args.follow[0], 'rt') as fin:
-            table0 = list(csv.reader(fin))
-            fix_nulls(table0, args.safe_null)
-        with open(args.follow[1], 'rt') as fin:
-            table1 = list(csv.reader(fin))
-            fix_nulls(table1, args.safe_null)
-        patch = daff.Coopy.diff(table0, table1)
-        ansi_patch = daff.Coopy.diffAsAnsi(table0, table1)
+        # rows are merged by key when possible, rather than loaded and aligned
+        patch = keyed_diff(db.tables_metadata[table], args.follow[0],
+                           args.follow[1], args.safe_null)
+        if patch is None:
+            table0 = read_csv(args.follow[0], args.safe_null)
+            table1 = read_csv(args.follow[1], args.safe_null)
+            patch = daff.Coopy.diff(table0, table1)
         if not args.quiet:
-            print(ansi_patch, file=sys.stderr, end='')
+            print(daff.TerminalDiffRender().render(patch), file=sys.stderr,
+                  end='')
 
     if not patch:
         raise KeyError('please specify either --patch or --follow')
 
+    chunk_size = int(args.chunk_size[0]) if args.chunk_size else None
+    checkpoint = args.checkpoint[0] if args.checkpoint else None
+    digest = None
+    start = 0
+    if checkpoint:
+        chunk_size = chunk_size or CHECKPOINT_CHUNK
+        digest = patch_digest(table, args.patch or args.follow)
+        start = load_checkpoint(checkpoint, digest)
+        if start:
+            print(" * resuming after {} changes".format(start),
+                  file=sys.stderr)
+    progress = PatchProgress(count_changes(patch), chunk_size=chunk_size,
+                             checkpoint=checkpoint, digest=digest,
+                             show=args.progress, start=start)
+    db.helper.resume_after = start
+    db.helper.listener = progress
+
     daff_patch = daff.HighlightPatch(st, patch)
-    daff_patch.apply()
+    try:
+        daff_patch.apply()
+        progress.finish(db, db.helper.operations)
+    except BaseException:
+        # anything since the last commit is lost, the checkpoint says so
+        db.rollback()
+        raise
     if db.events['skips'] != 0:
         print(" * {}".format(json.dumps(db.events)),
               file=sys.stderr)
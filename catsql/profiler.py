@@ -0,0 +1,153 @@
+from __future__ import print_function, unicode_literals
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+
+@contextmanager
+def phase(profiler, name):
+    """Time a phase, if there is a profiler."""
+    if profiler is None:
+        yield
+        return
+    with profiler.phase(name):
+        yield
+
+
+class Profiler(object):
+    """Records where the time goes in a run: named phases (connecting,
+    reflecting, counting), and for each table the time spent executing its
+    query, waiting for the first row, fetching rows and formatting them,
+    along with rows read and bytes written.
+
+    Pass one to Database (as `profiler`) to have it and its Filters record
+    into it, then use report() or as_dict() at the end."""
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.tables = OrderedDict()
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._add(self.phases, name, time.time() - start)
+
+    def table(self, table_name):
+        with self.lock:
+            if table_name not in self.tables:
+                self.tables[table_name] = OrderedDict([
+                    ('execute', 0.0), ('first_row', None), ('fetch', 0.0),
+                    ('format', 0.0), ('rows', 0), ('bytes', None)])
+            return self.tables[table_name]
+
+    def timed(self, work):
+        """Wrap work(session, query), as given to Filter._map, to record its
+        time as the execution time of the query's table."""
+        def run(session, query):
+            start = time.time()
+            try:
+                return work(session, query)
+            finally:
+                self._add(self.table(query['table_name']), 'execute',
+                          time.time() - start)
+        return run
+
+    def rows(self, table_name, rows):
+        """Pass rows through, noting how long it takes to execute the query
+        and get the first row, to fetch the rest, and how long is spent
+        between rows (formatting them)."""
+        stats = self.table(table_name)
+        start = time.time()
+        fetch = 0.0
+        count = 0
+        # for a query, this is where it is executed
+        rows = iter(rows)
+        execute = time.time() - start
+        self._add(stats, 'execute', execute)
+        try:
+            while True:
+                before = time.time()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    fetch += time.time() - before
+                    break
+                fetch += time.time() - before
+                count += 1
+                if count == 1:
+                    stats['first_row'] = time.time() - start
+                yield row
+        finally:
+            stats['fetch'] += fetch
+            stats['format'] += time.time() - start - execute - fetch
+            stats['rows'] += count
+
+    def wrote(self, table_name, nbytes):
+        stats = self.table(table_name)
+        stats['bytes'] = (stats['bytes'] or 0) + nbytes
+
+    def as_dict(self):
+        tables = OrderedDict()
+        for table_name, stats in self.tables.items():
+            stats = OrderedDict(stats)
+            seconds = stats['execute'] + stats['fetch'] + stats['format']
+            stats['rows_per_sec'] = (stats['rows'] / seconds if seconds > 0
+                                     else None)
+            tables[table_name] = stats
+        return OrderedDict([('total', time.time() - self.started),
+                            ('phases', self.phases),
+                            ('tables', tables)])
+
+    def report(self, fout):
+        result = self.as_dict()
+        phases = ', '.join('{} {:.3f}s'.format(name, seconds)
+                           for name, seconds in result['phases'].items())
+        print(" * total {:.3f}s{}".format(result['total'],
+                                          ', ' + phases if phases else ''),
+              file=fout)
+        for table_name, stats in result['tables'].items():
+            parts = ['{} rows'.format(stats['rows'])]
+            if stats['execute']:
+                parts.append('execute {:.3f}s'.format(stats['execute']))
+            if stats['first_row'] is not None:
+                parts.append('first row {:.3f}s'.format(stats['first_row']))
+            parts.append('fetch {:.3f}s'.format(stats['fetch']))
+            parts.append('format {:.3f}s'.format(stats['format']))
+            if stats['rows_per_sec'] is not None:
+                parts.append('{:.0f} rows/sec'.format(stats['rows_per_sec']))
+            if stats['bytes'] is not None:
+                parts.append('{} bytes'.format(stats['bytes']))
+            print(" * {}: {}".format(table_name, ', '.join(parts)), file=fout)
+
+    def save(self, fname):
+        with open(fname, 'w') as fout:
+            fout.write(json.dumps(self.as_dict(), indent=2))
+
+    def _add(self, record, key, seconds):
+        with self.lock:
+            record[key] = record.get(key, 0.0) + seconds
+
+
+class CountingWriter(object):
+    """A file-like wrapper counting the bytes written through it."""
+
+    def __init__(self, fout):
+        self.fout = fout
+        self.count = 0
+
+    def write(self, text):
+        if hasattr(text, 'encode'):
+            self.count += len(text.encode('utf-8'))
+        else:
+            self.count += len(text)
+        return self.fout.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.fout, name)
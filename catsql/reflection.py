@@ -0,0 +1,298 @@
+from __future__ import unicode_literals
+from collections import OrderedDict
+from sqlalchemy import (Column, Index, inspect, Table, text, types,
+                        UniqueConstraint)
+from sqlalchemy.exc import DBAPIError, InvalidRequestError
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+# (table, column, type, is-primary-key, is-nullable, length, precision,
+# scale) for every column of a schema, in a single query.
+INFORMATION_SCHEMA_COLUMNS = """
+SELECT c.table_name, c.column_name, c.data_type,
+       CASE WHEN k.column_name IS NULL THEN 0 ELSE 1 END,
+       CASE WHEN c.is_nullable = 'YES' THEN 1 ELSE 0 END,
+       c.character_maximum_length, c.numeric_precision, c.numeric_scale
+FROM information_schema.columns c
+LEFT JOIN (
+  SELECT kcu.table_schema, kcu.table_name, kcu.column_name
+  FROM information_schema.table_constraints tc
+  JOIN information_schema.key_column_usage kcu
+    ON tc.constraint_schema = kcu.constraint_schema
+   AND tc.constraint_name = kcu.constraint_name
+   AND tc.table_name = kcu.table_name
+  WHERE tc.constraint_type = 'PRIMARY KEY'
+) k
+  ON k.table_schema = c.table_schema
+ AND k.table_name = c.table_name
+ AND k.column_name = c.column_name
+WHERE c.table_schema = :schema{names}
+ORDER BY c.table_name, c.ordinal_position
+"""
+
+SQLITE_COLUMNS = """
+SELECT m.name, p.name, p.type, p.pk, NOT p."notnull", NULL, NULL, NULL
+FROM sqlite_master AS m
+JOIN pragma_table_info(m.name) AS p
+WHERE m.type = 'table'{names}
+ORDER BY m.name, p.cid
+"""
+
+# keep well clear of bound parameter limits (999 on older sqlite)
+BULK_CHUNK = 500
+
+
+def resolve_type(dialect, type_name, length=None, precision=None, scale=None):
+    if dialect.name == 'sqlite' and hasattr(dialect, '_resolve_type_affinity'):
+        # the declared type still has its arguments, e.g. VARCHAR(20)
+        return dialect._resolve_type_affinity((type_name or '').upper())
+    names = getattr(dialect, 'ischema_names', {})
+    coltype = names.get(type_name) or names.get((type_name or '').lower())
+    if coltype is None:
+        return types.NullType()
+    kwargs = {}
+    if isinstance(coltype, type):
+        if issubclass(coltype, types.String) and length is not None:
+            kwargs['length'] = int(length)
+        elif (issubclass(coltype, types.Numeric) and
+              not issubclass(coltype, types.Float) and
+              precision is not None):
+            kwargs['precision'] = int(precision)
+            kwargs['scale'] = int(scale or 0)
+        elif (issubclass(coltype, (types.DateTime, types.Time)) and
+              'with time zone' in type_name.lower()):
+            kwargs['timezone'] = True
+    try:
+        return coltype(**kwargs)
+    except TypeError:
+        # needs arguments we don't have, e.g. array item types
+        return types.NullType()
+
+
+class TableCatalog(Mapping):
+    """Tables of a database, reflected only when needed.
+
+    Table names are listed up front with one cheap inspector call.  A table's
+    columns are reflected when it is first looked up.  Looking up many tables
+    at once (see `prefetch`) reads all their columns in a single catalog
+    query when the dialect allows it; tables reflected that way carry column
+    names, types, nullability and primary keys, but not other constraints
+    or indexes until `complete` is called for them.
+
+    Keys match those of the underlying `MetaData.tables`, so are prefixed
+    with the schema when there is one.
+
+    If given a `SchemaCache`, table names and whatever gets reflected are
+    stored there, and a fresh enough entry saves reflecting them again.
+    """
+
+    def __init__(self, engine, metadata, schema=None, only=None, cache=None):
+        self.engine = engine
+        self.metadata = metadata
+        self.schema = schema
+        self.only = only
+        self.cache = cache
+        self._inspector = None
+        self._column_index = None
+        self._fingerprint = None
+        self._cached_time = None
+        self._completed = set()
+        names = self._load_cache()
+        if names is None:
+            names = self.inspector.get_table_names(schema=schema)
+        if only is not None:
+            missing = [name for name in only if name not in names]
+            if missing:
+                s = schema and (" schema '%s'" % schema) or ""
+                raise InvalidRequestError(
+                    "Could not reflect: requested table(s) not available "
+                    "in %r%s: (%s)" % (engine, s, ", ".join(missing)))
+            names = [name for name in names if name in only]
+        self._names = OrderedDict((self._key(name), name) for name in names)
+
+    @property
+    def inspector(self):
+        if self._inspector is None:
+            self._inspector = inspect(self.engine)
+        return self._inspector
+
+    def _load_cache(self):
+        if self.cache is None or not self.cache.usable(self.engine):
+            return None
+        self._fingerprint = self.cache.fingerprint(self.engine, self.schema)
+        entry = self.cache.load(self.engine, self.schema, self.only,
+                                self._fingerprint)
+        if entry is None:
+            return None
+        self._cached_time = entry['time']
+        for key, table in entry['metadata'].tables.items():
+            if key not in self.metadata.tables:
+                table.tometadata(self.metadata)
+        return entry['names']
+
+    def _save_cache(self):
+        if self.cache is None:
+            return
+        self.cache.save(self.engine, self.schema, self.only, self._fingerprint,
+                        list(self._names.values()), self.metadata,
+                        created=self._cached_time)
+
+    def _key(self, name):
+        if self.schema:
+            return '{}.{}'.format(self.schema, name)
+        return name
+
+    def __getitem__(self, key):
+        if key not in self._names:
+            raise KeyError(key)
+        table = self.metadata.tables.get(key)
+        if table is None:
+            table = Table(self._names[key], self.metadata, schema=self.schema,
+                          autoload=True, autoload_with=self.engine)
+            self._save_cache()
+        return table
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, key):
+        return key in self._names
+
+    def keys(self):
+        return list(self._names)
+
+    def values(self):
+        self.prefetch()
+        return [self[key] for key in self._names]
+
+    def items(self):
+        self.prefetch()
+        return [(key, self[key]) for key in self._names]
+
+    def column_index(self):
+        # column name -> keys of the tables that have a column of that name
+        if self._column_index is None:
+            index = {}
+            for key, table in self.items():
+                for name in table.columns.keys():
+                    index.setdefault(name, set()).add(key)
+            self._column_index = index
+        return self._column_index
+
+    def prefetch(self, keys=None):
+        # reflect a batch of tables together, in a single catalog query
+        # where possible
+        if keys is None:
+            keys = self.keys()
+        missing = [key for key in keys
+                   if key in self._names and key not in self.metadata.tables]
+        if len(missing) > 1:
+            if not self._reflect_bulk(missing):
+                self.metadata.reflect(self.engine, schema=self.schema,
+                                      only=[self._names[key]
+                                            for key in missing])
+            self._save_cache()
+
+    def complete(self, key):
+        """Make sure a table carries its unique constraints and indexes,
+        which tables reflected in bulk go without, and return it."""
+        table = self[key]
+        if key in self._completed:
+            return table
+        self._completed.add(key)
+        if len(table.indexes) > 0 or any(
+                isinstance(constraint, UniqueConstraint)
+                for constraint in table.constraints):
+            # fully reflected already
+            return table
+        name = self._names[key]
+        for constraint in self.inspector.get_unique_constraints(
+                name, schema=self.schema):
+            table.append_constraint(UniqueConstraint(
+                *[table.c[column] for column in constraint['column_names']],
+                name=constraint.get('name')))
+        kwargs = {}
+        if self.engine.dialect.name == 'sqlite':
+            # unique column constraints can be missed when parsing a table's
+            # sql, but they always have an index
+            kwargs['include_auto_indexes'] = True
+        for index in self.inspector.get_indexes(name, schema=self.schema,
+                                                **kwargs):
+            if all(column in table.c for column in index['column_names']):
+                Index(index['name'],
+                      *[table.c[column] for column in index['column_names']],
+                      unique=index['unique'])
+        self._save_cache()
+        return table
+
+    def _bulk_query(self):
+        dialect = self.engine.dialect.name
+        if dialect in ['postgresql', 'mysql']:
+            schema = self.schema or self.inspector.default_schema_name
+            return (INFORMATION_SCHEMA_COLUMNS, 'c.table_name',
+                    {'schema': schema})
+        if dialect == 'sqlite' and not self.schema:
+            return SQLITE_COLUMNS, 'm.name', {}
+        return None
+
+    def _bulk_columns(self, names):
+        bulk = self._bulk_query()
+        if bulk is None:
+            return None
+        sql, name_column, params = bulk
+        if len(names) == len(self._names):
+            chunks = [None]
+        else:
+            chunks = [names[i:i + BULK_CHUNK]
+                      for i in range(0, len(names), BULK_CHUNK)]
+        result = []
+        try:
+            with self.engine.connect() as conn:
+                for chunk in chunks:
+                    chunk_params = dict(params)
+                    names_sql = ''
+                    if chunk is not None:
+                        for idx, name in enumerate(chunk):
+                            chunk_params['n{}'.format(idx)] = name
+                        names_sql = ' AND {} IN ({})'.format(
+                            name_column,
+                            ', '.join(':n{}'.format(idx)
+                                      for idx in range(len(chunk))))
+                    rows = conn.execute(text(sql.format(names=names_sql)),
+                                        chunk_params)
+                    result += list(rows)
+        except DBAPIError:
+            # catalog can't be read this way (e.g. sqlite without
+            # table-valued pragmas), fall back on regular reflection
+            return None
+        return result
+
+    def _reflect_bulk(self, keys):
+        names = [self._names[key] for key in keys]
+        rows = self._bulk_columns(names)
+        if rows is None:
+            return False
+        wanted = set(names)
+        columns = OrderedDict()
+        for row in rows:
+            (table_name, column_name, type_name, primary, nullable,
+             length, precision, scale) = row
+            if table_name not in wanted:
+                continue
+            sql_type = resolve_type(self.engine.dialect, type_name,
+                                    length, precision, scale)
+            columns.setdefault(table_name, []).append(
+                Column(column_name, sql_type, primary_key=bool(primary),
+                       nullable=bool(nullable)))
+        for name, cols in columns.items():
+            if self._key(name) in self.metadata.tables:
+                continue
+            Table(name, self.metadata, *cols, schema=self.schema)
+        return True
@@ -0,0 +1,172 @@
+from __future__ import unicode_literals
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+
+from sqlalchemy import select, tuple_
+
+from catsql.cache import default_cache_dir
+from catsql.grep import text_columns
+
+INDEX_VERSION = 1
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS state (table_key TEXT PRIMARY KEY, signature TEXT,
+                                  mark BLOB);
+CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, table_key TEXT,
+                                    pk BLOB, UNIQUE (table_key, pk));
+CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts5(body, tokenize='trigram');
+"""
+
+
+class SearchIndex(object):
+    """A local full-text index of the text columns of a database, for
+    answering repeated --grep searches without scanning remote tables.
+
+    The index lives in a sqlite file (using FTS5's trigram tokenizer, so
+    any fragment of three or more characters can be looked up) under the
+    cache directory, keyed by database url and schema.  It maps text to
+    primary keys, so tables without a primary key are not indexed.
+
+    Tables are brought up to date incrementally before each search, by
+    scanning rows past a high-water mark.  The mark is kept on `column` for
+    tables that have it (e.g. a last-modified timestamp), so updated rows
+    are picked up too.  Otherwise it is kept on the primary key, which only
+    finds new rows; use rebuild() to catch up with updates and deletions.
+    Only tables with `column` are tracked closely enough to narrow a search
+    (see tracks()).
+    """
+
+    def __init__(self, engine, schema=None, column=None, directory=None,
+                 batch_size=5000):
+        self.engine = engine
+        self.schema = schema
+        self.column = column
+        self.batch_size = batch_size
+        directory = directory or default_cache_dir()
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        key = repr((INDEX_VERSION, str(engine.url), schema))
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.path = os.path.join(directory, 'search-{}.sqlite'.format(digest))
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript(SCHEMA_SQL)
+        self.fresh = set()
+
+    def close(self):
+        self.conn.close()
+
+    def rebuild(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM state")
+            self.conn.execute("DELETE FROM entries")
+            self.conn.execute("DELETE FROM terms")
+        self.fresh = set()
+
+    def covers(self, table):
+        return (len(table.primary_key) > 0 and
+                len(text_columns(table.columns)) > 0)
+
+    def tracks(self, table):
+        """Check if changed rows of the table are reindexed on refresh, so a
+        lookup can be trusted to find every row that may match.  Rows where
+        the column is NULL would never be indexed, so it must not allow
+        them."""
+        if (not self.covers(table) or self.column is None or
+                self.column not in table.c):
+            return False
+        column = table.c[self.column]
+        return column.primary_key or not column.nullable
+
+    def refresh(self, table_key, table):
+        """Index any rows of the table added (or updated, for tables with the
+        monotonic column) since the last refresh."""
+        if table_key in self.fresh or not self.covers(table):
+            return
+        keys = list(table.primary_key)
+        columns = text_columns(table.columns)
+        monotonic = self.column is not None and self.column in table.c
+        marks = [table.c[self.column]] if monotonic else keys
+        signature = json.dumps([[column.name for column in part]
+                                for part in [keys, columns, marks]])
+        row = self.conn.execute("SELECT signature, mark FROM state "
+                                "WHERE table_key = ?", (table_key,)).fetchone()
+        mark = None
+        if row is None or row[0] != signature:
+            self._forget(table_key)
+        elif row[1] is not None:
+            mark = pickle.loads(row[1])
+        # labelled, since the same column can play more than one part
+        parts = [('key', keys), ('text', columns), ('mark', marks)]
+        query = select([column.label('{}_{}'.format(part, idx))
+                        for part, group in parts
+                        for idx, column in enumerate(group)]).order_by(*marks)
+        if mark is not None:
+            if monotonic:
+                # rows sharing the last mark may have arrived since, and
+                # indexing a row twice is harmless
+                query = query.where(marks[0] >= mark[0])
+            elif len(marks) == 1:
+                query = query.where(marks[0] > mark[0])
+            else:
+                query = query.where(tuple_(*marks) > tuple_(*mark))
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(query)
+            while True:
+                rows = result.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                with self.conn:
+                    for row in rows:
+                        self._index(table_key, row[:len(keys)],
+                                    row[len(keys):len(keys) + len(columns)])
+                    mark = tuple(rows[-1][len(keys) + len(columns):])
+                    self.conn.execute("INSERT OR REPLACE INTO state "
+                                      "VALUES (?, ?, ?)",
+                                      (table_key, signature,
+                                       pickle.dumps(mark, 2)))
+            if mark is None:
+                with self.conn:
+                    self.conn.execute("INSERT OR REPLACE INTO state "
+                                      "VALUES (?, ?, NULL)",
+                                      (table_key, signature))
+        self.fresh.add(table_key)
+
+    def lookup(self, table_key, sequence):
+        """Primary keys of rows that may contain the sequence, as a list of
+        tuples.  Returns None if the index can't answer (the table isn't
+        indexed, or the sequence is too short to look up)."""
+        if len(sequence) < 3 or table_key not in self.fresh:
+            return None
+        phrase = '"{}"'.format(sequence.replace('"', '""'))
+        rows = self.conn.execute("SELECT entries.pk FROM terms "
+                                 "JOIN entries ON entries.id = terms.rowid "
+                                 "WHERE entries.table_key = ? "
+                                 "AND terms MATCH ?",
+                                 (table_key, phrase))
+        return [pickle.loads(row[0]) for row in rows]
+
+    def _index(self, table_key, key, values):
+        key = pickle.dumps(tuple(key), 2)
+        self.conn.execute("INSERT OR IGNORE INTO entries (table_key, pk) "
+                          "VALUES (?, ?)", (table_key, key))
+        entry = self.conn.execute("SELECT id FROM entries "
+                                  "WHERE table_key = ? AND pk = ?",
+                                  (table_key, key)).fetchone()[0]
+        self.conn.execute("DELETE FROM terms WHERE rowid = ?", (entry,))
+        body = '\n'.join('{}'.format(value) for value in values
+                         if value is not None)
+        self.conn.execute("INSERT INTO terms (rowid, body) VALUES (?, ?)",
+                          (entry, body))
+
+    def _forget(self, table_key):
+        with self.conn:
+            self.conn.execute("DELETE FROM terms WHERE rowid IN "
+                              "(SELECT id FROM entries WHERE table_key = ?)",
+                              (table_key,))
+            self.conn.execute("DELETE FROM entries WHERE table_key = ?",
+                              (table_key,))
+            self.conn.execute("DELETE FROM state WHERE table_key = ?",
+                              (table_key,))
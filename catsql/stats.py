@@ -0,0 +1,43 @@
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+# Row counts as last estimated by the database's planner statistics.
+ESTIMATED_COUNTS = {
+    'postgresql': "SELECT c.relname, c.reltuples "
+                  "FROM pg_catalog.pg_class c "
+                  "JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace "
+                  "WHERE n.nspname = COALESCE(:schema, current_schema()) "
+                  "AND c.relkind IN ('r', 'p')",
+    'mysql': "SELECT TABLE_NAME, TABLE_ROWS FROM information_schema.TABLES "
+             "WHERE TABLE_SCHEMA = COALESCE(:schema, DATABASE())",
+    'sqlite': "SELECT tbl, stat FROM sqlite_stat1",
+}
+
+
+def estimated_counts(engine, schema=None):
+    """Estimated row counts, keyed by table name.  Tables the database has no
+    statistics for (e.g. never analyzed) are left out."""
+    sql = ESTIMATED_COUNTS.get(engine.dialect.name)
+    if sql is None:
+        return {}
+    if engine.dialect.name == 'sqlite' and schema:
+        sql = sql.replace('sqlite_stat1', '"{}".sqlite_stat1'.format(schema))
+    params = {'schema': schema} if ':schema' in sql else {}
+    try:
+        with engine.connect() as conn:
+            rows = list(conn.execute(text(sql), params))
+    except DBAPIError:
+        # e.g. sqlite_stat1 only exists once ANALYZE has been run
+        return {}
+    result = {}
+    for name, estimate in rows:
+        if estimate is None:
+            continue
+        if engine.dialect.name == 'sqlite':
+            # one row per index, each starting with the table's row count
+            estimate = int(str(estimate).split()[0])
+            result[name] = max(estimate, result.get(name, 0))
+        elif estimate >= 0:
+            # postgres uses -1 for tables never vacuumed or analyzed
+            result[name] = int(round(estimate))
+    return result
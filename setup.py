@@ -13,6 +13,7 @@ install_requires = [
 
 if sys.version_info[0] == 2:
     install_requires.append('unicodecsv')
+    install_requires.append('futures')
 
 setup(name="catsql",
       version="0.4.13",
@@ -33,6 +34,9 @@ setup(name="catsql",
           ],
           "mysql": [
               "mysqlclient"
+          ],
+          "parquet": [
+              "pyarrow"
           ]
       },
       tests_require=[
@@ -1,8 +1,17 @@
 from catsql.main import catsql
+import json
+import mock
+import os
+import six
 import unittest
 
 from tests.workspace import Workspace
 
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 
 class TestCommands(unittest.TestCase):
 
@@ -21,6 +30,41 @@ class TestCommands(unittest.TestCase):
         assert self.workspace.output_lines() == 6
         assert len(self.workspace.output_rows()) == 5
 
+    def test_batch_size(self):
+        catsql([self.workspace.number_db, "--batch-size", "2",
+                "--output", self.workspace.output_file, "--csv"])
+        assert len(self.workspace.output_rows()) == 5
+
+    def test_cache_schema(self):
+        cache_dir = self.workspace.filename('cache')
+        with mock.patch.dict(os.environ, {'CATSQL_CACHE_DIR': cache_dir}):
+            for _ in range(2):
+                catsql([self.workspace.number_db, "--cache-schema",
+                        "--output", self.workspace.output_file, "--csv"])
+        assert len(os.listdir(cache_dir)) == 1
+        assert len(self.workspace.output_rows()) == 5
+
+    def test_jobs(self):
+        self.workspace.add_product_table()
+        catsql([self.workspace.number_db, "--jobs", "2",
+                "--output", self.workspace.output_file])
+        text = self.workspace.output_text()
+        assert text.index('== product ==') < text.index('== sheet ==')
+        assert self.workspace.output_lines() == 8 + 7
+
+    def test_jobs_count(self):
+        self.workspace.add_product_table()
+        catsql([self.workspace.number_db, "--jobs", "2", "--count",
+                "--output", self.workspace.output_file])
+        text = self.workspace.output_text()
+        assert '(3 rows)' in text
+        assert '(5 rows)' in text
+
+    def test_approx_count(self):
+        catsql([self.workspace.number_db, "--approx-count",
+                "--output", self.workspace.output_file])
+        assert '(5 rows)' in self.workspace.output_text()
+
     def test_column_value(self):
         catsql([self.workspace.number_db, "--NAME", "one", "--output", self.workspace.output_file, "--csv"])
         assert self.workspace.output_lines() == 2
@@ -30,6 +74,18 @@ class TestCommands(unittest.TestCase):
         assert result['NAME'] == 'one'
         assert result['DIGIT'] == '1'
 
+    def test_column_value_equals(self):
+        catsql([self.workspace.number_db, "--NAME=two",
+                "--output", self.workspace.output_file, "--csv"])
+        result = self.workspace.output_rows()
+        assert len(result) == 1
+        assert result[0]['DIGIT'] == '2'
+
+    def test_unknown_column(self):
+        with self.assertRaises(SystemExit):
+            catsql([self.workspace.number_db, "--COLOR", "green",
+                    "--output", self.workspace.output_file])
+
     def test_row_condition(self):
         catsql([self.workspace.number_db, "--sql", "NAME = 'one' or NAME = 'two'",
                 "--output", self.workspace.output_file, "--csv"])
@@ -45,6 +101,102 @@ class TestCommands(unittest.TestCase):
         assert len(result) == 1
         assert result[0]['DIGIT'] == '3'
 
+    def test_grep_mode(self):
+        catsql([self.workspace.number_db, "--grep", "fo",
+                "--grep-mode", "prefix",
+                "--output", self.workspace.output_file, "--csv"])
+        result = self.workspace.output_rows()
+        assert len(result) == 1
+        assert result[0]['DIGIT'] == '4'
+
+    def test_page(self):
+        self.workspace.add_product_table()
+        args = [self.workspace.number_db, "--table", "product",
+                "--page-size", "2", "--output", self.workspace.output_file,
+                "--csv"]
+        with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+            catsql(args)
+        rows = self.workspace.output_rows()
+        self.assertEqual([row['DIGIT'] for row in rows], ['1', '2'])
+        token = err.getvalue().split('--after ')[1].strip()
+        self.workspace.output_text_cache = None
+        with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+            catsql(args + ["--after", token])
+        rows = self.workspace.output_rows()
+        self.assertEqual([row['DIGIT'] for row in rows], ['3'])
+        self.assertNotIn('--after', err.getvalue())
+
+    def test_page_needs_key(self):
+        self.workspace.add_product_table()
+        with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+            catsql([self.workspace.number_db, "--table", "product,sheet",
+                    "--page-size", "2",
+                    "--output", self.workspace.output_file])
+        self.assertIn('sheet: no unique key to page by, skipped',
+                      err.getvalue())
+        self.assertIn('--after', err.getvalue())
+
+    def test_sample(self):
+        catsql([self.workspace.number_db, "--sample", "3",
+                "--output", self.workspace.output_file, "--csv"])
+        rows = self.workspace.output_rows()
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(set(row['NAME'] for row in rows) <=
+                        set(['one', 'two', 'thrEE', 'foUR', 'five']))
+
+    def test_explain(self):
+        catsql([self.workspace.number_db, "--grep", "thr", "--explain",
+                "--output", self.workspace.output_file])
+        self.assertIn('full scan of sheet', self.workspace.output_text())
+        self.assertNotIn('thrEE', self.workspace.output_text())
+
+    def test_profile(self):
+        report = self.workspace.filename('profile.json')
+        with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+            catsql([self.workspace.number_db, "--profile",
+                    "--profile-json", report,
+                    "--output", self.workspace.output_file, "--csv"])
+        self.assertIn('sheet: 5 rows', err.getvalue())
+        with open(report) as fin:
+            result = json.load(fin)
+        self.assertIn('connect', result['phases'])
+        self.assertIn('reflect', result['phases'])
+        self.assertEqual(result['tables']['sheet']['rows'], 5)
+        self.assertEqual(result['tables']['sheet']['bytes'],
+                         len(self.workspace.output_text()))
+
+    def test_max_rows(self):
+        with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+            with self.assertRaises(SystemExit) as status:
+                catsql([self.workspace.number_db, "--max-rows", "2",
+                        "--timeout", "10",
+                        "--output", self.workspace.output_file, "--csv"])
+        self.assertEqual(status.exception.code, 1)
+        self.assertEqual(len(self.workspace.output_rows()), 2)
+        self.assertIn('sheet: more than 2 rows', err.getvalue())
+
+    def test_grep_index(self):
+        self.workspace.add_product_table()
+        cache_dir = self.workspace.filename('cache')
+        with mock.patch.dict(os.environ, {'CATSQL_CACHE_DIR': cache_dir}):
+            for _ in range(2):
+                catsql([self.workspace.number_db, "--grep", "...",
+                        "--grep-index", "--grep-index-column", "DIGIT",
+                        "--table", "product",
+                        "--output", self.workspace.output_file, "--csv"])
+        assert len(os.listdir(cache_dir)) == 1
+        assert len(self.workspace.output_rows()) == 1
+
+    def test_grep_index_needs_column(self):
+        self.workspace.add_product_table()
+        cache_dir = self.workspace.filename('cache')
+        with mock.patch.dict(os.environ, {'CATSQL_CACHE_DIR': cache_dir}):
+            catsql([self.workspace.number_db, "--grep", "...", "--grep-index",
+                    "--table", "product",
+                    "--output", self.workspace.output_file, "--csv"])
+        assert not os.path.exists(cache_dir)
+        assert len(self.workspace.output_rows()) == 1
+
     def test_json_basic(self):
         catsql([self.workspace.number_db, "--json", self.workspace.output_file])
         result = self.workspace.output_json()
@@ -56,22 +208,109 @@ class TestCommands(unittest.TestCase):
         result = self.workspace.output_json()
         assert result['count'] == 5
 
+    def test_ndjson(self):
+        catsql([self.workspace.number_db,
+                "--ndjson", self.workspace.output_file])
+        lines = self.workspace.output_text().splitlines()
+        assert len(lines) == 5
+        assert json.loads(lines[1]) == {'NAME': 'foUR', 'DIGIT': 4}
+
+    def test_ndjson_stdout(self):
+        catsql([self.workspace.number_db, "--ndjson", "-", "--NAME", "two",
+                "--output", self.workspace.output_file])
+        assert self.workspace.output_json() == {'NAME': 'two', 'DIGIT': 2}
+
+    def test_ndjson_before_url(self):
+        catsql(["--ndjson", self.workspace.output_file,
+                self.workspace.number_db, "--NAME", "two"])
+        assert self.workspace.output_json() == {'NAME': 'two', 'DIGIT': 2}
+
     def test_types(self):
         catsql([self.workspace.number_db, "--types", "--json", self.workspace.output_file])
         result = self.workspace.output_json()
         assert result['results'][0]['DIGIT'] == 'INTEGER'
 
+    def test_types_terse(self):
+        catsql([self.workspace.number_db, "--types", "--terse",
+                "--NAME", "one", "--output", self.workspace.output_file,
+                "--csv"])
+        assert self.workspace.output_rows() == [{'DIGIT': 'INTEGER'}]
+
+    def test_types_float(self):
+        fname = self.workspace.filename('ratios.csv')
+        with open(fname, 'w') as fout:
+            fout.write("NAME,RATIO\none,0.5\n")
+        catsql([fname, "--types", "--json", self.workspace.output_file])
+        result = self.workspace.output_json()
+        assert result['results'][0]['RATIO'] == 'FLOAT'
+
     def test_sqlite_basic(self):
         catsql([self.workspace.number_db, "--sqlite", self.workspace.output_file_sql])
         catsql([self.workspace.output_file_sql, "--json", self.workspace.output_file])
         result = self.workspace.output_json()
         assert result['count'] == 5
 
+    def test_sqlite_filtered(self):
+        for _ in range(2):
+            catsql([self.workspace.number_db, "--sql", "DIGIT > 2",
+                    "--column", "DIGIT,NAME",
+                    "--sqlite", self.workspace.output_file_sql])
+        catsql([self.workspace.output_file_sql, "--json", self.workspace.output_file])
+        result = self.workspace.output_json()
+        assert result['count'] == 2
+        assert list(result['results'][0].keys()) == ['DIGIT', 'NAME']
+
+    def test_sqlite_fetched(self):
+        catsql([self.workspace.number_db, "--jobs", "2",
+                "--sqlite", self.workspace.output_file_sql])
+        catsql([self.workspace.output_file_sql,
+                "--json", self.workspace.output_file, "--NAME", "five"])
+        result = self.workspace.output_json()
+        assert result['count'] == 1
+        assert result['results'][0]['DIGIT'] is None
+
     def test_excel_basic(self):
         catsql([self.workspace.number_db, "--excel", self.workspace.output_file_excel])
         result = self.workspace.output_excel()
         assert len(list(result.active)) == 5 + 1
 
+    @mock.patch('catsql.export.EXCEL_MAX_ROWS', 3)
+    def test_excel_split(self):
+        catsql([self.workspace.number_db, "--excel", self.workspace.output_file_excel])
+        result = self.workspace.output_excel()
+        assert len(list(result.active)) == 3
+        catsql([self.workspace.number_db,
+                "--excel", self.workspace.output_file_excel, "--excel-split"])
+        result = self.workspace.output_excel()
+        assert result.sheetnames == ['sheet', 'sheet_2', 'sheet_3']
+        assert [len(list(ws)) for ws in result] == [3, 3, 2]
+
+    @unittest.skipIf(pyarrow is None, 'needs pyarrow')
+    def test_parquet(self):
+        fname = self.workspace.filename('output.parquet')
+        catsql([self.workspace.number_db, "--parquet", fname,
+                "--row-group-size", "2"])
+        result = pyarrow.parquet.ParquetFile(fname)
+        assert result.num_row_groups == 3
+        assert str(result.schema_arrow.field('DIGIT').type) == 'int64'
+        assert result.read().column('NAME').to_pylist()[0] == 'five'
+
+    @unittest.skipIf(pyarrow is None, 'needs pyarrow')
+    def test_parquet_types(self):
+        fname = self.workspace.filename('output.parquet')
+        catsql([self.workspace.number_db, "--types", "--parquet", fname])
+        result = pyarrow.parquet.read_table(fname)
+        assert result.to_pylist() == [{'NAME': 'TEXT', 'DIGIT': 'INTEGER'}]
+
+    @unittest.skipIf(pyarrow is None, 'needs pyarrow')
+    def test_arrow(self):
+        fname = self.workspace.filename('output.arrow')
+        catsql([self.workspace.number_db, "--arrow", fname,
+                "--column", "DIGIT"])
+        result = pyarrow.ipc.open_file(fname).read_all()
+        assert result.column_names == ['DIGIT']
+        assert result.num_rows == 5
+
     def test_terse_kv(self):
         catsql([self.workspace.number_db, "--terse",
                 "--value", "DIGIT=4",
@@ -81,6 +320,12 @@ class TestCommands(unittest.TestCase):
         assert 'NAME' in result['results'][0]
         assert 'DIGIT' not in result['results'][0]
 
+    def test_terse_csv(self):
+        catsql([self.workspace.number_db, "--terse", "--safe-null",
+                "--NAME", "five", "--output", self.workspace.output_file,
+                "--csv"])
+        assert self.workspace.output_rows() == [{'DIGIT': 'NULL'}]
+
     def test_terse_direct(self):
         catsql([self.workspace.number_db, "--terse",
                 "--DIGIT", "4",
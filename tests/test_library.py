@@ -1,7 +1,17 @@
 from __future__ import unicode_literals
 
 import catsql
+from catsql.budget import timed_out
+from catsql.cache import SchemaCache
+from catsql.database import Database
+from catsql.explain import sqlite_plan
+from catsql.profiler import Profiler
+from catsql.search_index import SearchIndex
+import itertools
 import json
+import mock
+import six
+import sqlite3
 import unittest
 
 from tests.workspace import Workspace
@@ -37,6 +47,184 @@ class TestLibrary(unittest.TestCase):
         self.assertEquals(len(q), 1)
         self.assertEquals(len(q.rows.all()), 2)
 
+    def test_stream(self):
+        q = catsql.connect(self.workspace.number_db)
+        q.order()
+        q.stream(2)
+        self.assertEquals(len(q), 1)
+        self.assertEquals([row.NAME for row in q.rows],
+                          ['five', 'foUR', 'one', 'thrEE', 'two'])
+
+    def test_page(self):
+        self.workspace.add_product_table()
+        conn = sqlite3.connect(self.workspace.number_file)
+        conn.executescript("INSERT INTO product VALUES "
+                           "(4, '..'), (5, '..'), (6, '.');")
+        conn.close()
+        codes = []
+        token = None
+        while True:
+            q = catsql.connect(self.workspace.number_db, tables=['product'],
+                               columns=['CODE'])
+            q.page(2, after=token)
+            rows = list(q.rows)
+            codes += [row.CODE for row in rows]
+            last = rows[-1] if rows else None
+            token = q.page_token({'product': (len(rows), last)})
+            if token is None:
+                break
+        # ordered by the key, even though it isn't shown, so no ties are lost
+        self.assertEquals(codes, ['.', '..', '...', '..', '..', '.'])
+
+    def test_page_needs_key(self):
+        self.workspace.add_product_table()
+        conn = sqlite3.connect(self.workspace.number_file)
+        conn.executescript("CREATE TABLE tag "
+                           "(NAME VARCHAR(10) NOT NULL UNIQUE);"
+                           "INSERT INTO tag VALUES ('b'), ('a');")
+        conn.close()
+        q = catsql.connect(self.workspace.number_db)
+        with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+            q.page(1)
+        self.assertEquals(err.getvalue().strip(),
+                          '* sheet: no unique key to page by, skipped')
+        rows = dict((t['table_name'], list(t['rows'])) for t in q)
+        self.assertEquals(sorted(rows), ['product', 'tag'])
+        self.assertEquals([row.NAME for row in rows['tag']], ['a'])
+
+    def test_sample(self):
+        self.workspace.add_product_table()
+        conn = sqlite3.connect(self.workspace.number_file)
+        inserts = ["INSERT INTO big VALUES ({0}, 'v{0}');".format(i)
+                   for i in range(1, 1001)]
+        conn.executescript("BEGIN; CREATE TABLE big (ID INTEGER PRIMARY KEY, "
+                           "V TEXT);" + "".join(inserts) + "COMMIT;")
+        conn.close()
+        q = catsql.connect(self.workspace.number_db)
+        q.sample(2)
+        self.assertEquals(len(q), 3)
+        for query in q:
+            rows = list(query['rows'])
+            self.assertEquals(len(rows), 2)
+            self.assertEquals(len(set(rows)), 2)
+        q = Database(self.workspace.number_db, tables=['big']).query()
+        q.sample(200)
+        # 800 keys are looked up, none of them as bound parameters
+        self.assertEquals(list(q[0]['rows'].statement.compile().params),
+                          ['param_1'])
+        rows = list(q.rows)
+        self.assertEquals(len(rows), 200)
+        self.assertEquals(len(set(rows)), 200)
+        q = Database(self.workspace.number_db, tables=['big']).query()
+        q.sample(pct=50)
+        self.assertTrue(300 < len(list(q.rows)) < 700)
+
+    def test_explain(self):
+        self.workspace.add_product_table()
+        q = catsql.connect(self.workspace.number_db)
+        q.where_sql('DIGIT = 2')
+        plans = q.explain()
+        self.assertEquals([plan['table_name'] for plan in plans],
+                          ['product', 'sheet'])
+        self.assertEquals(plans[0]['scans'], [])
+        self.assertEquals(plans[1]['scans'], ['sheet'])
+
+    def test_explain_typed_columns(self):
+        conn = sqlite3.connect(self.workspace.number_file)
+        # the plan's detail column lines up with AT
+        conn.executescript("CREATE TABLE event (ID INTEGER PRIMARY KEY, "
+                           "PRICE NUMERIC(10, 2), NAME TEXT, AT DATETIME);"
+                           "INSERT INTO event VALUES "
+                           "(1, 1.5, 'x', '2020-01-01 00:00:00');")
+        conn.close()
+        q = catsql.connect(self.workspace.number_db, tables=['event'])
+        q.where_kv({'ID': 1})
+        plans = q.explain()
+        self.assertEquals(plans[0]['scans'], [])
+        self.assertIn('event', plans[0]['plan'][0])
+
+    def test_explain_sqlite_plan(self):
+        # older sqlite says "SCAN TABLE x"
+        plan = sqlite_plan([(2, 0, 0, 'SCAN TABLE sheet'),
+                            (3, 0, 0, 'SCAN product')])
+        self.assertEquals(plan['scans'], ['sheet', 'product'])
+
+    def test_profile(self):
+        self.workspace.add_product_table()
+        profiler = Profiler()
+        q = Database(self.workspace.number_db, profiler=profiler).query()
+        self.assertEquals(sorted(len(list(t['rows']))
+                                 for t in q.fetch(jobs=2)), [3, 5])
+        self.assertEquals(sorted(profiler.tables), ['product', 'sheet'])
+        self.assertEquals(profiler.tables['sheet']['rows'], 5)
+        self.assertTrue(profiler.tables['sheet']['execute'] > 0)
+        self.assertIn('reflect', profiler.phases)
+
+    def test_max_rows(self):
+        self.workspace.add_product_table()
+        q = Database(self.workspace.number_db, max_rows=3).query()
+        q.order()
+        with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+            rows = dict((t['table_name'], list(t['rows'])) for t in q)
+        self.assertEquals(len(rows['product']), 3)
+        self.assertEquals([row.NAME for row in rows['sheet']],
+                          ['five', 'foUR', 'one'])
+        self.assertEquals(err.getvalue().strip(),
+                          '* sheet: more than 3 rows, cut short')
+        self.assertEquals(q.cut_short, ['sheet'])
+
+    def test_timeout(self):
+        self.workspace.add_product_table()
+        conn = sqlite3.connect(self.workspace.number_file)
+        inserts = ["INSERT INTO big VALUES ({0}, 'v{0}');".format(i)
+                   for i in range(1, 2001)]
+        conn.executescript("BEGIN; CREATE TABLE big (ID INTEGER PRIMARY KEY, "
+                           "V TEXT);" + "".join(inserts) + "COMMIT;")
+        conn.close()
+        clock = mock.Mock()
+        # every look at the clock is a second later
+        clock.time.side_effect = itertools.count()
+        with mock.patch('catsql.budget.time', clock):
+            q = Database(self.workspace.number_db, timeout=0.5,
+                         tables=['big', 'product']).query()
+            with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+                rows = dict((t['table_name'], list(t['rows'])) for t in q)
+        self.assertEquals(rows['big'], [])
+        self.assertEquals(len(rows['product']), 3)
+        self.assertIn('big: over the 0.5s timeout, skipped', err.getvalue())
+        self.assertEquals(q.cut_short, ['big'])
+
+    def test_timeout_counts_database_time(self):
+        conn = sqlite3.connect(self.workspace.number_file)
+        inserts = ["INSERT INTO big VALUES ({0}, 'v{0}');".format(i)
+                   for i in range(1, 2001)]
+        conn.executescript("BEGIN; CREATE TABLE big (ID INTEGER PRIMARY KEY, "
+                           "V TEXT);" + "".join(inserts) + "COMMIT;")
+        conn.close()
+        now = [0]
+        clock = mock.Mock()
+        clock.time.side_effect = lambda: now[0]
+        with mock.patch('catsql.budget.time', clock):
+            q = Database(self.workspace.number_db, timeout=0.5,
+                         tables=['big']).query()
+            q.stream(10)
+            with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+                count = 0
+                for table in q:
+                    for row in table['rows']:
+                        # a slow reader, which the database shouldn't pay for
+                        now[0] += 1
+                        count += 1
+        self.assertEquals(count, 2000)
+        self.assertEquals(err.getvalue(), '')
+        self.assertEquals(q.cut_short, [])
+
+    def test_timed_out(self):
+        self.assertTrue(timed_out(sqlite3.OperationalError('interrupted')))
+        self.assertFalse(timed_out(
+            sqlite3.OperationalError('no such table: interrupted')))
+        self.assertFalse(timed_out(ValueError('interrupted')))
+
     def test_grep(self):
         q = catsql.connect(self.workspace.number_db)
         q.grep('wo')
@@ -44,6 +232,136 @@ class TestLibrary(unittest.TestCase):
         self.assertEquals(len(q.rows.all()), 1)
         self.assertEquals(q.row.NAME, 'two')
 
+    def test_grep_no_concat(self):
+        q = catsql.connect(self.workspace.number_db)
+        q.grep('e // ')
+        self.assertEquals(len(q.rows.all()), 0)
+        q = catsql.connect(self.workspace.number_db)
+        q.grep('e // ', mode='concat')
+        self.assertEquals(len(q.rows.all()), 3)
+
+    def test_grep_exact(self):
+        q = catsql.connect(self.workspace.number_db)
+        q.grep('tw', mode='exact')
+        self.assertEquals(len(q.rows.all()), 0)
+        q = catsql.connect(self.workspace.number_db)
+        q.grep('two', mode='exact')
+        self.assertEquals(q.row.DIGIT, 2)
+
+    def test_grep_prefix(self):
+        q = catsql.connect(self.workspace.number_db)
+        q.grep('f', mode='prefix')
+        self.assertEquals(sorted(row.NAME for row in q.rows), ['five', 'foUR'])
+        q = catsql.connect(self.workspace.number_db)
+        q.grep('_', mode='prefix')
+        self.assertEquals(len(q.rows.all()), 0)
+
+    def test_grep_prefix_index(self):
+        conn = sqlite3.connect(self.workspace.number_file)
+        conn.executescript("CREATE INDEX sheet_name ON sheet "
+                           "(NAME COLLATE NOCASE);")
+        conn.close()
+        q = catsql.connect(self.workspace.number_db)
+        q.grep('F', mode='prefix')
+        self.assertEquals(q.explain()[0]['scans'], [])
+        self.assertEquals(sorted(row.NAME for row in q.rows), ['five', 'foUR'])
+
+    def test_grep_text_columns_only(self):
+        self.workspace.add_product_table()
+        q = catsql.connect(self.workspace.number_db, columns=['DIGIT'])
+        q.grep('2')
+        self.assertEquals(len(q), 0)
+
+    def test_grep_fulltext(self):
+        self.workspace.add_fulltext_index()
+        q = catsql.connect(self.workspace.number_db, tables=['sheet'])
+        q.grep('three', mode='fulltext')
+        self.assertIn('sheet_fts', str(q.rows))
+        self.assertEquals(q.row.DIGIT, 3)
+
+    def test_grep_fulltext_fallback(self):
+        q = catsql.connect(self.workspace.number_db)
+        q.grep('hre', mode='fulltext')
+        self.assertEquals(q.row.DIGIT, 3)
+
+    def test_grep_index(self):
+        self.workspace.add_product_table()
+        conn = sqlite3.connect(self.workspace.number_file)
+        conn.executescript("ALTER TABLE product ADD COLUMN "
+                           "STAMP INTEGER NOT NULL DEFAULT 1;")
+        conn.close()
+        directory = self.workspace.filename('cache')
+        db = Database(self.workspace.number_db)
+        index = SearchIndex(db.engine, column='STAMP', directory=directory)
+        q = db.query()
+        q.grep('...', index=index)
+        self.assertEquals(len(q), 2)
+        self.assertEquals(index.lookup('product', '...'), [(3,)])
+        self.assertEquals(index.lookup('sheet', 'thr'), None)
+        self.assertEquals([row.DIGIT for row in q[0]['rows']], [3])
+        conn = sqlite3.connect(self.workspace.number_file)
+        conn.executescript("INSERT INTO product VALUES (4, '....', 2);"
+                           "UPDATE product SET CODE = 'x', STAMP = 2 "
+                           "WHERE DIGIT = 3;")
+        conn.close()
+        db = Database(self.workspace.number_db, tables=['product'])
+        index = SearchIndex(db.engine, column='STAMP', directory=directory)
+        q = db.query()
+        q.grep('...', index=index)
+        self.assertEquals(index.lookup('product', '...'), [(4,)])
+        self.assertEquals([row.DIGIT for row in q.rows], [4])
+
+    def test_grep_index_nullable_column(self):
+        # rows with no mark would never be indexed
+        self.workspace.add_product_table()
+        conn = sqlite3.connect(self.workspace.number_file)
+        conn.executescript("ALTER TABLE product ADD COLUMN STAMP INTEGER;"
+                           "UPDATE product SET STAMP = 1 WHERE DIGIT > 1;")
+        conn.close()
+        db = Database(self.workspace.number_db, tables=['product'])
+        index = SearchIndex(db.engine, column='STAMP',
+                            directory=self.workspace.filename('cache'))
+        q = db.query()
+        self.assertFalse(index.tracks(q[0]['table']))
+        q.grep('.', index=index)
+        self.assertEquals([row.DIGIT for row in q.rows], [1, 2, 3])
+
+    def test_grep_index_untracked(self):
+        # without a column to find updated rows, the index can't narrow a
+        # search
+        self.workspace.add_product_table()
+        directory = self.workspace.filename('cache')
+        db = Database(self.workspace.number_db, tables=['product'])
+        index = SearchIndex(db.engine, directory=directory)
+        index.refresh('product', db.query()[0]['table'])
+        conn = sqlite3.connect(self.workspace.number_file)
+        conn.executescript("UPDATE product SET CODE = '....' WHERE DIGIT = 1;")
+        conn.close()
+        q = db.query()
+        q.grep('....', index=index)
+        self.assertEquals(index.lookup('product', '....'), [])
+        self.assertEquals([row.DIGIT for row in q.rows], [1])
+
+    def test_csv(self):
+        fname = self.workspace.filename('numbers.csv')
+        with open(fname, 'w') as fout:
+            fout.write("NAME,DIGIT,RATIO\n"
+                       "one,1,0.5\n"
+                       "two,2,1.5\n"
+                       "three,,x\n"
+                       "\n"
+                       "four,4\n"
+                       "\n")
+        for limit in [None, 0]:
+            db = Database(fname, csv_memory_limit=limit)
+            self.assertEquals(db.engine.url.database is None, limit is None)
+            q = db.query()
+            self.assertEquals([str(c.type) for c in q[0]['table'].columns],
+                              ['INTEGER', 'VARCHAR', 'INTEGER', 'FLOAT'])
+            self.assertEquals([tuple(row) for row in q.rows],
+                              [(1, 'one', 1, 0.5), (2, 'two', 2, 1.5),
+                               (3, 'three', '', 'x'), (4, 'four', 4, None)])
+
     def test_where_sql(self):
         q = catsql.connect(self.workspace.number_db)
         q.where_sql('DIGIT = 2')
@@ -58,6 +376,24 @@ class TestLibrary(unittest.TestCase):
         self.assertEquals(len(q[0]['rows'].all()), 1)
         self.assertEquals(q.row.DIGIT, 4)
 
+    def test_where_sql_unknown_column(self):
+        q = catsql.connect(self.workspace.number_db)
+        q.where_sql('COLOR = "green"')
+        self.assertEquals(len(q), 0)
+
+    def test_where_sql_unknown_word(self):
+        q = catsql.connect(self.workspace.number_db)
+        q.where_sql("NAME = 'ONE' COLLATE NOCASE")
+        self.assertEquals(len(q), 1)
+        self.assertEquals(q.row.DIGIT, 1)
+
+    def test_where_sql_subquery(self):
+        self.workspace.add_product_table()
+        q = catsql.connect(self.workspace.number_db)
+        q.where_sql('DIGIT in (select DIGIT from product where CODE = "..")')
+        self.assertEquals(len(q), 2)
+        self.assertEquals(len(q[1]['rows'].all()), 1)
+
     def test_where_kv(self):
         q = catsql.connect(self.workspace.number_db)
         q.where_kv({'DIGIT': 4})
@@ -108,12 +444,71 @@ class TestLibrary(unittest.TestCase):
         q = catsql.connect(self.workspace.number_db, tables=['more'])
         self.assertEquals(len(q), 1)
 
+    def test_fetch_parallel(self):
+        self.workspace.add_product_table()
+        q = catsql.connect(self.workspace.number_db)
+        q.where_sql('DIGIT > 1')
+        results = [(t['table_name'], len(list(t['rows'])))
+                   for t in q.fetch(jobs=2)]
+        self.assertEquals(results, [('product', 2), ('sheet', 3)])
+
+    @mock.patch('catsql.filter.FETCH_BATCH', 2)
+    @mock.patch('catsql.filter.FETCH_QUEUE', 1)
+    def test_fetch_parallel_streams(self):
+        self.workspace.add_product_table()
+        self.workspace.numbers(self.workspace.number_file, 'more')
+        q = catsql.connect(self.workspace.number_db)
+        results = q.fetch(jobs=2)
+        more = next(results)
+        self.assertEquals(more['table_name'], 'more')
+        # later batches wait until earlier ones are read
+        self.assertEquals(len([next(more['rows']) for _ in range(3)]), 3)
+        self.assertEquals([(t['table_name'], len(list(t['rows'])))
+                           for t in results],
+                          [('product', 3), ('sheet', 5)])
+        # rows not read before moving on are dropped
+        with self.assertRaises(RuntimeError):
+            list(more['rows'])
+
+    def test_counts_parallel(self):
+        self.workspace.add_product_table()
+        q = catsql.connect(self.workspace.number_db)
+        self.assertEquals(q.counts(jobs=2), {'product': 3, 'sheet': 5})
+
+    def test_counts_filtered(self):
+        self.workspace.add_product_table()
+        q = catsql.connect(self.workspace.number_db)
+        q.where_sql('DIGIT > 1')
+        self.assertEquals(q.counts(), {'product': 2, 'sheet': 3})
+
+    def test_counts_approx(self):
+        self.workspace.add_product_table()
+        self.workspace.analyze()
+        self.workspace.numbers(self.workspace.number_file)  # stats now stale
+        q = catsql.connect(self.workspace.number_db,
+                           tables=['product', 'sheet'])
+        self.assertEquals(q.counts(approx=True), {'product': 3, 'sheet': 5})
+        self.assertEquals(q.counts(), {'product': 3, 'sheet': 10})
+        q.where_sql('DIGIT > 1')
+        self.assertEquals(q.counts(approx=True), {'product': 2, 'sheet': 6})
+
     def test_where_kv_multiple_tables(self):
         self.workspace.add_product_table()
         q = catsql.connect(self.workspace.number_db)
         q.where_kv({'CODE': '.'})
         self.assertEquals(len(q), 1)
 
+    def test_where_kv_prunes_tables(self):
+        self.workspace.add_product_table()
+        db = Database(self.workspace.number_db)
+        index = db.tables_metadata.column_index()
+        self.assertEquals(index['DIGIT'], set(['product', 'sheet']))
+        self.assertEquals(index['CODE'], set(['product']))
+        q = db.query()
+        q.where_kv_with_expansion({'CODE': '..'})
+        self.assertEquals([t['table_name'] for t in q], ['product'])
+        self.assertEquals(q.row.DIGIT, 2)
+
     def test_where_kv_with_expansion_multiple_tables(self):
         self.workspace.add_product_table()
         q = catsql.connect(self.workspace.number_db)
@@ -137,3 +532,52 @@ class TestLibrary(unittest.TestCase):
         q = catsql.connect(self.workspace.number_db)
         q.where_sql('CODE = "."')
         self.assertEquals(len(q), 1)
+
+    def test_lazy_reflection(self):
+        self.workspace.add_product_table()
+        db = Database(self.workspace.number_db)
+        self.assertEquals(sorted(db.tables_metadata.keys()),
+                          ['product', 'sheet'])
+        q = db.query()
+        self.assertEquals(len(db.Base.metadata.tables), 0)
+        self.assertEquals(len(q), 2)
+        self.assertEquals(sorted(db.Base.metadata.tables),
+                          ['product', 'sheet'])
+        product = q[0]['table']
+        self.assertEquals(list(product.primary_key.columns.keys()), ['DIGIT'])
+        self.assertEquals(str(product.c['CODE'].type), 'TEXT')
+
+    def test_bulk_reflection_details(self):
+        conn = sqlite3.connect(self.workspace.number_file)
+        conn.executescript("CREATE TABLE tag "
+                           "(NAME VARCHAR(20) NOT NULL UNIQUE, "
+                           "PRICE NUMERIC(10, 2));")
+        conn.close()
+        db = Database(self.workspace.number_db)
+        self.assertEquals(len(db.query()), 2)
+        tag = db.tables_metadata['tag']
+        self.assertEquals(str(tag.c['NAME'].type), 'VARCHAR(20)')
+        self.assertEquals(str(tag.c['PRICE'].type), 'NUMERIC(10, 2)')
+        self.assertFalse(tag.c['NAME'].nullable)
+        self.assertTrue(tag.c['PRICE'].nullable)
+        db.tables_metadata.complete('tag')
+        self.assertEquals([list(index.columns.keys()) for index in tag.indexes
+                           if index.unique], [['NAME']])
+
+    def test_schema_cache(self):
+        cache = SchemaCache(self.workspace.filename('cache'))
+        db = Database(self.workspace.number_db, cache=cache)
+        self.assertEquals(len(db.query()), 1)
+        db = Database(self.workspace.number_db, cache=cache)
+        self.assertIn('sheet', db.Base.metadata.tables)
+        self.assertEquals(len(db.query().rows.all()), 5)
+        self.workspace.add_product_table()
+        db = Database(self.workspace.number_db, cache=cache)
+        self.assertEquals(len(db.Base.metadata.tables), 0)
+        self.assertEquals(len(db.query()), 2)
+
+    def test_schema_cache_ttl(self):
+        cache = SchemaCache(self.workspace.filename('cache'), ttl=0)
+        Database(self.workspace.number_db, cache=cache).query().rows.all()
+        db = Database(self.workspace.number_db, cache=cache)
+        self.assertEquals(len(db.Base.metadata.tables), 0)
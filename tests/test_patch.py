@@ -1,6 +1,14 @@
+from catsql.daffsql.staging_helper import StagingHelper
+from catsql.database import Database
+from catsql.keyed_diff import keyed_diff
 from catsql.main import catsql
-from catsql.patch import patchsql
+from catsql.nullify import Nullify
+from catsql.patch import patch_digest, patchsql
+import json
 import mock
+import os
+import six
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine
 import unittest
 
 from tests.workspace import Workspace
@@ -16,6 +24,23 @@ def editor_call(args):
         fout.write(txt)
 
 
+# a mix of changes, with one update (of "six") that matches no row
+MIXED_PATCH = ("@@,NAME,DIGIT\n"
+               "->,one,1->11\n"
+               "->,two,2->22\n"
+               "->,six,6->66\n"
+               "->,thrEE,3->33\n"
+               "---,foUR,4\n"
+               "---,five,NULL\n"
+               "+++,six,6\n"
+               "+++,seven,7\n")
+
+THREE_UPDATES = ("@@,NAME,DIGIT\n"
+                 "->,one,1->11\n"
+                 "->,two,2->22\n"
+                 "->,thrEE,3->33\n")
+
+
 class TestPatch(unittest.TestCase):
 
     def setUp(self):
@@ -24,6 +49,19 @@ class TestPatch(unittest.TestCase):
     def tearDown(self):
         self.workspace.tearDown()
 
+    def write_patch(self, text):
+        patch = self.workspace.filename('patch.diff')
+        with open(patch, 'w') as fout:
+            fout.write(text)
+        return patch
+
+    def digits(self):
+        self.workspace.output_text_cache = None
+        catsql([self.workspace.number_db, "--json", self.workspace.output_file])
+        result = self.workspace.output_json()
+        return sorted(row['DIGIT'] for row in result['results']
+                      if row['DIGIT'])
+
     def test_basic(self):
         patch = self.workspace.filename('patch.diff')
         with open(patch, 'w') as fout:
@@ -36,6 +74,100 @@ class TestPatch(unittest.TestCase):
         self.assertEquals(len(result['results']), 1)
         self.assertEquals(result['results'][0]['DIGIT'], 22)
 
+    def check_mixed(self, strategy):
+        patch = self.write_patch(MIXED_PATCH)
+        with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+            patchsql([self.workspace.number_db, '--table', 'sheet',
+                      '--patch', patch, '--strategy', strategy])
+        self.assertIn('skipped update {"NAME": "six", "DIGIT": "6"}',
+                      err.getvalue())
+        self.assertIn('"updates": 3, "inserts": 2, "deletes": 2, "skips": 1',
+                      err.getvalue())
+        self.assertEquals(self.digits(), [6, 7, 11, 22, 33])
+
+    def test_batched(self):
+        self.check_mixed('rows')
+
+    def test_staging(self):
+        self.check_mixed('staging')
+
+    def test_staging_latest(self):
+        # what the UPDATE ... FROM path joins against: the last staged
+        # change for each condition
+        staged = Table('staged', MetaData(),
+                       Column('catsql_seq', Integer, primary_key=True),
+                       Column('catsql_c0', Integer),
+                       Column('catsql_v0', String))
+        engine = create_engine('sqlite://')
+        staged.create(engine)
+        engine.execute(staged.insert(), [
+            {'catsql_seq': 0, 'catsql_c0': 1, 'catsql_v0': 'a'},
+            {'catsql_seq': 1, 'catsql_c0': 2, 'catsql_v0': 'b'},
+            {'catsql_seq': 2, 'catsql_c0': 1, 'catsql_v0': 'c'}])
+        latest = StagingHelper()._latest(staged)
+        rows = engine.execute(
+            latest.select().order_by(latest.c.catsql_c0)).fetchall()
+        self.assertEquals([tuple(row) for row in rows],
+                          [(2, 1, 'c'), (1, 2, 'b')])
+
+    def test_batched_keyed(self):
+        self.workspace.add_product_table()
+        patch = self.write_patch("@@,DIGIT,CODE\n"
+                                 "->,1,.->a\n"
+                                 "->,2,..->b\n"
+                                 "->,9,x->y\n"
+                                 "->,3,...->c\n")
+        with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+            patchsql([self.workspace.number_db, '--table', 'product',
+                      '--patch', patch])
+        self.assertIn('skipped update {"DIGIT": "9", "CODE": "x"}',
+                      err.getvalue())
+        self.assertIn('"updates": 3, "inserts": 0, "deletes": 0, "skips": 1',
+                      err.getvalue())
+        catsql([self.workspace.number_db, "--table", "product", "--json",
+                self.workspace.output_file])
+        result = self.workspace.output_json()
+        self.assertEquals([row['CODE'] for row in result['results']],
+                          ['a', 'b', 'c'])
+
+    def test_failure_rolls_back(self):
+        self.workspace.add_product_table()
+        patch = self.write_patch("@@,DIGIT,CODE\n"
+                                 "->,1,.->a\n"
+                                 "->,2,..->b\n"
+                                 "+++,3,...\n")
+        for strategy in ['rows', 'staging']:
+            with self.assertRaises(Exception):
+                patchsql([self.workspace.number_db, '--table', 'product',
+                          '--patch', patch, '--strategy', strategy, '--quiet'])
+            self.workspace.output_text_cache = None
+            catsql([self.workspace.number_db, "--table", "product", "--json",
+                    self.workspace.output_file])
+            result = self.workspace.output_json()
+            self.assertEquals([row['CODE'] for row in result['results']],
+                              ['.', '..', '...'])
+
+    def test_chunked(self):
+        patch = self.write_patch(THREE_UPDATES)
+        with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+            patchsql([self.workspace.number_db, '--table', 'sheet',
+                      '--patch', patch, '--chunk-size', '2', '--progress'])
+        self.assertIn('3/3 changes', err.getvalue())
+        self.assertEquals(self.digits(), [4, 11, 22, 33])
+
+    def test_resume(self):
+        patch = self.write_patch(THREE_UPDATES)
+        checkpoint = self.workspace.filename('patch.checkpoint')
+        with open(checkpoint, 'w') as fout:
+            fout.write(json.dumps({'patch': patch_digest('sheet', [patch]),
+                                   'done': 2}))
+        with mock.patch('sys.stderr', new_callable=six.StringIO) as err:
+            patchsql([self.workspace.number_db, '--table', 'sheet',
+                      '--patch', patch, '--checkpoint', checkpoint])
+        self.assertIn('resuming after 2 changes', err.getvalue())
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertEquals(self.digits(), [1, 2, 4, 33])
+
     def test_from_file_pair(self):
         f1 = self.workspace.filename('f1.csv')
         f2 = self.workspace.filename('f2.csv')
@@ -53,6 +185,87 @@ class TestPatch(unittest.TestCase):
         self.assertEquals(len(result['results']), 1)
         self.assertEquals(result['results'][0]['DIGIT'], 22)
 
+    def test_follow_keyed(self):
+        self.workspace.add_product_table()
+        f1 = self.workspace.filename('f1.csv')
+        f2 = self.workspace.filename('f2.csv')
+        with open(f1, 'w') as fout:
+            fout.write("DIGIT,CODE\n"
+                       "1,.\n"
+                       "2,..\n"
+                       "3,...\n")
+        with open(f2, 'w') as fout:
+            fout.write("DIGIT,CODE\n"
+                       "2,->\n"
+                       "3,...\n"
+                       "10,..........\n")
+        product = Database(self.workspace.number_db).tables_metadata['product']
+        patch = keyed_diff(product, f1, f2)
+        self.assertEquals([[patch.getCell(c, r)
+                            for c in range(patch.get_width())]
+                           for r in range(patch.get_height())],
+                          [['@@', 'DIGIT', 'CODE'],
+                           ['---', '1', '.'],
+                           ['-->', '2', '..-->->'],
+                           ['+++', '10', '..........']])
+        with mock.patch('sys.stderr', new_callable=six.StringIO):
+            patchsql([self.workspace.number_db, '--table', 'product',
+                      '--follow', f1, f2])
+        catsql([self.workspace.number_db, "--table", "product", "--json",
+                self.workspace.output_file])
+        result = self.workspace.output_json()
+        self.assertEquals([(row['DIGIT'], row['CODE'])
+                           for row in result['results']],
+                          [(2, '->'), (3, '...'), (10, '..........')])
+
+    def test_follow_unordered(self):
+        self.workspace.add_product_table()
+        f1 = self.workspace.filename('f1.csv')
+        f2 = self.workspace.filename('f2.csv')
+        with open(f1, 'w') as fout:
+            fout.write("DIGIT,CODE\n"
+                       "1,.\n"
+                       "2,..\n")
+        with open(f2, 'w') as fout:
+            fout.write("DIGIT,CODE\n"
+                       "2,..\n"
+                       "1,:\n")
+        product = Database(self.workspace.number_db).tables_metadata['product']
+        self.assertIsNone(keyed_diff(product, f1, f2))
+        patchsql([self.workspace.number_db, '--table', 'product',
+                  '--follow', f1, f2, '--quiet'])
+        catsql([self.workspace.number_db, "--table", "product", "--json",
+                self.workspace.output_file])
+        result = self.workspace.output_json()
+        self.assertEquals([row['CODE'] for row in result['results']],
+                          [':', '..', '...'])
+
+    def test_follow_safe_null(self):
+        f1 = self.workspace.filename('f1.csv')
+        f2 = self.workspace.filename('f2.csv')
+        with open(f1, 'w') as fout:
+            fout.write("NAME,DIGIT\n"
+                       "five,NULL\n")
+        with open(f2, 'w') as fout:
+            fout.write("NAME,DIGIT\n"
+                       "five,5\n")
+        patchsql([self.workspace.number_db, '--table', 'sheet', '--follow', f1, f2,
+                  '--safe-null', '--quiet'])
+        catsql([self.workspace.number_db, "--json", self.workspace.output_file,
+                '--NAME', 'five'])
+        result = self.workspace.output_json()
+        self.assertEquals(len(result['results']), 1)
+        self.assertEquals(result['results'][0]['DIGIT'], 5)
+
+    def test_nullify_rows(self):
+        nullify = Nullify()
+        rows = [[None, 'NULL', '_NULL', 'Nancy', 1, '']]
+        encoded = list(nullify.encode_rows(rows))
+        self.assertEquals(encoded,
+                          [['NULL', '_NULL', '__NULL', 'Nancy', 1, '']])
+        self.assertEquals(list(nullify.decode_rows(encoded)), rows)
+        self.assertEquals(nullify.decode_table(encoded), rows)
+
     @mock.patch('catsql.main.call', editor_call)
     def test_integrated(self):
         catsql([self.workspace.number_db, '--edit', '--quiet'])
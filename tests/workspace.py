@@ -58,6 +58,19 @@ class Workspace(object):
         conn = sqlite3.connect(self.number_file)
         conn.cursor().executescript(PRODUCT_SQL)
 
+    def analyze(self):
+        conn = sqlite3.connect(self.number_file)
+        conn.cursor().executescript("CREATE INDEX IF NOT EXISTS sheet_name "
+                                    "ON sheet (NAME);"
+                                    "ANALYZE;")
+
+    def add_fulltext_index(self):
+        conn = sqlite3.connect(self.number_file)
+        conn.cursor().executescript("CREATE VIRTUAL TABLE sheet_fts "
+                                    "USING fts5(NAME, content='sheet');"
+                                    "INSERT INTO sheet_fts(sheet_fts) "
+                                    "VALUES('rebuild');")
+
     def tearDown(self):
         try:
             shutil.rmtree(os.path.join(os.path.dirname(os.path.realpath(self.path)),